@@ -0,0 +1,453 @@
+# --------------------------------------------------------
+#    mmqgis_benchmark - timings for mmqgis_library operations
+#
+#    Run with the QGIS python environment on the path:
+#	python mmqgis_benchmark.py [benchmark name ...]
+#
+#    Timings that would take hours with the legacy code are
+#    extrapolated from a sample and marked with a "~"
+# --------------------------------------------------------
+
+import os
+import sys
+import time
+import random
+import shutil
+import zipfile
+import tempfile
+
+from mmqgis_library import *
+
+def benchmark_time(function, *args):
+	start = time.time()
+	result = function(*args)
+	return time.time() - start, result
+
+# Stand-in for the QGIS interface so library functions that report
+# progress can be timed outside of a running QGIS
+
+class benchmark_interface:
+	def mainWindow(self):
+		return self
+
+	def statusBar(self):
+		return self
+
+	def messageBar(self):
+		return self
+
+	def showMessage(self, message):
+		pass
+
+	def pushMessage(self, message, level, duration):
+		pass
+
+	def addVectorLayer(self, path, name, provider):
+		pass
+
+def benchmark_report(name, count, old_seconds, new_seconds, estimated = False):
+	if estimated:
+		old_text = "~%.2f" % old_seconds
+	else:
+		old_text = "%.2f" % old_seconds
+
+	print "%-24s %10d %14s %12.2f %9.1fx" % (name, count, old_text, new_seconds, \
+		old_seconds / max(new_seconds, 1e-6))
+
+# --------------------------------------------------------
+#    Legacy implementations replaced in mmqgis_library,
+#	kept here to time the new code against
+# --------------------------------------------------------
+
+# Original mmqgis_library cell construction from tangents to the midpoints
+# with every other point. O(n^2) per cell.
+
+def legacy_voronoi_cell(center, points, xmin, ymin, xmax, ymax):
+	# Borders are tangents to midpoints between all neighbors
+	tangents = []
+	for neighbor in points:
+		border = mmqgis_voronoi_line((center[0] + neighbor[0]) / 2.0, (center[1] + neighbor[1]) / 2.0)
+		if ((neighbor[0] != center[0]) or (neighbor[1] != center[1])):
+			tangents.append(border)
+
+	# Add edge intersections to clip to extent of points
+	offset = (xmax - xmin) * 0.01
+	tangents.append(mmqgis_voronoi_line(xmax + offset, center[1]))
+	tangents.append(mmqgis_voronoi_line(center[0], ymax + offset))
+	tangents.append(mmqgis_voronoi_line(xmin - offset, center[1]))
+	tangents.append(mmqgis_voronoi_line(center[0], ymin - offset))
+	#print "Extent x = " + str(xmax) + " -> " + str(xmin) + ", y = " + str(ymax) + " -> " + str(ymin)
+
+	# Find vector distance and angle to border from center point
+	for scan in range(0, len(tangents)):
+		run = tangents[scan].x - center[0]
+		rise = tangents[scan].y - center[1]
+		tangents[scan].distance = sqrt((run * run) + (rise * rise))
+		if (tangents[scan].distance <= 0):
+			tangents[scan].angle = 0
+		elif (tangents[scan].y >= center[1]):
+			tangents[scan].angle = acos(run / tangents[scan].distance)
+		elif (tangents[scan].y < center[1]):
+			tangents[scan].angle = (2 * pi) - acos(run / tangents[scan].distance)
+		elif (tangents[scan].x > center[0]):
+			tangents[scan].angle = pi / 2.0
+		else:
+			tangents[scan].angle = 3 * pi / 4
+
+		#print "  Tangent, " + str(tangents[scan].x) + ", " + str(tangents[scan].y) + \
+		#	", angle " + str(tangents[scan].angle * 180 / pi) + ", distance " + \
+		#	str(tangents[scan].distance)
+
+
+	# Find the closest line - guaranteed to be a border
+	closest = -1
+	for scan in range(0, len(tangents)):
+		if ((closest == -1) or (tangents[scan].distance < tangents[closest].distance)):
+			closest = scan
+
+	# Use closest as the first border
+	border = mmqgis_voronoi_line(tangents[closest].x, tangents[closest].y)
+	border.angle = tangents[closest].angle
+	border.distance = tangents[closest].distance
+	borders = [ border ]
+
+	#print "  Border 0) " + str(closest) + " of " + str(len(tangents)) + ", " \
+	#	+ str(border.x) + ", " + str(border.y) \
+	#	+ ", (angle " + str(border.angle * 180 / pi) + ", distance " \
+	#	+ str(border.distance) + ")"
+
+	# Work around the tangents in a CCW circle
+	circling = 1
+	while circling:
+		next = -1
+		scan = 0
+		while (scan < len(tangents)):
+			anglebetween = tangents[scan].angle - borders[len(borders) - 1].angle
+			if (anglebetween < 0):
+				anglebetween += (2 * pi)
+			elif (anglebetween > (2 * pi)):
+				anglebetween -= (2 * pi)
+
+			#print "    Scanning " + str(scan) + " of " + str(len(borders)) + \
+			#	", " + str(tangents[scan].x) + ", " + str(tangents[scan].y) + \
+			#	", angle " + str(tangents[scan].angle * 180 / pi) + \
+			#	", anglebetween " + str(anglebetween * 180 / pi)
+
+			# If border intersects to the left
+			if (anglebetween < pi) and (anglebetween > 0):
+				# A typo here with a reversed slash cost 8/13/2009 debugging
+				tangents[scan].iangle = atan2( (tangents[scan].distance / 
+					borders[len(borders) - 1].distance) \
+					- cos(anglebetween), sin(anglebetween))
+				tangents[scan].idistance = borders[len(borders) - 1].distance \
+					/ cos(tangents[scan].iangle)
+
+				tangents[scan].iangle += borders[len(borders) - 1].angle
+
+				# If the rightmost intersection so far, it's a candidate for next border
+				if (next < 0) or (tangents[scan].iangle < tangents[next].iangle):
+					# print "      Take idistance " + str(tangents[scan].idistance)
+					next = scan
+
+			scan += 1
+
+		# iangle/distance are for intersection of border with next border
+		borders[len(borders) - 1].iangle = tangents[next].iangle
+		borders[len(borders) - 1].idistance = tangents[next].idistance
+
+		# Stop circling if back to the beginning
+		if (borders[0].x == tangents[next].x) and (borders[0].y == tangents[next].y):
+			circling = 0
+
+		else:
+			# Add the next border
+			border = mmqgis_voronoi_line(tangents[next].x, tangents[next].y)
+			border.angle = tangents[next].angle
+			border.distance = tangents[next].distance
+			border.iangle = tangents[next].iangle
+			border.idistance = tangents[next].idistance
+			borders.append(border)
+			#print "  Border " + str(len(borders) - 1) + \
+			#	") " + str(next) + ", " + str(border.x) + \
+			#	", " + str(border.y) + ", angle " + str(border.angle * 180 / pi) +\
+			#	", iangle " + str(border.iangle * 180 / pi) +\
+			#	", idistance " + str(border.idistance) + "\n"
+
+		# Remove the border from the list so not repeated
+		tangents.pop(next)
+		if (len(tangents) <= 0):
+			circling = 0
+
+	polygon = []
+	if len(borders) >= 3:
+		for border in borders:
+			ix = center[0] + (border.idistance * cos(border.iangle))
+			iy = center[1] + (border.idistance * sin(border.iangle))
+			#print "  Node, " + str(ix) + ", " + str(iy) + \
+			#	", angle " + str(border.angle * 180 / pi) + \
+			#	", iangle " + str(border.iangle * 180 / pi) + \
+			#	", idistance " + str(border.idistance) + ", from " \
+			#	+ str(border.x) + ", " + str(border.y)
+			polygon.append(QgsPoint(ix, iy))
+
+		#print "Polygon " + unicode(point_number)
+		#for x in range(0, len(polygon)):
+		#	print "  Point " + unicode(polygon[x].x()) + ", " + unicode(polygon[x].y())
+
+		# Remove duplicate nodes
+		# Compare as strings (unicode) to avoid odd precision discrepancies
+		# that sometimes cause duplicate points to be unrecognized
+		dup = 0
+		while (dup < (len(polygon) - 1)):
+			if (unicode(polygon[dup].x()) == unicode(polygon[dup + 1].x())) and \
+			   (unicode(polygon[dup].y()) == unicode(polygon[dup + 1].y())):
+				polygon.pop(dup)
+				# print "  Removed duplicate node " + unicode(dup) + \
+				#	" in polygon " + unicode(point_number)
+			else:
+				# print "  " + unicode(polygon[dup].x()) + ", " + \
+				#	unicode(polygon[dup].y()) + " != " + \
+				#	unicode(polygon[dup + 1].x()) + ", " + \
+				#	unicode(polygon[dup + 1].y())
+				dup = dup + 1
+
+		# attributes = { 0:QVariant(center[0]), 1:QVariant(center[1]) }
+
+	return polygon
+
+# Original pop() based mmqgis_gridify_points().
+# Quadratic in the number of points.
+
+def legacy_gridify_points(hspacing, vspacing, points):
+	# Align points to grid
+	point_count = 0
+	deleted_points = 0
+	newpoints = []
+	for point in points:
+		point_count += 1
+		newpoints.append(QgsPoint(round(point.x() / hspacing, 0) * hspacing, \
+				    round(point.y() / vspacing, 0) * vspacing))
+
+	# Delete overlapping points
+	z = 0
+	while z < (len(newpoints) - 2):
+		if newpoints[z] == newpoints[z + 1]:
+			newpoints.pop(z + 1)
+			deleted_points += 1
+		else:
+			z += 1
+
+	# Delete line points that go out and return to the same place
+	z = 0
+	while z < (len(newpoints) - 3):
+		if newpoints[z] == newpoints[z + 2]:
+			newpoints.pop(z + 1)
+			newpoints.pop(z + 1)
+			deleted_points += 2
+			# Step back to catch arcs
+			if (z > 0):
+				z -= 1
+		else:
+			z += 1
+
+	# Delete overlapping start/end points
+	while (len(newpoints) > 1) and (newpoints[0] == newpoints[len(newpoints) - 1]):
+		newpoints.pop(len(newpoints) - 1)
+		deleted_points += 2
+				
+	return newpoints, point_count, deleted_points
+
+# Original mmqgis_buffer_geometry() that builds new CRS and
+# transform objects on every call
+
+def legacy_buffer_geometry(geometry, meters):
+	if meters <= 0:
+		return None
+
+	# To approximate meaningful meter distances independent of the original CRS,
+	# the geometry is transformed to an azimuthal equidistant projection
+	# with the center of the polygon as the origin. After buffer creation,
+	# the buffer is transformed to WGS 84 and returned. While this may introduce
+	# some deviation from the original CRS, buffering is assumed in practice
+	# to be a fairly inexact operation that can tolerate such deviation
+
+	wgs84 = QgsCoordinateReferenceSystem()
+	wgs84.createFromProj4("+proj=longlat +datum=WGS84 +no_defs")
+
+	latitude = str(geometry.centroid().asPoint().y())
+	longitude = str(geometry.centroid().asPoint().x())
+
+	#proj4 = "+proj=aeqd +lat_0=" + str(geometry.centroid().asPoint().y()) + \
+	#	" +lon_0=" + str(geometry.centroid().asPoint().x()) + \
+	#	" +x_0=0 +y_0=0 +datum=WGS84 +units=m +no_defs"
+
+	# For some reason, Azimuthal Equidistant transformation noticed to not be
+	# working on 10 July 2014. World Equidistant Conic works, but there may be errors.
+	proj4 = "+proj=eqdc +lat_0=0 +lon_0=0 +lat_1=60 +lat_2=60 " + \
+		"+x_0=0 +y_0=0 +ellps=WGS84 +datum=WGS84 +units=m +no_defs"
+
+	azimuthal_equidistant = QgsCoordinateReferenceSystem()
+	azimuthal_equidistant.createFromProj4(proj4)
+	
+	transform = QgsCoordinateTransform(wgs84, azimuthal_equidistant)
+	geometry.transform(transform)
+
+	newgeometry = geometry.buffer(meters, 7)
+
+	wgs84 = QgsCoordinateReferenceSystem()
+	wgs84.createFromProj4("+proj=longlat +datum=WGS84 +no_defs")
+
+	transform = QgsCoordinateTransform(azimuthal_equidistant, wgs84)
+	newgeometry.transform(transform)
+
+	return newgeometry
+
+# --------------------------------------------------------
+#    Voronoi diagram: tangent walk vs sweepline cells
+# --------------------------------------------------------
+
+def benchmark_voronoi(sizes = [1000, 10000, 100000], sample = 100):
+	for count in sizes:
+		random.seed(count)
+		points = [ (random.uniform(0, 100000), random.uniform(0, 100000), []) for x in range(count) ]
+		xmin = min([ point[0] for point in points ])
+		xmax = max([ point[0] for point in points ])
+		ymin = min([ point[1] for point in points ])
+		ymax = max([ point[1] for point in points ])
+
+		new_seconds, cells = benchmark_time(mmqgis_voronoi_cells, points, xmin, ymin, xmax, ymax)
+
+		# The legacy cost per cell is linear in the point count, so
+		# a sample of cells is timed and scaled to the full layer
+		centers = points[0:min(sample, count)]
+		start = time.time()
+		for center in centers:
+			legacy_voronoi_cell(center, points, xmin, ymin, xmax, ymax)
+		old_seconds = (time.time() - start) * count / len(centers)
+
+		benchmark_report("voronoi", count, old_seconds, new_seconds, len(centers) < count)
+
+# --------------------------------------------------------
+#    Hexagon grid: cell by cell vs column arrays
+# --------------------------------------------------------
+
+def benchmark_grid(sizes = [1000000, 10000000], sample = 100000, shapetype = "Hexagons"):
+	qgis = benchmark_interface()
+	crs = QgsCoordinateReferenceSystem()
+	directory = tempfile.mkdtemp()
+
+	def spacing(count):
+		# Hexagon columns are 0.866 row heights wide on a 1000 x 1000 extent
+		return 1000.0 / sqrt(count * 0.866025403784439)
+
+	try:
+		for count in sizes:
+			yspacing = spacing(count)
+			new_seconds, message = benchmark_time(mmqgis_grid, qgis, shapetype, crs, \
+				yspacing, yspacing, 0, 0, 1000, 1000, "grid", \
+				os.path.join(directory, "new.shp"), False)
+
+			# The legacy cost per cell is constant, so a smaller
+			# grid is timed and scaled to the full cell count
+			yspacing = spacing(min(sample, count))
+			old_seconds, message = benchmark_time(mmqgis_grid_without_numpy, qgis, shapetype, crs, \
+				yspacing, yspacing, 0, 0, 1000, 1000, "grid", \
+				os.path.join(directory, "old.shp"), False)
+			old_seconds = old_seconds * count / min(sample, count)
+
+			benchmark_report("grid", count, old_seconds, new_seconds, sample < count)
+
+	finally:
+		shutil.rmtree(directory)
+
+# --------------------------------------------------------
+#    Gridify: pop() cleanup vs stack cleanup on the
+#	bundled Mississippi coastline
+# --------------------------------------------------------
+
+def benchmark_gridify(spacings = [0.0001, 0.001, 0.01], repeat = 12):
+	directory = tempfile.mkdtemp()
+	try:
+		zipfile.ZipFile(os.path.join(os.path.dirname(os.path.abspath(__file__)), \
+			"MSCoast_geo.zip")).extractall(directory)
+		layer = QgsVectorLayer(os.path.join(directory, "MSCoast_geo.shp"), "coast", "ogr")
+		if not layer.isValid():
+			print "Failure loading MSCoast_geo.zip"
+			return
+
+		lines = []
+		for feature in layer.getFeatures():
+			geometry = feature.geometry()
+			if len(geometry.asPolyline()) > 0:
+				lines.append(geometry.asPolyline())
+			else:
+				lines.extend(geometry.asMultiPolyline())
+
+		# The coastline is joined end to end and repeated
+		# to get one long line like a detailed coastline
+		line = []
+		for z in range(repeat):
+			for polyline in lines:
+				line.extend(polyline)
+
+		for spacing in spacings:
+			old_seconds, old = benchmark_time(legacy_gridify_points, spacing, spacing, list(line))
+			new_seconds, new = benchmark_time(mmqgis_gridify_points, spacing, spacing, list(line))
+			if (old[0] != new[0]) or (old[1:] != new[1:]):
+				print "gridify results differ at spacing " + unicode(spacing)
+
+			benchmark_report("gridify " + unicode(spacing), len(line), old_seconds, new_seconds)
+
+	finally:
+		shutil.rmtree(directory)
+
+# --------------------------------------------------------
+#    Geometry buffers: new CRS objects per feature vs
+#	cached CRS and transforms
+# --------------------------------------------------------
+
+def benchmark_buffers(sizes = [1000, 10000, 100000], sample = 10000):
+	def squares(count):
+		random.seed(count)
+		geometries = []
+		for x in range(count):
+			left = random.uniform(-120, 120)
+			bottom = random.uniform(-60, 60)
+			geometries.append(QgsGeometry.fromPolygon([[QgsPoint(left, bottom), \
+				QgsPoint(left + 0.01, bottom), QgsPoint(left + 0.01, bottom + 0.01), \
+				QgsPoint(left, bottom + 0.01), QgsPoint(left, bottom)]]))
+		return geometries
+
+	for count in sizes:
+		geometries = squares(count)
+		mmqgis_crs_cache.clear()
+		mmqgis_transform_cache.clear()
+		start = time.time()
+		for geometry in geometries:
+			mmqgis_buffer_geometry(geometry, 500)
+		new_seconds = time.time() - start
+
+		# The legacy cost per feature is constant, so a
+		# sample of features is timed and scaled
+		geometries = squares(min(sample, count))
+		start = time.time()
+		for geometry in geometries:
+			legacy_buffer_geometry(geometry, 500)
+		old_seconds = (time.time() - start) * count / len(geometries)
+
+		benchmark_report("buffers", count, old_seconds, new_seconds, len(geometries) < count)
+
+benchmarks = {
+	"buffers": benchmark_buffers,
+	"grid": benchmark_grid,
+	"gridify": benchmark_gridify,
+	"voronoi": benchmark_voronoi }
+
+if __name__ == "__main__":
+	names = sys.argv[1:]
+	if not names:
+		names = sorted(benchmarks.keys())
+
+	print "%-24s %10s %14s %12s %10s" % ("benchmark", "count", "old seconds", "new seconds", "speedup")
+	for name in names:
+		benchmarks[name]()
@@ -0,0 +1,273 @@
+# --------------------------------------------------------
+#    mmqgis_checks - checks that optimized mmqgis_library
+#	functions behave like the code they replaced
+#
+#    Run with or without QGIS:
+#	python mmqgis_checks.py [check name ...]
+#
+#    Outside of QGIS, stand-ins for the few QGIS classes these
+#    checks use are installed before mmqgis_library is imported
+# --------------------------------------------------------
+
+import sys
+import time
+import types
+import random
+import threading
+import urlparse
+import BaseHTTPServer
+import SocketServer
+
+from multiprocessing.pool import ThreadPool
+
+try:
+	import qgis.core
+
+except ImportError:
+	class QgsPoint:
+		def __init__(self, x = 0.0, y = 0.0):
+			self.xvalue = float(x)
+			self.yvalue = float(y)
+
+		def x(self):
+			return self.xvalue
+
+		def y(self):
+			return self.yvalue
+
+		def __eq__(self, other):
+			return (self.xvalue == other.x()) and (self.yvalue == other.y())
+
+		def __ne__(self, other):
+			return not self.__eq__(other)
+
+	class QGis:
+		WKBUnknown, WKBPoint, WKBLineString, WKBPolygon, \
+			WKBMultiPoint, WKBMultiLineString, WKBMultiPolygon = range(7)
+		WKBNoGeometry = 100
+		WKBPoint25D, WKBLineString25D, WKBPolygon25D, WKBMultiPoint25D, \
+			WKBMultiLineString25D, WKBMultiPolygon25D = range(0x80000001, 0x80000007)
+
+	core = types.ModuleType("qgis.core")
+	core.QgsPoint = QgsPoint
+	core.QGis = QGis
+	sys.modules["qgis"] = types.ModuleType("qgis")
+	sys.modules["qgis"].core = core
+	sys.modules["qgis.core"] = core
+	for name in ["PyQt4", "PyQt4.QtCore", "PyQt4.QtGui"]:
+		sys.modules[name] = types.ModuleType(name)
+
+import mmqgis_library
+from mmqgis_benchmark import *
+
+def check_report(name, failures, detail):
+	if failures:
+		print "%-24s FAILED %s" % (name, detail)
+	else:
+		print "%-24s ok     %s" % (name, detail)
+	return not failures
+
+# --------------------------------------------------------
+#    Geocoding worker pool against a local stand-in for
+#	Nominatim that fails some first requests
+# --------------------------------------------------------
+
+class check_geocode_server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+	daemon_threads = True
+
+class check_geocode_handler(BaseHTTPServer.BaseHTTPRequestHandler):
+	def do_GET(self):
+		address = urlparse.parse_qs(urlparse.urlparse(self.path).query)["q"][0]
+		number = int(address.split(" ")[0])
+
+		with self.server.lock:
+			self.server.times.append(time.time())
+			retry = (number % 5 == 0) and (address not in self.server.failed)
+			if retry:
+				self.server.failed.add(address)
+
+		if retry:
+			self.send_response(503)
+			self.end_headers()
+			return
+
+		self.send_response(200)
+		self.send_header("Content-Type", "text/xml")
+		self.end_headers()
+		self.wfile.write('<searchresults><place lat="%d.5" lon="-%d.25" class="place" ' \
+			'type="house" display_name="%s"/></searchresults>' % (number, number, address))
+
+	def log_message(self, format, *args):
+		pass
+
+def check_geocode_pool(count = 60, rate = 20, workers = 8):
+	server = check_geocode_server(("127.0.0.1", 0), check_geocode_handler)
+	server.lock = threading.Lock()
+	server.times = []
+	server.failed = set()
+	thread = threading.Thread(target = server.serve_forever)
+	thread.daemon = True
+	thread.start()
+
+	urls = dict(mmqgis_library.mmqgis_geocode_urls)
+	backoff = mmqgis_library.mmqgis_geocode_backoff
+	mmqgis_library.mmqgis_geocode_urls["OpenStreetMap / Nominatim"] = \
+		"http://127.0.0.1:%d/search" % server.server_address[1]
+	mmqgis_library.mmqgis_geocode_backoff = lambda attempt: None
+
+	try:
+		limiter = mmqgis_rate_limiter(rate)
+		tasks = [ ("OpenStreetMap / Nominatim", None, "%d+Main+Street" % number, limiter, None) \
+			for number in range(count) ]
+
+		pool = ThreadPool(workers)
+		start = time.time()
+		results = list(pool.imap(mmqgis_geocode_task, tasks))
+		seconds = time.time() - start
+		pool.close()
+		pool.join()
+
+	finally:
+		mmqgis_library.mmqgis_geocode_urls.update(urls)
+		mmqgis_library.mmqgis_geocode_backoff = backoff
+		server.shutdown()
+		server.server_close()
+
+	failures = []
+	for number, result in enumerate(results):
+		if (result == None) or (result[0] != [ -number - 0.25 ]) or (result[1] != [ number + 0.5 ]):
+			failures.append("address " + unicode(number) + " gave " + unicode(result))
+
+	# Every address is requested once, plus a retry for each failure
+	requests = count + len([ number for number in range(count) if number % 5 == 0 ])
+	if len(server.times) != requests:
+		failures.append(unicode(len(server.times)) + " requests instead of " + unicode(requests))
+
+	# With a burst of one, no rate + 1 requests fit in one second
+	times = sorted(server.times)
+	for index in range(rate, len(times)):
+		if (times[index] - times[index - rate]) < 0.98:
+			failures.append("more than " + unicode(rate) + " requests in one second")
+			break
+
+	return check_report("geocode pool", failures[0:5], "%d requests in %.2f seconds at %d/s" \
+		% (len(server.times), seconds, rate))
+
+# --------------------------------------------------------
+#    Gridify against the original pop() based version,
+#	with and without NumPy
+# --------------------------------------------------------
+
+def check_gridify_line(random, count):
+	# Short random walks over half spacings give repeated points,
+	# back and forth steps, rounding ties and closed rings
+	x = random.randint(-10, 10) * 0.5
+	y = random.randint(-10, 10) * 0.5
+	points = [ QgsPoint(x, y) ]
+	for z in range(1, count):
+		x += random.choice([ -0.5, 0, 0, 0.5 ]) + random.uniform(-0.1, 0.1) * random.randint(0, 1)
+		y += random.choice([ -0.5, 0, 0, 0.5 ])
+		points.append(QgsPoint(x, y))
+	if (count > 2) and (random.random() < 0.25):
+		points.append(QgsPoint(points[0].x(), points[0].y()))
+	return points
+
+def check_gridify(lines = 2000):
+	generator = random.Random(18)
+	cases = [ check_gridify_line(generator, generator.choice([ 0, 1, 2, 3, 4, 5, 8, 30, 64, 100, 250 ])) \
+		for line in range(lines) ]
+
+	paths = [ ("without NumPy", None) ]
+	if mmqgis_library.numpy != None:
+		paths.append(("with NumPy", mmqgis_library.numpy))
+
+	numpy = mmqgis_library.numpy
+	failures = []
+	try:
+		for name, module in paths:
+			mmqgis_library.numpy = module
+			for index, points in enumerate(cases):
+				hspacing, vspacing = [ (1, 1), (0.5, 0.5), (2, 0.25) ][index % 3]
+				old = legacy_gridify_points(hspacing, vspacing, points)
+				new = mmqgis_gridify_points(hspacing, vspacing, points)
+				if (old[1:] != new[1:]) or (len(old[0]) != len(new[0])) or \
+				   [ (point.x(), point.y()) for point in old[0] ] != [ (point.x(), point.y()) for point in new[0] ]:
+					failures.append(name + ": line " + unicode(index) + " differs")
+	finally:
+		mmqgis_library.numpy = numpy
+
+	return check_report("gridify", failures[0:5], "%d lines %s" \
+		% (lines, " and ".join([ name for name, module in paths ])))
+
+# --------------------------------------------------------
+#    NumPy distance, bearing and end point functions
+#	against the scalar versions they batch
+# --------------------------------------------------------
+
+def check_geodesic_differs(batch, scalar, tolerance = 1e-9):
+	return abs(batch - scalar) > (tolerance * max(1.0, abs(scalar)))
+
+def check_geodesic(count = 20000):
+	if mmqgis_library.numpy == None:
+		print "%-24s skipped (NumPy is not installed)" % "geodesic"
+		return True
+
+	# Random points plus coincident, nearly antipodal and polar pairs
+	generator = random.Random(24)
+	pairs = [ (generator.uniform(-180, 180), generator.uniform(-90, 90), \
+		generator.uniform(-180, 180), generator.uniform(-90, 90)) for z in range(count) ]
+	pairs = pairs + [ (x, y, x, y) for x, y, end_x, end_y in pairs[0:100] ]
+	pairs = pairs + [ (x, y, x - 179.999, 0.001 - y) for x, y, end_x, end_y in pairs[100:200] ]
+	pairs = pairs + [ (x, 90, end_x, end_y) for x, y, end_x, end_y in pairs[200:300] ]
+	start_x, start_y, end_x, end_y = [ list(values) for values in zip(*pairs) ]
+	lengths = [ generator.choice([ 0, 1, 1000, 1e6, 1.5e7 ]) for pair in pairs ]
+
+	distances = mmqgis_distances(start_x, start_y, end_x, end_y)
+	bearings = mmqgis_bearings(start_x, start_y, end_x, end_y)
+	endpoints = mmqgis_endpoints(start_x, start_y, lengths, bearings)
+
+	failures = []
+	for z, (x, y, ex, ey) in enumerate(pairs):
+		start = QgsPoint(x, y)
+		end = QgsPoint(ex, ey)
+		endpoint = mmqgis_endpoint(start, lengths[z], bearings[z])
+		if check_geodesic_differs(distances[z], mmqgis_distance(start, end)):
+			failures.append("distance " + unicode(pairs[z]))
+		if check_geodesic_differs(bearings[z], mmqgis_bearing(start, end)):
+			failures.append("bearing " + unicode(pairs[z]))
+		if check_geodesic_differs(endpoints[0][z], endpoint.x()) or \
+		   check_geodesic_differs(endpoints[1][z], endpoint.y()):
+			failures.append("end point " + unicode(pairs[z]))
+
+	# Broadcast forms used by hub distance (one hub, many points)
+	# and point buffers (one center and radius, many bearings)
+	hub = QgsPoint(start_x[0], start_y[0])
+	distances = mmqgis_distances(start_x[0], start_y[0], end_x, end_y)
+	degrees = [ z * 360.0 / 64 for z in range(64) ]
+	ring = mmqgis_endpoints(start_x[0], start_y[0], 5000, degrees)
+	for z in range(len(pairs)):
+		if check_geodesic_differs(distances[z], mmqgis_distance(hub, QgsPoint(end_x[z], end_y[z]))):
+			failures.append("hub distance " + unicode(pairs[z]))
+	for z in range(len(degrees)):
+		endpoint = mmqgis_endpoint(hub, 5000, degrees[z])
+		if check_geodesic_differs(ring[0][z], endpoint.x()) or \
+		   check_geodesic_differs(ring[1][z], endpoint.y()):
+			failures.append("buffer ring bearing " + unicode(degrees[z]))
+
+	return check_report("geodesic", failures[0:5], "%d pairs to 1e-9" % len(pairs))
+
+checks = {
+	"geocode": check_geocode_pool,
+	"geodesic": check_geodesic,
+	"gridify": check_gridify }
+
+if __name__ == "__main__":
+	names = sys.argv[1:]
+	if not names:
+		names = sorted(checks.keys())
+
+	passed = True
+	for name in names:
+		passed = checks[name]() and passed
+
+	sys.exit(0 if passed else 1)
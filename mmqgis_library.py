@@ -15,16 +15,29 @@
 import io
 import re
 import csv
+import json
 import sys
 import time
 import locale
+import struct
+import hashlib
 import random
 import urllib2
 import os.path
 import operator
 import tempfile
+import heapq
+import bisect
+import cPickle
+import itertools
+import collections
+import threading
+import sqlite3
+import Queue
 import xml.etree.ElementTree
 
+from multiprocessing.pool import ThreadPool
+
 from qgis.core import *
 from PyQt4.QtCore import *
 from PyQt4.QtGui import *
@@ -32,6 +45,16 @@ from PyQt4.QtGui import *
 # Used instead of "import math" so math functions can be used without "math." prefix
 from math import *
 
+# Fortune's sweepline algorithm for Voronoi diagrams
+from voronoi import computeVoronoiNeighbors
+
+# NumPy comes with QGIS, but functions that use it fall back
+# to plain python when it is not installed
+try:
+	import numpy
+except ImportError:
+	numpy = None
+
 # --------------------------------------------------------
 #    MMQGIS Utility Functions
 # --------------------------------------------------------
@@ -96,42 +119,65 @@ def mmqgis_format_float(value, separator, decimals):
 
 def mmqgis_gridify_points(hspacing, vspacing, points):
 	# Align points to grid
-	point_count = 0
+	point_count = len(points)
 	deleted_points = 0
-	newpoints = []
-	for point in points:
-		point_count += 1
-		newpoints.append(QgsPoint(round(point.x() / hspacing, 0) * hspacing, \
-				    round(point.y() / vspacing, 0) * vspacing))
-
-	# Delete overlapping points
-	z = 0
-	while z < (len(newpoints) - 2):
-		if newpoints[z] == newpoints[z + 1]:
-			newpoints.pop(z + 1)
-			deleted_points += 1
-		else:
-			z += 1
-
-	# Delete line points that go out and return to the same place
-	z = 0
-	while z < (len(newpoints) - 3):
-		if newpoints[z] == newpoints[z + 2]:
-			newpoints.pop(z + 1)
-			newpoints.pop(z + 1)
-			deleted_points += 2
-			# Step back to catch arcs
-			if (z > 0):
-				z -= 1
-		else:
-			z += 1
+	x = [ point.x() for point in points ]
+	y = [ point.y() for point in points ]
+
+	# Coordinate arrays are snapped at once for longer lines. Python 2 round()
+	# rounds halves away from zero, which numpy.round() does not, so the
+	# rounding is done from the exact fractional part instead.
+	if (numpy != None) and (point_count >= 64):
+		cells = []
+		for values, spacing in [ (x, hspacing), (y, vspacing) ]:
+			values = numpy.array(values) / spacing
+			whole = numpy.floor(numpy.abs(values))
+			whole = whole + ((numpy.abs(values) - whole) >= 0.5)
+			cells.append((numpy.copysign(whole, values) * spacing).tolist())
+		newpoints = zip(cells[0], cells[1])
+	else:
+		newpoints = [ (round(x[z] / hspacing, 0) * hspacing, round(y[z] / vspacing, 0) * vspacing) \
+			for z in range(point_count) ]
+
+	# Delete overlapping points. Each point is compared to the last point kept,
+	# except the final point, which is always kept.
+	if len(newpoints) > 0:
+		kept = [ newpoints[0] ]
+		for z in range(1, len(newpoints) - 1):
+			if newpoints[z] == kept[-1]:
+				deleted_points += 1
+			else:
+				kept.append(newpoints[z])
+		if len(newpoints) > 1:
+			kept.append(newpoints[-1])
+		newpoints = kept
+
+	# Delete line points that go out and return to the same place.
+	# Kept points are a stack and the rest are read from an index into
+	# newpoints. Stepping back to catch arcs returns the top of the stack
+	# to the unread points. Stops when fewer than three points are unread.
+	if len(newpoints) > 3:
+		kept = [ newpoints[0] ]
+		z = 1
+		while (len(newpoints) - z) >= 3:
+			if kept[-1] == newpoints[z + 1]:
+				z += 2
+				deleted_points += 2
+				# Step back to catch arcs
+				if len(kept) > 1:
+					z -= 1
+					newpoints[z] = kept.pop()
+			else:
+				kept.append(newpoints[z])
+				z += 1
+		newpoints = kept + newpoints[z:]
 
 	# Delete overlapping start/end points
 	while (len(newpoints) > 1) and (newpoints[0] == newpoints[len(newpoints) - 1]):
 		newpoints.pop(len(newpoints) - 1)
 		deleted_points += 2
 				
-	return newpoints, point_count, deleted_points
+	return [ QgsPoint(point[0], point[1]) for point in newpoints ], point_count, deleted_points
 
 
 # http://stackoverflow.com/questions/3410976/how-to-round-a-number-to-significant-figures-in-python
@@ -142,10 +188,278 @@ def mmqgis_round(number, digits):
 	else:
 		return round(number, digits - int(floor(log10(abs(number)))) - 1)
 
+# Bounding box as an (xmin, ymin, xmax, ymax) tuple for mmqgis_spatial_grid
+
+def mmqgis_bounding_box(geometry):
+	box = geometry.boundingBox()
+	return (box.xMinimum(), box.yMinimum(), box.xMaximum(), box.yMaximum())
+
+# Canonical form of a closed ring as a tuple of (x, y) without the closing
+# vertex, starting at the lowest vertex and running in whichever direction
+# gives the lower sequence, so the same ring always has the same form
+
+def mmqgis_canonical_ring(ring):
+	if (len(ring) > 1) and (ring[0] == ring[-1]):
+		ring = ring[0:-1]
+	if len(ring) <= 0:
+		return ()
+
+	lowest = min(ring)
+	count = len(ring)
+	canonical = None
+	for start in range(count):
+		if ring[start] == lowest:
+			forward = tuple(ring[(start + x) % count] for x in range(count))
+			backward = tuple(ring[(start - x) % count] for x in range(count))
+			canonical = min([ value for value in [canonical, forward, backward] if value != None ])
+
+	return canonical
+
+# Geometry as (wkb type, parts) with each part a tuple of rings (or lines)
+# and each ring a tuple of (x, y). Polygon rings are canonicalized.
+
+def mmqgis_geometry_parts(geometry):
+	wkbtype = geometry.wkbType()
+	if (wkbtype == QGis.WKBPoint) or (wkbtype == QGis.WKBPoint25D):
+		parts = [ [ [ geometry.asPoint() ] ] ]
+	elif (wkbtype == QGis.WKBMultiPoint) or (wkbtype == QGis.WKBMultiPoint25D):
+		parts = [ [ [ point ] ] for point in geometry.asMultiPoint() ]
+	elif (wkbtype == QGis.WKBLineString) or (wkbtype == QGis.WKBLineString25D):
+		parts = [ [ geometry.asPolyline() ] ]
+	elif (wkbtype == QGis.WKBMultiLineString) or (wkbtype == QGis.WKBMultiLineString25D):
+		parts = [ [ line ] for line in geometry.asMultiPolyline() ]
+	elif (wkbtype == QGis.WKBPolygon) or (wkbtype == QGis.WKBPolygon25D):
+		parts = [ geometry.asPolygon() ]
+	elif (wkbtype == QGis.WKBMultiPolygon) or (wkbtype == QGis.WKBMultiPolygon25D):
+		parts = geometry.asMultiPolygon()
+	else:
+		return wkbtype, None
+
+	polygon = (wkbtype in [QGis.WKBPolygon, QGis.WKBPolygon25D, QGis.WKBMultiPolygon, QGis.WKBMultiPolygon25D])
+	canonical = []
+	for part in parts:
+		rings = []
+		for ring in part:
+			ring = [ (point.x(), point.y()) for point in ring ]
+			if polygon:
+				rings.append(mmqgis_canonical_ring(ring))
+			else:
+				rings.append(tuple(ring))
+		canonical.append(tuple(rings))
+
+	return wkbtype, tuple(canonical)
+
+# Fixed size digest of the packed binary canonical geometry for hashing.
+# Geometry types without a canonical form fall back to their WKT.
+
+def mmqgis_geometry_digest(geometry):
+	if geometry == None:
+		return hashlib.sha1("").digest()
+
+	wkbtype, parts = mmqgis_geometry_parts(geometry)
+	if parts == None:
+		return hashlib.sha1(geometry.exportToWkt()).digest()
+
+	digest = hashlib.sha1(struct.pack("<II", wkbtype & 0xffffffff, len(parts)))
+	for part in parts:
+		digest.update(struct.pack("<I", len(part)))
+		for ring in part:
+			digest.update(struct.pack("<I%dd" % (len(ring) * 2), len(ring), *itertools.chain(*ring)))
+
+	return digest.digest()
+
+# Distance from x, y to the segment x1, y1 - x2, y2
+
+def mmqgis_point_segment_distance(x, y, x1, y1, x2, y2):
+	dx = x2 - x1
+	dy = y2 - y1
+	length = (dx * dx) + (dy * dy)
+	if length > 0:
+		position = max(0.0, min(1.0, (((x - x1) * dx) + ((y - y1) * dy)) / length))
+		x1 = x1 + (position * dx)
+		y1 = y1 + (position * dy)
+
+	return sqrt(((x - x1) * (x - x1)) + ((y - y1) * (y - y1)))
+
+# Vertices and segments of mmqgis_geometry_parts() for mmqgis_hausdorff_distance().
+# Canonical polygon rings have no closing vertex, so the closing segment is added.
+
+def mmqgis_geometry_segments(wkbtype, parts):
+	polygon = (wkbtype in [QGis.WKBPolygon, QGis.WKBPolygon25D, QGis.WKBMultiPolygon, QGis.WKBMultiPolygon25D])
+	vertices = []
+	segments = []
+	for part in parts:
+		for ring in part:
+			vertices.extend(ring)
+			if len(ring) == 1:
+				segments.append(ring[0] + ring[0])
+			for z in range(1, len(ring)):
+				segments.append(ring[z - 1] + ring[z])
+			if polygon and (len(ring) > 2):
+				segments.append(ring[-1] + ring[0])
+
+	return vertices, segments
+
+# Distances from x, y to each of a list of segments
+
+def mmqgis_point_segments_distances(x, y, segments):
+	return [ mmqgis_point_segment_distance(x, y, *segment) for segment in segments ]
+
+# Hausdorff distance between the outlines of two geometries given as
+# mmqgis_geometry_parts(). Returns None if the types differ.
+#
+# Along a segment, the distance to each segment of the other outline is convex,
+# so between points p and q it is no more than the larger of its values at p and q.
+# The distance to the other outline is the least of those, and is also 1-Lipschitz,
+# so no point between p and q is farther than the lesser of those two bounds.
+# Segments are split at their midpoints until the bound is within precision of the
+# farthest distance found, so the result is no more than precision below the exact
+# Hausdorff distance.
+
+def mmqgis_hausdorff_distance(geometry1, geometry2, precision):
+	if (geometry1[0] != geometry2[0]) or (geometry1[1] == None) or (geometry2[1] == None):
+		return None
+
+	vertices1, segments1 = mmqgis_geometry_segments(geometry1[0], geometry1[1])
+	vertices2, segments2 = mmqgis_geometry_segments(geometry2[0], geometry2[1])
+	if (len(segments1) <= 0) or (len(segments2) <= 0):
+		return None
+
+	distance = 0
+	for segments, others in [ (segments1, segments2), (segments2, segments1) ]:
+		pending = []
+		for x1, y1, x2, y2 in segments:
+			d1 = mmqgis_point_segments_distances(x1, y1, others)
+			d2 = mmqgis_point_segments_distances(x2, y2, others)
+			distance = max(distance, min(d1), min(d2))
+			pending.append((x1, y1, d1, x2, y2, d2))
+
+		while len(pending) > 0:
+			x1, y1, d1, x2, y2, d2 = pending.pop()
+			length = sqrt(((x2 - x1) * (x2 - x1)) + ((y2 - y1) * (y2 - y1)))
+			bound = min(min(map(max, d1, d2)), (min(d1) + min(d2) + length) / 2)
+			if bound <= (distance + precision):
+				continue
+
+			x = (x1 + x2) / 2.0
+			y = (y1 + y2) / 2.0
+			d = mmqgis_point_segments_distances(x, y, others)
+			distance = max(distance, min(d))
+			pending.append((x1, y1, d1, x, y, d))
+			pending.append((x, y, d, x2, y2, d2))
+
+	return distance
+
+# Grid cell of each bounding box edge snapped to the tolerance grid, as in
+# mmqgis_gridify_points(). Geometries within the tolerance of each other
+# have snapped edges no more than one cell apart.
+
+def mmqgis_tolerance_bucket(parts, tolerance):
+	vertices = [ vertex for part in parts for ring in part for vertex in ring ]
+	if len(vertices) <= 0:
+		return None
+
+	x = [ vertex[0] for vertex in vertices ]
+	y = [ vertex[1] for vertex in vertices ]
+	return tuple([ int(round(edge / tolerance, 0)) for edge in [ min(x), min(y), max(x), max(y) ] ])
+
+# Sort-merge join of layer features to CSV rows for CSV files too large to
+# hold in memory. feature_keys are (key, feature index) and row_keys are
+# (key, row index, row), both in any order. With first_match_only, each row
+# only joins the lowest numbered feature with its key. The four sorts below
+# share memory_rows, so at most memory_rows records are held in memory at once,
+# plus the feature indices for the one key being merged.
+#
+# Returns two mmqgis_external_sorter, matches as (feature index, row index, row)
+# and unmatched rows as (row index, row), plus the count of CSV rows
+
+def mmqgis_merge_join(feature_keys, row_keys, memory_rows, first_match_only = False):
+	sort_rows = 0
+	if memory_rows > 0:
+		sort_rows = max(1, memory_rows / 4)
+
+	features = mmqgis_external_sorter(sort_rows)
+	for record in feature_keys:
+		features.add(record)
+
+	rows = mmqgis_external_sorter(sort_rows)
+	for record in row_keys:
+		rows.add(record)
+
+	matches = mmqgis_external_sorter(sort_rows)
+	notfound = mmqgis_external_sorter(sort_rows)
+
+	feature_groups = itertools.groupby(features.sorted(), operator.itemgetter(0))
+	feature_key, feature_group = next(feature_groups, (None, None))
+
+	for key, row_group in itertools.groupby(rows.sorted(), operator.itemgetter(0)):
+		# Skip features with keys not in the CSV file
+		while (feature_group != None) and (feature_key < key):
+			feature_key, feature_group = next(feature_groups, (None, None))
+
+		if (feature_group == None) or (feature_key != key):
+			for record in row_group:
+				notfound.add(record[1:])
+			continue
+
+		feature_indices = [ record[1] for record in feature_group ]
+		if first_match_only:
+			feature_indices = feature_indices[0:1]
+
+		for record in row_group:
+			for feature_index in feature_indices:
+				matches.add((feature_index, record[1], record[2]))
+
+	return matches, notfound, rows.count
+
+
+# Bounded memo cache with hit and miss counts.
+# When full, the least recently used entry is dropped
+
+class mmqgis_memo_cache:
+	def __init__(self, max_size):
+		self.max_size = max_size
+		self.entries = collections.OrderedDict()
+		self.hits = 0
+		self.misses = 0
+
+	def lookup(self, key):
+		# Returns (found, value)
+		if key in self.entries:
+			self.hits += 1
+			value = self.entries.pop(key)
+			self.entries[key] = value
+			return True, value
+
+		self.misses += 1
+		return False, None
+
+	def store(self, key, value):
+		if key in self.entries:
+			del self.entries[key]
+		elif len(self.entries) >= self.max_size:
+			self.entries.popitem(last = False)
+		self.entries[key] = value
+
+	def clear(self):
+		self.entries.clear()
+		self.hits = 0
+		self.misses = 0
+
+mmqgis_searchable_streetname_cache = mmqgis_memo_cache(100000)
+mmqgis_normalize_address_cache = mmqgis_memo_cache(100000)
 
 # Use common address abbreviations to reduce naming discrepancies and improve hit ratio
 
 def mmqgis_searchable_streetname(name):
+	found, searchable = mmqgis_searchable_streetname_cache.lookup(name)
+	if not found:
+		searchable = mmqgis_searchable_streetname_uncached(name)
+		mmqgis_searchable_streetname_cache.store(name, searchable)
+
+	return searchable
+
+def mmqgis_searchable_streetname_uncached(name):
 	# print "searchable_name(" + str(name) + ")"
 	if not name:
 		return ""
@@ -186,6 +500,15 @@ def mmqgis_searchable_streetname(name):
 # Returns list: [number street unit]
 
 def mmqgis_normalize_address(address):
+	found, normalized = mmqgis_normalize_address_cache.lookup(address)
+	if not found:
+		normalized = mmqgis_normalize_address_uncached(address)
+		mmqgis_normalize_address_cache.store(address, normalized)
+
+	# Copied so callers cannot change the cached list
+	return list(normalized)
+
+def mmqgis_normalize_address_uncached(address):
 	if not address:
 		return [None, None, None]
 
@@ -329,26 +652,84 @@ def mmqgis_normalize_address(address):
 
 	return [number, street, unit]
 
-def mmqgis_geocode_address_google(address, apikey):
-	if apikey:
-		url = "https://maps.googleapis.com/maps/api/geocode/xml?sensor=false&address=" + address + "&key=" + apikey
-	else:
-		url = "http://maps.googleapis.com/maps/api/geocode/xml?sensor=false&address=" + address
+# Geocoding web service addresses and default requests per second.
+# Module variables so that geocoding can be pointed at a test server
+
+mmqgis_geocode_urls = {
+	"Google Maps": "https://maps.googleapis.com/maps/api/geocode/xml",
+	"OpenStreetMap / Nominatim": "http://nominatim.openstreetmap.org/search" }
+
+mmqgis_geocode_rates = {
+	"Google Maps": 2.0,
+	"OpenStreetMap / Nominatim": 1.0 }
+
+# Token bucket rate limiter shared by geocoding threads. Tokens refill
+# at rate per second up to burst, and each request takes one token
+
+class mmqgis_rate_limiter:
+	def __init__(self, rate, burst = 1):
+		self.rate = float(rate)
+		self.burst = float(burst)
+		self.tokens = self.burst
+		self.updated = time.time()
+		self.lock = threading.Lock()
+
+	def acquire(self):
+		while True:
+			with self.lock:
+				now = time.time()
+				self.tokens = min(self.burst, self.tokens + ((now - self.updated) * self.rate))
+				self.updated = now
+				if self.tokens >= 1:
+					self.tokens -= 1
+					return
+
+				wait = (1 - self.tokens) / self.rate
 
-	max_attempts = 5
+			time.sleep(wait)
+
+# Exponential backoff with jitter between retries of failed requests
+
+def mmqgis_geocode_backoff(attempt):
+	time.sleep(min(30.0, 2.0 ** (attempt - 1)) + random.uniform(0, 0.5))
+
+# Reads a URL, retrying failures with backoff. Each attempt waits for the rate limiter.
+# Content containing retry_text is retried the same way, sharing the same attempts,
+# and the last such content is returned for the caller to report.
+# Returns (content, None) or (None, error message)
+
+def mmqgis_geocode_fetch(url, host, limiter = None, max_attempts = 5, retry_text = None):
 	for attempt in range(1, max_attempts + 1):
+		if limiter:
+			limiter.acquire()
+
 		try:
-			xml = urllib2.urlopen(url).read()
-			break
+			content = urllib2.urlopen(url).read()
 
 		except Exception, e:
-			message = "Failure connecting to maps.googleapis.com: " + unicode(e)
+			message = "Failure connecting to " + host + ": " + unicode(e)
 			if (attempt >= max_attempts):
-				return message, None, None, None, None
+				return None, message
+
+			mmqgis_geocode_backoff(attempt)
+			continue
+
+		if retry_text and (content.find(retry_text) > 0) and (attempt < max_attempts):
+			mmqgis_geocode_backoff(attempt)
+			continue
+
+		return content, None
+
+def mmqgis_geocode_address_google(address, apikey, limiter = None):
+	url = mmqgis_geocode_urls["Google Maps"] + "?sensor=false&address=" + address
+	if apikey:
+		url = url + "&key=" + apikey
+
+	# Per-second quota errors clear after a pause
+	xml, message = mmqgis_geocode_fetch(url, "maps.googleapis.com", limiter, 5, 'OVER_QUERY_LIMIT')
+	if xml == None:
+		return message, None, None, None, None
 
-			# Wait a second and try again
-			time.sleep(1)
-		
 	if (xml.find('OVER_QUERY_LIMIT') > 0):
 		return "Exceeded Daily Google Limit", None, None, None, None
 
@@ -414,22 +795,12 @@ def mmqgis_geocode_address_google(address, apikey):
 	return x, y, addrtype, addrlocat, formatted_addr
 
 
-def mmqgis_geocode_address_osm(address):
-	url = "http://nominatim.openstreetmap.org/search?format=xml&q=" + address
-
-	max_attempts = 5
-	for attempt in range(1, max_attempts + 1):
-		try:
-			osm = urllib2.urlopen(url).read()
-			break
-
-		except Exception, e:
-			message = "Failure connecting to maps.googleapis.com: " + unicode(e)
-			if (attempt >= max_attempts):
-				return message, None, None, None, None
+def mmqgis_geocode_address_osm(address, limiter = None):
+	url = mmqgis_geocode_urls["OpenStreetMap / Nominatim"] + "?format=xml&q=" + address
 
-			# Wait a second and try again
-			time.sleep(1)
+	osm, message = mmqgis_geocode_fetch(url, "nominatim.openstreetmap.org", limiter)
+	if osm == None:
+		return message, None, None, None, None
 
 	# print(url)
 	# print(osm)
@@ -625,6 +996,83 @@ def mmqgis_endpoint(start, distance, degrees):
 	return QgsPoint(end_lon * 180 / pi, end_lat * 180 / pi)
 
 
+# NumPy versions of mmqgis_distance(), mmqgis_bearing() and mmqgis_endpoint()
+# that take arrays of WGS 84 long/lat coordinates rather than single points.
+# Arguments are broadcast against each other, so one start point can be
+# given with an array of end points (or one distance with many bearings)
+
+def mmqgis_distances(start_x, start_y, end_x, end_y):
+	radius = 6378137 # meters
+	flattening = 1/298.257223563
+
+	start_lon = numpy.asarray(start_x, dtype = float) * pi / 180
+	start_y = numpy.asarray(start_y, dtype = float) * pi / 180
+	start_lat = numpy.arctan2((1 - flattening) * numpy.sin(start_y), numpy.cos(start_y))
+	end_lon = numpy.asarray(end_x, dtype = float) * pi / 180
+	end_y = numpy.asarray(end_y, dtype = float) * pi / 180
+	end_lat = numpy.arctan2((1 - flattening) * numpy.sin(end_y), numpy.cos(end_y))
+
+	arc_distance = (numpy.sin((end_lat - start_lat) / 2) ** 2) + \
+		(numpy.cos(start_lat) * numpy.cos(end_lat) * (numpy.sin((end_lon - start_lon) / 2) ** 2))
+
+	return 2 * radius * numpy.arctan2(numpy.sqrt(arc_distance), numpy.sqrt(1 - arc_distance))
+
+def mmqgis_bearings(start_x, start_y, end_x, end_y):
+	start_lon = numpy.asarray(start_x, dtype = float) * pi / 180
+	start_lat = numpy.asarray(start_y, dtype = float) * pi / 180
+	end_lon = numpy.asarray(end_x, dtype = float) * pi / 180
+	end_lat = numpy.asarray(end_y, dtype = float) * pi / 180
+
+	return numpy.arctan2(numpy.sin(end_lon - start_lon) * numpy.cos(end_lat), \
+		(numpy.cos(start_lat) * numpy.sin(end_lat)) - \
+		(numpy.sin(start_lat) * numpy.cos(end_lat) * numpy.cos(end_lon - start_lon))) \
+		* 180 / pi
+
+def mmqgis_endpoints(start_x, start_y, distance, degrees):
+	# Returns (x, y) arrays of end points
+	radius = 6378137.0 # meters
+
+	start_lon = numpy.asarray(start_x, dtype = float) * pi / 180
+	start_lat = numpy.asarray(start_y, dtype = float) * pi / 180
+	bearing = numpy.asarray(degrees, dtype = float) * pi / 180
+	arc = numpy.asarray(distance, dtype = float) / radius
+
+	end_lat = numpy.arcsin((numpy.sin(start_lat) * numpy.cos(arc)) +
+		(numpy.cos(start_lat) * numpy.sin(arc) * numpy.cos(bearing)))
+	end_lon = start_lon + numpy.arctan2( \
+		numpy.sin(bearing) * numpy.sin(arc) * numpy.cos(start_lat),
+		numpy.cos(arc) - (numpy.sin(start_lat) * numpy.sin(end_lat)))
+
+	return end_lon * 180 / pi, end_lat * 180 / pi
+
+
+# Little-endian WKB for an array of geometries that all have the same number of
+# vertices (points, lines or single ring polygons), packed for all geometries at once.
+# vertices is a NumPy array shaped (geometry count, vertex count, 2)
+
+def mmqgis_wkb_array(wkbtype, vertices):
+	count, points = vertices.shape[0:2]
+
+	header = [("order", "u1"), ("type", "<u4")]
+	if wkbtype == QGis.WKBPolygon:
+		header.append(("rings", "<u4"))
+	if wkbtype != QGis.WKBPoint:
+		header.append(("points", "<u4"))
+
+	records = numpy.zeros(count, numpy.dtype(header + [("xy", "<f8", (points, 2))]))
+	records["order"] = 1
+	records["type"] = wkbtype
+	if wkbtype == QGis.WKBPolygon:
+		records["rings"] = 1
+	if wkbtype != QGis.WKBPoint:
+		records["points"] = points
+	records["xy"] = vertices
+
+	data = records.tostring()
+	size = records.dtype.itemsize
+	return [ data[offset:offset + size] for offset in range(0, count * size, size) ]
+
+
 def mmqgis_feet_to_meters(feet):
 	return feet / 3.2808399
 
@@ -644,45 +1092,73 @@ def mmqgis_meters_to_miles(meters):
 #ufl = QgsPoint(-88.209445, 40.111328)
 
 
+# Reusable CRS and transform objects. Parsing a proj4 string and building a
+# transform is expensive relative to buffering one feature, so both are
+# kept in bounded caches keyed by proj4 string / EPSG authority id
+
+mmqgis_wgs84_proj4 = "+proj=longlat +datum=WGS84 +no_defs"
+
+# World Equidistant Conic used for meter buffers around geometries.
+# For some reason, Azimuthal Equidistant transformation noticed to not be
+# working on 10 July 2014. World Equidistant Conic works, but there may be errors.
+mmqgis_equidistant_proj4 = "+proj=eqdc +lat_0=0 +lon_0=0 +lat_1=60 +lat_2=60 " + \
+	"+x_0=0 +y_0=0 +ellps=WGS84 +datum=WGS84 +units=m +no_defs"
+
+mmqgis_crs_cache = mmqgis_memo_cache(64)
+mmqgis_transform_cache = mmqgis_memo_cache(64)
+
+def mmqgis_crs_key(crs):
+	# CRS objects are keyed by EPSG (or other authority) id when available
+	if isinstance(crs, basestring):
+		return crs
+
+	if crs.authid():
+		return unicode(crs.authid())
+
+	return unicode(crs.toProj4())
+
+def mmqgis_crs(definition):
+	# definition is a proj4 string ("+proj=..."), an authority id
+	# ("EPSG:4326") or an existing QgsCoordinateReferenceSystem
+	if not isinstance(definition, basestring):
+		return definition
+
+	found, crs = mmqgis_crs_cache.lookup(definition)
+	if not found:
+		crs = QgsCoordinateReferenceSystem()
+		if definition.startswith("+"):
+			crs.createFromProj4(definition)
+		else:
+			crs.createFromString(definition)
+		mmqgis_crs_cache.store(definition, crs)
+
+	return crs
+
+def mmqgis_transform(source, destination):
+	key = (mmqgis_crs_key(source), mmqgis_crs_key(destination))
+	found, transform = mmqgis_transform_cache.lookup(key)
+	if not found:
+		transform = QgsCoordinateTransform(mmqgis_crs(source), mmqgis_crs(destination))
+		mmqgis_transform_cache.store(key, transform)
+
+	return transform
+
+
 def mmqgis_buffer_geometry(geometry, meters):
 	if meters <= 0:
 		return None
 
 	# To approximate meaningful meter distances independent of the original CRS,
-	# the geometry is transformed to an azimuthal equidistant projection
-	# with the center of the polygon as the origin. After buffer creation,
-	# the buffer is transformed to WGS 84 and returned. While this may introduce
+	# the geometry is transformed to an equidistant projection,
+	# buffered, and then transformed back to WGS 84 and returned. While this may introduce
 	# some deviation from the original CRS, buffering is assumed in practice
 	# to be a fairly inexact operation that can tolerate such deviation
 
-	wgs84 = QgsCoordinateReferenceSystem()
-	wgs84.createFromProj4("+proj=longlat +datum=WGS84 +no_defs")
-
-	latitude = str(geometry.centroid().asPoint().y())
-	longitude = str(geometry.centroid().asPoint().x())
-
-	#proj4 = "+proj=aeqd +lat_0=" + str(geometry.centroid().asPoint().y()) + \
-	#	" +lon_0=" + str(geometry.centroid().asPoint().x()) + \
-	#	" +x_0=0 +y_0=0 +datum=WGS84 +units=m +no_defs"
-
-	# For some reason, Azimuthal Equidistant transformation noticed to not be
-	# working on 10 July 2014. World Equidistant Conic works, but there may be errors.
-	proj4 = "+proj=eqdc +lat_0=0 +lon_0=0 +lat_1=60 +lat_2=60 " + \
-		"+x_0=0 +y_0=0 +ellps=WGS84 +datum=WGS84 +units=m +no_defs"
-
-	azimuthal_equidistant = QgsCoordinateReferenceSystem()
-	azimuthal_equidistant.createFromProj4(proj4)
-	
-	transform = QgsCoordinateTransform(wgs84, azimuthal_equidistant)
-	geometry.transform(transform)
+	geometry.transform(mmqgis_transform(mmqgis_wgs84_proj4, mmqgis_equidistant_proj4))
 
 	newgeometry = geometry.buffer(meters, 7)
 
-	wgs84 = QgsCoordinateReferenceSystem()
-	wgs84.createFromProj4("+proj=longlat +datum=WGS84 +no_defs")
-
-	transform = QgsCoordinateTransform(azimuthal_equidistant, wgs84)
-	newgeometry.transform(transform)
+	newgeometry.transform(mmqgis_transform(mmqgis_equidistant_proj4, mmqgis_wgs84_proj4))
 
 	return newgeometry
 
@@ -695,17 +1171,20 @@ def mmqgis_buffer_point(point, meters, edges, rotation_degrees):
 	# edges can be supplied for non-circular buffers that are not supported
 	# by the QgsGeometry.buffer() function
 
-	wgs84 = QgsCoordinateReferenceSystem()
-	wgs84.createFromProj4("+proj=longlat +datum=WGS84 +no_defs")
-
 	# print "Point " + unicode(point.x()) + ", " + unicode(point.y()) + " meters " + unicode(meters)
 
-	polyline = []
-	for edge in range(0, edges + 1):
-		degrees = ((float(edge) * 360.0 / float(edges)) + rotation_degrees) % 360
-		polyline.append(mmqgis_endpoint(point, meters, degrees))
+	if numpy == None:
+		polyline = []
+		for edge in range(0, edges + 1):
+			degrees = ((float(edge) * 360.0 / float(edges)) + rotation_degrees) % 360
+			polyline.append(mmqgis_endpoint(point, meters, degrees))
 
-	return QgsGeometry.fromPolygon([polyline])
+		return QgsGeometry.fromPolygon([polyline])
+
+	degrees = numpy.mod((numpy.arange(edges + 1) * 360.0 / float(edges)) + rotation_degrees, 360)
+	x, y = mmqgis_endpoints(point.x(), point.y(), meters, degrees)
+
+	return QgsGeometry.fromPolygon([[ QgsPoint(x, y) for x, y in zip(x.tolist(), y.tolist()) ]])
 
 
 def mmqgis_buffer_line_side(geometry, width, direction):
@@ -766,10 +1245,18 @@ def mmqgis_buffer_line_side(geometry, width, direction):
 		else:
 			bearing = -90 # Left
 
+	# Segment bearings
+	if numpy == None:
+		bearings = [ mmqgis_bearing(points[z], points[z + 1]) for z in range(0, len(points) - 1) ]
+	else:
+		x = [ point.x() for point in points ]
+		y = [ point.y() for point in points ]
+		bearings = mmqgis_bearings(x[0:-1], y[0:-1], x[1:], y[1:]).tolist()
+
 	# Buffer individual segments
 	polygon = None
 	for z in range(0, len(points) - 1):
-		b1 = mmqgis_bearing(points[z], points[z + 1]) % 360
+		b1 = bearings[z] % 360
 
 		# Form rectangle beside line 
 		# 2% offset mitigates topology floating-point errors
@@ -782,7 +1269,7 @@ def mmqgis_buffer_line_side(geometry, width, direction):
 
 		# Determine if rounded convex elbow is needed
 		if (z < (len(points) - 2)):
-			b2 = mmqgis_bearing(points[z + 1], points[z + 2]) % 360
+			b2 = bearings[z + 1] % 360
 			elbow = b2 - b1
 			if (elbow < -180):
 				elbow = elbow + 360
@@ -912,7 +1399,10 @@ def mmqgis_line_center(geometry, distance_percent):
 #	with vector shapes using fuzzy address match
 # --------------------------------------------------------
 
-def mmqgis_street_address_join(qgis, shapelayer, shapeaddress, csvname, csvaddress, outfilename, notfoundname, addlayer):
+# memory_rows > 0 streams CSV files too large for memory through a
+# sort-merge join holding at most about that many rows in memory
+
+def mmqgis_street_address_join(qgis, shapelayer, shapeaddress, csvname, csvaddress, outfilename, notfoundname, addlayer, memory_rows = 0):
 
 	# Find the layer of shapes
 	layer = mmqgis_find_layer(shapelayer)
@@ -934,9 +1424,13 @@ def mmqgis_street_address_join(qgis, shapelayer, shapeaddress, csvname, csvaddre
 		dialect = csv.Sniffer().sniff(infile.read(4096))
 		infile.seek(0)
 		reader = csv.reader(infile, dialect)
-		addresses = list(reader)
-		del reader
-		del infile
+		if memory_rows > 0:
+			# Only the header is read here and the rows are streamed
+			addresses = [ reader.next() ]
+		else:
+			addresses = list(reader)
+			del reader
+			del infile
 
 	except Exception as e:
 		return unicode(csvname) + ": " + unicode(e)
@@ -996,6 +1490,41 @@ def mmqgis_street_address_join(qgis, shapelayer, shapeaddress, csvname, csvaddre
 		return "Failure creating output shapefile: " + unicode(outfile.errorMessage())
 
 
+	csv_count = len(addresses)
+	if memory_rows > 0:
+		# Sort the normalized CSV and shape addresses to temporary files and merge them
+		mmqgis_status_message(qgis, "Sorting addresses")
+
+		request = QgsFeatureRequest()
+		request.setFlags(QgsFeatureRequest.NoGeometry)
+		request.setSubsetOfAttributes([ layer_index ])
+
+		try:
+			matches, notfound_rows, csv_count = mmqgis_merge_join( \
+				mmqgis_street_address_keys(layer.getFeatures(request), layer_index), \
+				mmqgis_street_address_rows(reader, csvindex), memory_rows, True)
+		except ValueError as e:
+			return unicode(e)
+
+		matches = matches.sorted()
+		match = next(matches, None)
+
+	else:
+		# Normalize each CSV address once into a (number, street) hash index
+		mmqgis_status_message(qgis, "Indexing addresses")
+
+		address_index = {}
+		for row_index, row in enumerate(addresses):
+			file_address = mmqgis_normalize_address(row[csvindex])
+			if not file_address[1]:
+				continue
+
+			key = (file_address[0], file_address[1])
+			if key in address_index:
+				address_index[key].append(row_index)
+			else:
+				address_index[key] = [ row_index ]
+
 	# Iterate through each feature in the shape layer
 	matched_count = 0
 	feature_count = layer.featureCount()
@@ -1009,18 +1538,25 @@ def mmqgis_street_address_join(qgis, shapelayer, shapeaddress, csvname, csvaddre
 		# print "Searching street " + unicode(feature_index) + " of " + unicode(feature_count)
 
 		shape_attributes = feature.attributes()
+
+		if memory_rows > 0:
+			while (match != None) and (match[0] == feature_index):
+				newfeature = QgsFeature()
+				newfeature.setAttributes(shape_attributes + match[2])
+				newfeature.setGeometry(feature.geometry())
+				outfile.addFeature(newfeature)
+				matched_count += 1
+				match = next(matches, None)
+			continue
+
 		feature_address = mmqgis_normalize_address(unicode(shape_attributes[layer_index]))
 		if not feature_address[1]:
 			continue
 
-		# Check each file address against this feature
-		for row_index, row in enumerate(addresses):
-
-			# Check to see if file address matches feature address
-			file_address = mmqgis_normalize_address(row[csvindex])
-
-			if (feature_address[0] != file_address[0]) or (feature_address[1] != file_address[1]):
-				continue
+		# File addresses matching this feature are removed from the
+		# index so they only join the first matching feature
+		for row_index in address_index.pop((feature_address[0], feature_address[1]), []):
+			row = addresses[row_index]
 
 			# print "Feature: " + unicode(shape_attributes[layer_index])
 			# print "   Row: " + unicode(row[csvindex]) + " (" + unicode(csvindex) + ")"
@@ -1038,6 +1574,9 @@ def mmqgis_street_address_join(qgis, shapelayer, shapeaddress, csvname, csvaddre
 
 	del outfile
 
+	if memory_rows > 0:
+		addresses = (row for row_index, row in notfound_rows.sorted())
+
 	# Write unjoined addresses to notfound file
 	for index, row in enumerate(addresses):
 		if row[csvindex] > "":
@@ -1049,22 +1588,284 @@ def mmqgis_street_address_join(qgis, shapelayer, shapeaddress, csvname, csvaddre
 	if matched_count and addlayer:
 		vlayer = qgis.addVectorLayer(outfilename, os.path.basename(outfilename), "ogr")
 		
-	mmqgis_completion_message(qgis, unicode(matched_count) + " of " + unicode(len(addresses)) \
+	mmqgis_completion_message(qgis, unicode(matched_count) + " of " + unicode(csv_count) \
 		+ " addresses geocoded from " + unicode(feature_count) + " street records")
 
 	return None
 
+# Normalized (number, street) keys for the streaming mmqgis_street_address_join
+
+def mmqgis_street_address_keys(features, address_index):
+	for feature_index, feature in enumerate(features):
+		address = mmqgis_normalize_address(unicode(feature.attributes()[address_index]))
+		if address[1]:
+			yield ((address[0], address[1]), feature_index)
+
+def mmqgis_street_address_rows(reader, address_index):
+	for row_index, row in enumerate(reader):
+		try:
+			row = [unicode(field, "utf-8") for field in row]
+		except:
+			raise ValueError("Row " + unicode(row_index + 1) + " in CSV file not in UTF-8 encoding")
+
+		address = mmqgis_normalize_address(row[address_index])
+		yield ((address[0], address[1]), row_index, row)
+
+# --------------------------------------------------------
+#    mmqgis_animation_renderer - Offscreen frame rendering
+#		for the mmqgis_animate functions
+# --------------------------------------------------------
+
+# Memory layer geometry types for mmqgis_animation_layer()
+
+mmqgis_memory_geometry_types = {
+	QGis.WKBPoint: "Point", QGis.WKBPoint25D: "Point",
+	QGis.WKBLineString: "LineString", QGis.WKBLineString25D: "LineString",
+	QGis.WKBPolygon: "Polygon", QGis.WKBPolygon25D: "Polygon",
+	QGis.WKBMultiPoint: "MultiPoint", QGis.WKBMultiPoint25D: "MultiPoint",
+	QGis.WKBMultiLineString: "MultiLineString", QGis.WKBMultiLineString25D: "MultiLineString",
+	QGis.WKBMultiPolygon: "MultiPolygon", QGis.WKBMultiPolygon25D: "MultiPolygon" }
+
+# In-memory copy of a layer's fields, features and style. Returns the
+# copy and a dict of copied feature ids keyed by original feature id.
+# With copy_features False the copy starts out empty.
+
+def mmqgis_animation_layer(layer, copy_features = True):
+	geometry_type = mmqgis_memory_geometry_types.get(layer.wkbType(), "None")
+	copy = QgsVectorLayer(geometry_type + "?crs=" + unicode(layer.crs().authid()), \
+		layer.name(), "memory")
+	copy.setCrs(layer.crs())
+	copy.dataProvider().addAttributes(layer.fields().toList())
+	copy.updateFields()
+
+	copy.setRendererV2(layer.rendererV2().clone())
+	copy.setBlendMode(layer.blendMode())
+	copy.setLayerTransparency(layer.layerTransparency())
+	for key in layer.customPropertyKeys():
+		copy.setCustomProperty(key, layer.customProperty(key))
+
+	if not copy_features:
+		return copy, {}
+
+	original_ids = []
+	features = []
+	for feature in layer.getFeatures():
+		original_ids.append(feature.id())
+		features.append(QgsFeature(feature))
+
+	result, features = copy.dataProvider().addFeatures(features)
+	ids = dict(zip(original_ids, [ feature.id() for feature in features ]))
+
+	return copy, ids
+
+# World file for a map image as written by QgsMapCanvas.saveAsImage()
+# (.pgw for .png) locating the center of the top left pixel
+
+def mmqgis_write_world_file(settings, imagefile):
+	def number(value):
+		return ("%.17f" % value).rstrip("0").rstrip(".")
+
+	base, suffix = os.path.splitext(imagefile)
+	if len(suffix) < 3:
+		return
+
+	pixel = settings.mapUnitsPerPixel()
+	extent = settings.visibleExtent()
+
+	worldfile = open(base + suffix[0:2] + suffix[-1] + "w", "wb")
+	worldfile.write(number(pixel) + "\r\n")
+	worldfile.write("0 \r\n")
+	worldfile.write("0 \r\n")
+	worldfile.write("-" + number(pixel) + "\r\n")
+	worldfile.write(number(extent.xMinimum() + (pixel / 2)) + "\r\n")
+	worldfile.write(number(extent.yMaximum() - (pixel / 2)) + "\r\n")
+	worldfile.close()
+
+# True if a map layer draws labels or diagrams
+
+def mmqgis_layer_labeled(layer):
+	if (layer == None) or (layer.type() != QgsMapLayer.VectorLayer):
+		return False
+
+	if layer.customProperty("labeling/enabled", False) in [ True, "true" ]:
+		return True
+
+	if layer.hasLabelsEnabled():
+		return True
+
+	return layer.diagramRenderer() != None
+
+# Renders animation frames offscreen with the canvas map settings, replacing the
+# animated layers with in-memory copies. Each slot has its own copies so frames
+# can be prepared in one slot while frames in other slots are still rendering.
+# A frame's image is written when its slot is next used or the renderer closes.
+#
+# Layers drawn below all the animated layers never change, so they are rendered
+# once into a cached background. Each frame then only renders the animated layers
+# and any layers above them onto a transparent overlay that is composited onto
+# the background. Layers in the overlay with blend modes other than normal
+# need the layers below them, and labels must be placed together so they
+# avoid each other and draw above all features, so frames are rendered in full
+# when there are such blend modes or any layer is labeled.
+#
+# timings has (frame file, prepare, render, write) seconds for each frame,
+# with prepare timed from slot() so it includes building the frame's features.
+
+class mmqgis_animation_renderer:
+	def __init__(self, qgis, layers, slots = 2, copy_features = True, cache_background = True):
+		self.settings = qgis.mapCanvas().mapSettings()
+		self.layer_ids = [ layer.id() for layer in layers ]
+		self.slots = []
+		self.timings = []
+
+		for slot in range(max(1, slots)):
+			copies = []
+			ids = []
+			for layer in layers:
+				copy, copy_ids = mmqgis_animation_layer(layer, copy_features)
+				QgsMapLayerRegistry.instance().addMapLayer(copy, False)
+				copies.append(copy)
+				ids.append(copy_ids)
+
+			self.slots.append({ "layers": copies, "ids": ids, "job": None, "framefile": None, \
+				"features": [ copy_ids.values() for copy_ids in ids ], "start": time.time() })
+
+		# Layer ids are listed top first
+		self.overlay_ids = self.settings.layers()
+		self.background = None
+		self.background_seconds = 0
+
+		animated = [ index for index, layer_id in enumerate(self.overlay_ids) if layer_id in self.layer_ids ]
+		if (not cache_background) or (len(animated) <= 0):
+			return
+
+		overlay_ids = self.overlay_ids[0:max(animated) + 1]
+		background_ids = self.overlay_ids[max(animated) + 1:]
+		if len(background_ids) <= 0:
+			return
+
+		for layer_id in overlay_ids:
+			layer = QgsMapLayerRegistry.instance().mapLayer(layer_id)
+			if (layer != None) and (layer.blendMode() != QPainter.CompositionMode_SourceOver):
+				return
+
+		for layer_id in self.overlay_ids:
+			if mmqgis_layer_labeled(QgsMapLayerRegistry.instance().mapLayer(layer_id)):
+				return
+
+		start = time.time()
+		settings = QgsMapSettings(self.settings)
+		settings.setLayers(background_ids)
+		job = QgsMapRendererParallelJob(settings)
+		job.start()
+		job.waitForFinished()
+
+		self.background = job.renderedImage()
+		self.background_seconds = time.time() - start
+		self.overlay_ids = overlay_ids
+
+	# Slot for a frame, once the slot's previous frame has been written
+
+	def slot(self, frame):
+		slot = frame % len(self.slots)
+		self.finish(slot)
+		self.slots[slot]["start"] = time.time()
+		return slot
+
+	def change_geometries(self, slot, layer_index, geometries):
+		ids = self.slots[slot]["ids"][layer_index]
+		changes = {}
+		for feature_id, geometry in geometries.iteritems():
+			changes[ids[feature_id]] = geometry
+
+		self.slots[slot]["layers"][layer_index].dataProvider().changeGeometryValues(changes)
+
+	# Replace all features in a slot's copy of a layer
+
+	def replace_features(self, slot, layer_index, features):
+		provider = self.slots[slot]["layers"][layer_index].dataProvider()
+		provider.deleteFeatures(self.slots[slot]["features"][layer_index])
+		result, features = provider.addFeatures([ QgsFeature(feature) for feature in features ])
+		self.slots[slot]["features"][layer_index] = [ feature.id() for feature in features ]
+
+	def render(self, slot, framefile):
+		layer_ids = []
+		for layer_id in self.overlay_ids:
+			if layer_id in self.layer_ids:
+				layer_id = self.slots[slot]["layers"][self.layer_ids.index(layer_id)].id()
+			layer_ids.append(layer_id)
+
+		settings = QgsMapSettings(self.settings)
+		settings.setLayers(layer_ids)
+		if self.background != None:
+			settings.setBackgroundColor(QColor(0, 0, 0, 0))
+
+		self.slots[slot]["prepare"] = time.time() - self.slots[slot]["start"]
+
+		job = QgsMapRendererParallelJob(settings)
+		job.start()
+		self.slots[slot]["job"] = job
+		self.slots[slot]["framefile"] = framefile
+
+	def finish(self, slot):
+		job = self.slots[slot]["job"]
+		if job == None:
+			return
+
+		job.waitForFinished()
+
+		start = time.time()
+		image = job.renderedImage()
+		if self.background != None:
+			overlay = image
+			image = QImage(self.background)
+			painter = QPainter(image)
+			painter.drawImage(0, 0, overlay)
+			painter.end()
+
+		image.save(self.slots[slot]["framefile"], "PNG")
+		mmqgis_write_world_file(self.settings, self.slots[slot]["framefile"])
+
+		self.timings.append((self.slots[slot]["framefile"], self.slots[slot]["prepare"], \
+			job.renderingTime() / 1000.0, time.time() - start))
+		self.slots[slot]["job"] = None
+
+	# Average frame timings as text for completion messages
+
+	def summary(self):
+		if len(self.timings) <= 0:
+			return "no frames rendered"
+
+		count = len(self.timings)
+		text = "%d frames, average %.0f ms prepare, %.0f ms render, %.0f ms write" % (count, \
+			1000 * sum([ timing[1] for timing in self.timings ]) / count, \
+			1000 * sum([ timing[2] for timing in self.timings ]) / count, \
+			1000 * sum([ timing[3] for timing in self.timings ]) / count)
+
+		if self.background != None:
+			text = text + ", static background rendered once in %.0f ms" % (1000 * self.background_seconds)
+
+		return text
+
+	def close(self):
+		for slot in range(len(self.slots)):
+			self.finish(slot)
+			for copy in self.slots[slot]["layers"]:
+				QgsMapLayerRegistry.instance().removeMapLayer(copy.id())
+
+		self.slots = []
+
 # --------------------------------------------------------
 #    mmqgis_animate_columns - Create animations by
 #		interpolating offsets from attributes
 # --------------------------------------------------------
 
-def mmqgis_animate_columns(qgis, layer_name, long_col, lat_col, outdir, frame_count):
+def mmqgis_animate_columns(qgis, layer_name, long_col, lat_col, outdir, frame_count, renderers = 2):
 
 	# Error Checks
 	layer = mmqgis_find_layer(layer_name)
 	if layer == None:
-		return "Invalid map layer ID: " + unicode(map_layer_id)
+		return "Invalid map layer: " + unicode(layer_name)
 
 	long_col_index = layer.fieldNameIndex(long_col)
 	if (long_col_index < 0):
@@ -1082,10 +1883,14 @@ def mmqgis_animate_columns(qgis, layer_name, long_col, lat_col, outdir, frame_co
 
 	# Find differential change with each frame
 	feature_id = []
+	geometries = []
 	xdifferential = []
 	ydifferential = []
 
 	for feature in layer.getFeatures():
+		if feature.geometry() == None:
+			continue
+
 		attributes = feature.attributes()
 		try:
 			xtotal = float(attributes[long_col_index])
@@ -1095,42 +1900,65 @@ def mmqgis_animate_columns(qgis, layer_name, long_col, lat_col, outdir, frame_co
 			ytotal = 0
 
 		feature_id.append(feature.id())
+		geometries.append(QgsGeometry(feature.geometry()))
 		xdifferential.append(xtotal / frame_count)
 		ydifferential.append(ytotal / frame_count)
 
-	# for feature in range(0, len(xdifferential)):
-	#	print "Differentials: " + unicode(xdifferential[feature]) + ", " + unicode(ydifferential[feature])
+	# Single points have their coordinates for each frame computed
+	# as arrays and packed to WKB for all features at once
+	points = False
+	if numpy != None:
+		xdifferential = numpy.array(xdifferential)
+		ydifferential = numpy.array(ydifferential)
+
+		points = (len(geometries) > 0) and \
+			all([ geometry.wkbType() == QGis.WKBPoint for geometry in geometries ])
+		if points:
+			vertices = numpy.empty((len(geometries), 1, 2))
+			xorigin = numpy.array([ geometry.asPoint().x() for geometry in geometries ])
+			yorigin = numpy.array([ geometry.asPoint().y() for geometry in geometries ])
 
-	# Iterate Frames
+	# Iterate Frames: offsets for all features are computed as arrays, the
+	# shifted geometries are written to an in-memory copy of the layer and
+	# the frame renders offscreen while the next frame is prepared
+
+	renderer = mmqgis_animation_renderer(qgis, [layer], renderers)
 
 	for frame in range(frame_count + 1):
 		mmqgis_status_message(qgis, "Rendering frame " + unicode(frame))
 
-		# Shift shapes
-
-		layer.startEditing()
+		slot = renderer.slot(frame)
+		frame_geometries = {}
+		if points:
+			vertices[:, 0, 0] = xorigin + (xdifferential * frame)
+			vertices[:, 0, 1] = yorigin + (ydifferential * frame)
 
-		for feature_index, feature in enumerate(layer.getFeatures()):
-			geometry = QgsGeometry(feature.geometry())
-			geometry.translate(xdifferential[feature_index] * frame, 
-				ydifferential[feature_index] * frame)
-			# print unicode(geometry.asPoint().x()) + " - " + unicode(geometry.asPoint().y())
-			layer.changeGeometry(feature_id[feature_index], geometry)
+			for feature_index, wkb in enumerate(mmqgis_wkb_array(QGis.WKBPoint, vertices)):
+				geometry = QgsGeometry()
+				geometry.fromWkb(wkb)
+				frame_geometries[feature_id[feature_index]] = geometry
 
-		# Write Frame
+		else:
+			if numpy != None:
+				xoffset = (xdifferential * frame).tolist()
+				yoffset = (ydifferential * frame).tolist()
+			else:
+				xoffset = [ x * frame for x in xdifferential ]
+				yoffset = [ y * frame for y in ydifferential ]
 
-		# qgis.mapCanvas().refreshMap()
-		pixmap = QPixmap(qgis.mapCanvas().mapSettings().outputSize().width(), 
-			qgis.mapCanvas().mapSettings().outputSize().height())
+			# Shift shapes
+			for feature_index, geometry in enumerate(geometries):
+				geometry = QgsGeometry(geometry)
+				geometry.translate(xoffset[feature_index], yoffset[feature_index])
+				frame_geometries[feature_id[feature_index]] = geometry
 
-		framefile = outdir + "/frame" + format(frame, "06d") + ".png"
-		qgis.mapCanvas().saveAsImage(framefile, pixmap)
+		# Write Frame
+		renderer.change_geometries(slot, 0, frame_geometries)
+		renderer.render(slot, outdir + "/frame" + format(frame, "06d") + ".png")
 
-		# Clean up: Constantly starting and stopping editing is slow, 
-		# but leaving editing open and accumulating successive changes
-		# seems to be even slower (6/5/2014)
+	renderer.close()
 
-		layer.rollBack()
+	mmqgis_completion_message(qgis, "Rendered " + renderer.summary())
 
 	return None
 
@@ -1138,7 +1966,7 @@ def mmqgis_animate_columns(qgis, layer_name, long_col, lat_col, outdir, frame_co
 #    mmqgis_animate_lines
 # --------------------------------------------------------
 
-def mmqgis_animate_lines(qgis, layer_name, fixed_speed, frame_count, outdir):
+def mmqgis_animate_lines(qgis, layer_name, fixed_speed, frame_count, outdir, renderers = 2):
 
 	# Error Checks
 	layer = mmqgis_find_layer(layer_name)
@@ -1159,6 +1987,9 @@ def mmqgis_animate_lines(qgis, layer_name, fixed_speed, frame_count, outdir):
 	# Convert features to lists of points
 	points = []
 	length = []
+	segments = []
+	distances = []
+	feature_ids = []
 	for feature_index, feature in enumerate(layer.getFeatures()):
 
 		fpoints = []
@@ -1174,6 +2005,7 @@ def mmqgis_animate_lines(qgis, layer_name, fixed_speed, frame_count, outdir):
 			return "Invalid geometry type " + unicode(feature.geometry().wkbType())
 
 		points.append(fpoints)
+		feature_ids.append(feature.id())
 
 		# print unicode(feature_index) + " = " + unicode(len(points)) + \
 		#	" = " + unicode(feature.geometry().wkbType()) + " = " + unicode(type(points))
@@ -1188,17 +2020,32 @@ def mmqgis_animate_lines(qgis, layer_name, fixed_speed, frame_count, outdir):
 
 		length.append(flength)
 
+		# Segment lengths and the cumulative length at each vertex
+		# for finding the visible part of the line in each frame
+		fsegments = [0]
+		fdistances = [0]
+		for z in range(1, len(fpoints)):
+			segment_length = pow(pow(fpoints[z].x() - fpoints[z - 1].x(), 2) + \
+				pow(fpoints[z].y() - fpoints[z - 1].y(), 2), 0.5)
+			fsegments.append(segment_length)
+			fdistances.append(fdistances[-1] + segment_length)
+
+		segments.append(fsegments)
+		distances.append(fdistances)
+
 	max_length = max(length)
 
-	# Iterate Frames
+	# Iterate Frames: the last vertex short of the visible length is found by
+	# binary search on the cumulative lengths, and the frame renders offscreen
+	# while the next frame's lines are cut
+	renderer = mmqgis_animation_renderer(qgis, [layer], renderers)
+
 	for frame in range(frame_count + 1):
 		mmqgis_status_message(qgis, "Rendering frame " + unicode(frame))
 
-		layer.startEditing()
-
-		for feature_index, feature in enumerate(layer.getFeatures()):
-
-			fpoints = points[feature_index]
+		slot = renderer.slot(frame)
+		frame_geometries = {}
+		for feature_index, fpoints in enumerate(points):
 			if (len(fpoints) <= 0):
 				continue
 
@@ -1207,47 +2054,31 @@ def mmqgis_animate_lines(qgis, layer_name, fixed_speed, frame_count, outdir):
 			else:
 				visible_length = length[feature_index] * frame / frame_count
 
+			# Vertices before the first vertex at or past the visible length are shown
+			fdistances = distances[feature_index]
+			z = bisect.bisect_left(fdistances, visible_length)
+			visible = [fpoints[0], fpoints[0]] + fpoints[1:z]
 
-			total_length = 0
-			visible = [fpoints[0], fpoints[0]]
-			for z in range(1, len(fpoints)):
-				segment_length = pow(pow(fpoints[z].x() - fpoints[z - 1].x(), 2) + \
-					pow(fpoints[z].y() - fpoints[z - 1].y(), 2), 0.5)
-
-				# print "   " + unicode(total_length) + " + " + unicode(segment_length)
-
-				if (total_length >= visible_length):
-					break
-
-				elif (total_length + segment_length) <= visible_length:
+			# A vertex exactly at the visible length is shown, otherwise
+			# only part of the segment leading to it
+			if (z > 0) and (z < len(fpoints)):
+				if fdistances[z] == visible_length:
 					visible.append(fpoints[z])
-					total_length = total_length + segment_length
-
-				else: # only display part of line segment
-					fraction = (visible_length - total_length) / segment_length
+				else:
+					fraction = (visible_length - fdistances[z - 1]) / segments[feature_index][z]
 					x = fpoints[z - 1].x() + ((fpoints[z].x() - fpoints[z - 1].x()) * fraction)
 					y = fpoints[z - 1].y() + ((fpoints[z].y() - fpoints[z - 1].y()) * fraction)
 					visible.append(QgsPoint(x, y))
-					break
 
-			# print unicode(visible_length) + ", " + unicode(len(visible)) + ", " + \
-			#	unicode(total_length) + ", " + unicode(max_length)
-
-			layer.changeGeometry(feature.id(), QgsGeometry.fromPolyline(visible))
+			frame_geometries[feature_ids[feature_index]] = QgsGeometry.fromPolyline(visible)
 
 		# Write Frame
+		renderer.change_geometries(slot, 0, frame_geometries)
+		renderer.render(slot, outdir + "/frame" + format(frame, "06d") + ".png")
 
-		pixmap = QPixmap(qgis.mapCanvas().mapSettings().outputSize().width(), 
-			qgis.mapCanvas().mapSettings().outputSize().height())
-
-		framefile = outdir + "/frame" + format(frame, "06d") + ".png"
-		qgis.mapCanvas().saveAsImage(framefile, pixmap)
+	renderer.close()
 
-		# Clean up: Constantly starting and stopping editing is slow, 
-		# but leaving editing open and accumulating successive changes
-		# seems to be even slower
-
-		layer.rollBack()
+	mmqgis_completion_message(qgis, "Rendered " + renderer.summary())
 
 	return None
 
@@ -1257,7 +2088,7 @@ def mmqgis_animate_lines(qgis, layer_name, fixed_speed, frame_count, outdir):
 #		displaying successive rows
 # --------------------------------------------------------
 
-def mmqgis_animate_rows(qgis, layer_names, outdir):
+def mmqgis_animate_rows(qgis, layer_names, outdir, renderers = 2):
 
 	# Error Checks
 	if not os.path.isdir(outdir):
@@ -1279,55 +2110,56 @@ def mmqgis_animate_rows(qgis, layer_names, outdir):
 		return "At least one animated layer must have more than one feature"
 
 
-	# Lists of Feature IDs and fields used for subsetting
-
-	feature_ids = [None] * len(layers)
-	subset_fields = []
-	for index in range(len(layers)):
-		feature_ids[index] = layers[index].allFeatureIds()
+	# First attribute values in feature order and the features with
+	# each value, read in one scan of each layer. A frame shows the
+	# features with the same first attribute as the frame's row.
 
-		fields = layers[index].fields().toList()
-		if (len(fields) <= 0):
+	frame_values = []
+	value_features = []
+	for layer in layers:
+		if (len(layer.fields().toList()) <= 0):
 			return "Each layer must have at least one attribute"
-		subset_fields.append(fields[0].name())
 
+		values = []
+		features = {}
+		for feature in layer.getFeatures():
+			value = unicode(feature.attributes()[0])
+			values.append(value)
+			if value in features:
+				features[value].append(feature)
+			else:
+				features[value] = [feature]
 
-	# Iterate frames
+		frame_values.append(values)
+		value_features.append(features)
 
-	for frame in range(int(frame_count + 1)):
-		mmqgis_status_message(qgis, "Rendering frame " + unicode(frame))
 
-		for layer_index, layer in enumerate(layers):
-			if frame < len(feature_ids[layer_index]):
-				feature_id = feature_ids[layer_index][frame]
-				feature = list(layer.getFeatures(QgsFeatureRequest(feature_id)))[0]
-				attribute = feature.attributes()[0]
-				subset_string = subset_fields[layer_index] + " = '" + unicode(attribute) + "'"
-				# print unicode(layer_index) + ": " + subset_string
-				if (not layer.setSubsetString(subset_string)):
-					return "Failure subsetting layer: " + subset_string
+	# Iterate frames. Each renderer slot has empty copies of the layers
+	# that are filled with the frame's features when the value changes.
+	# Layers with fewer rows keep showing their last row.
 
-		# qgis.mapCanvas().refresh()
-		pixmap = QPixmap(qgis.mapCanvas().mapSettings().outputSize().width(), 
-			qgis.mapCanvas().mapSettings().outputSize().height())
+	renderer = mmqgis_animation_renderer(qgis, layers, renderers, False)
+	slot_values = [ [ None ] * len(layers) for slot in range(len(renderer.slots)) ]
 
-		framefile = outdir + "/frame" + format(frame, "06d") + ".png"
-		qgis.mapCanvas().saveAsImage(framefile, pixmap)
+	for frame in range(int(frame_count + 1)):
+		mmqgis_status_message(qgis, "Rendering frame " + unicode(frame))
 
-		# This is now too hard to do with subsetString
+		slot = renderer.slot(frame)
+		for layer_index in range(len(layers)):
+			values = frame_values[layer_index]
+			if len(values) <= 0:
+				continue
 
-		# if not cumulative:
-		#	for layer_index in range(len(layers)):
-		#		if frame < layers[layer_index].featureCount():
-		#			feature = QgsFeature()
-		#			featureid = feature_ids[layer_index][frame]
-		#			templayers[layer_index].dataProvider().deleteFeatures([featureid])
+			value = values[min(frame, len(values) - 1)]
+			if slot_values[slot][layer_index] != value:
+				renderer.replace_features(slot, layer_index, value_features[layer_index][value])
+				slot_values[slot][layer_index] = value
 
+		renderer.render(slot, outdir + "/frame" + format(frame, "06d") + ".png")
 
-	# Restore visibility to all features
+	renderer.close()
 
-	for layer in layers:
-		layer.setSubsetString("")
+	mmqgis_completion_message(qgis, "Rendered " + renderer.summary())
 
 	return None
 
@@ -1414,7 +2246,10 @@ def mmqgis_attribute_export(qgis, outfilename, layername, attribute_names, field
 #                            file to a shapefile
 # --------------------------------------------------------
 
-def mmqgis_attribute_join(qgis, layername, infilename, joinfield, targetfield, outfilename, notfoundname, addlayer):
+# memory_rows > 0 streams CSV files too large for memory through a
+# sort-merge join holding at most about that many rows in memory
+
+def mmqgis_attribute_join(qgis, layername, infilename, joinfield, targetfield, outfilename, notfoundname, addlayer, memory_rows = 0):
 	layer = mmqgis_find_layer(layername)
 	if layer == None:
 		return "Layer " + unicode(layername) + " not found"
@@ -1507,12 +2342,41 @@ def mmqgis_attribute_join(qgis, layername, infilename, joinfield, targetfield, o
 	if (outfile.hasError() != QgsVectorFileWriter.NoError):
 		return "Failure creating output shapefile: " + unicode(outfile.errorMessage())
 
-	# Read the CSV file data into memory
 	csv_data = []
 	csv_found = []
-	for row in reader:
-		csv_data.append(row)
-		csv_found.append(0)
+	csv_keys = {}
+	csv_count = 0
+
+	if memory_rows > 0:
+		# Sort the CSV rows and feature keys to temporary files and merge them
+		mmqgis_status_message(qgis, "Sorting join keys")
+
+		request = QgsFeatureRequest()
+		request.setFlags(QgsFeatureRequest.NoGeometry)
+		request.setSubsetOfAttributes([ target_index ])
+		feature_keys = ((unicode(feature.attributes()[target_index]).encode("utf-8").lower().strip(), \
+			feature_index) for feature_index, feature in enumerate(layer.getFeatures(request)))
+
+		row_keys = ((row[join_index].strip().lower(), row_index, row) for row_index, row in enumerate(reader))
+
+		matches, notfound_rows, csv_count = mmqgis_merge_join(feature_keys, row_keys, memory_rows)
+		matches = matches.sorted()
+		match = next(matches, None)
+
+	else:
+		# Read the CSV file data into memory and hash the rows by normalized
+		# join key so each feature finds its matches with a single lookup
+		for row_index, row in enumerate(reader):
+			csv_data.append(row)
+			csv_found.append(0)
+
+			key = row[join_index].strip().lower()
+			if key in csv_keys:
+				csv_keys[key].append(row_index)
+			else:
+				csv_keys[key] = [ row_index ]
+
+		csv_count = len(csv_data)
 
 	del reader
 
@@ -1530,29 +2394,38 @@ def mmqgis_attribute_join(qgis, layername, infilename, joinfield, targetfield, o
 		if feature.geometry() == None:
 			return "No geometry in layer: " + unicode(layername)
 
-		# Key must be UTF-8 encoded to be comparable with UTF-8 encoded 8-bit characters from CSV file
-		key = unicode(attributes[target_index]).encode("utf-8").lower().strip()
-
-		for row_index, row in enumerate(csv_data):
-			if row[join_index].strip().lower() == key:
-				# print key + " --------------"
-				newattributes = []
-				for value in attributes:
-					newattributes.append(value)
-					
-				for combine_index, combine in enumerate(row):
-					if combine_index != join_index:
-						try:
-							newattribute = unicode(combine, 'utf-8')
-						except:
-							return "CSV file does not appear to be UTF-8 encoded: " + unicode(infilename)
-						newattributes.append(newattribute)
+		# One feature can match many rows
+		matched_rows = []
+		if memory_rows > 0:
+			while (match != None) and (match[0] == feature_index):
+				matched_rows.append(match[1:])
+				match = next(matches, None)
 
-				newfeature = QgsFeature()
-				newfeature.setAttributes(newattributes)
-				newfeature.setGeometry(feature.geometry())
-				outfile.addFeature(newfeature)
-				matched_count += 1
+		else:
+			# Key must be UTF-8 encoded to be comparable with UTF-8 encoded 8-bit characters from CSV file
+			key = unicode(attributes[target_index]).encode("utf-8").lower().strip()
+			matched_rows = [ (row_index, csv_data[row_index]) for row_index in csv_keys.get(key, []) ]
+
+		for row_index, row in matched_rows:
+			# print key + " --------------"
+			newattributes = []
+			for value in attributes:
+				newattributes.append(value)
+				
+			for combine_index, combine in enumerate(row):
+				if combine_index != join_index:
+					try:
+						newattribute = unicode(combine, 'utf-8')
+					except:
+						return "CSV file does not appear to be UTF-8 encoded: " + unicode(infilename)
+					newattributes.append(newattribute)
+
+			newfeature = QgsFeature()
+			newfeature.setAttributes(newattributes)
+			newfeature.setGeometry(feature.geometry())
+			outfile.addFeature(newfeature)
+			matched_count += 1
+			if memory_rows <= 0:
 				csv_found[row_index] += 1
 
 	if matched_count <= 0:
@@ -1577,9 +2450,14 @@ def mmqgis_attribute_join(qgis, layername, infilename, joinfield, targetfield, o
 		# Encoding is forced to UTF-8 because CSV writer doesn't support Unicode
 		writer.writerow([field.encode("utf-8") for field in header])
 
-		for x in range(0, len(csv_data)):
-			if not csv_found[x]:
-				writer.writerow(csv_data[x])
+		if memory_rows > 0:
+			for row_index, row in notfound_rows.sorted():
+				writer.writerow(row)
+
+		else:
+			for x in range(0, len(csv_data)):
+				if not csv_found[x]:
+					writer.writerow(csv_data[x])
 		del writer
 		del outfile
 	
@@ -1588,7 +2466,7 @@ def mmqgis_attribute_join(qgis, layername, infilename, joinfield, targetfield, o
 		# newlayer.setProviderEncoding("utf-8")
 
 	mmqgis_completion_message(qgis, unicode(matched_count) + " records joined from " + \
-		unicode(feature_count) + " shape records and " + unicode(len(csv_data)) + " CSV file records")
+		unicode(feature_count) + " shape records and " + unicode(csv_count) + " CSV file records")
 
 	return None
 
@@ -1643,9 +2521,8 @@ def mmqgis_buffers(qgis, layername, radius_attribute, radius, radius_unit, edge_
 		if not QgsVectorFileWriter.deleteShapeFile(savename):
 			return "Failure deleting existing shapefile: " + savename
  
-	wgs84 = QgsCoordinateReferenceSystem()
-	wgs84.createFromProj4("+proj=longlat +datum=WGS84 +no_defs")
-	transform = QgsCoordinateTransform(layer.crs(), wgs84)
+	wgs84 = mmqgis_crs(mmqgis_wgs84_proj4)
+	transform = mmqgis_transform(layer.crs(), mmqgis_wgs84_proj4)
 	# print layer.crs().toProj4() + " -> " + wgs84.toProj4()
 	
 	outfile = QgsVectorFileWriter(savename, "utf-8", layer.fields(), QGis.WKBPolygon, wgs84)
@@ -1661,15 +2538,137 @@ def mmqgis_buffers(qgis, layername, radius_attribute, radius, radius_unit, edge_
 	else:
 		feature_list = layer.getFeatures()
 
+	# Point buffers are built in batches with array math
+	if (numpy != None) and (layer.wkbType() in [QGis.WKBPoint, QGis.WKBPoint25D]):
+		buffercount, message = mmqgis_buffer_point_batches(qgis, outfile, feature_list, featurecount, \
+			transform, radius_attribute_index, radius, radius_unit, edge_attribute_index, edge_count, \
+			rotation_attribute_index, rotation_degrees)
+
+		if message:
+			return message
+
+	else:
+		for feature_index, feature in enumerate(feature_list):
+			mmqgis_status_message(qgis, "Writing feature " + \
+				unicode(feature.id()) + " of " + unicode(featurecount))
+
+			if radius_attribute_index < 0:
+				feature_radius = radius
+			else:
+				try:
+					feature_radius = float(feature.attributes()[radius_attribute_index])
+				except:
+					feature_radius = 0.0
+
+			if feature_radius <= 0:
+				continue
+
+			# Buffer radii are always in meters
+			if radius_unit == "Feet":
+				feature_radius = mmqgis_feet_to_meters(feature_radius)
+
+			elif radius_unit == "Miles":
+				feature_radius = mmqgis_miles_to_meters(feature_radius)
+
+			elif radius_unit == "Kilometers":
+				feature_radius = feature_radius * 1000
+
+			if feature_radius <= 0:
+				continue
+
+			if edge_attribute_index < 0:
+				feature_edges = edge_count
+			else:
+				try:
+					feature_edges = int(feature.attributes()[edge_attribute_index])
+				except:
+					feature_edges = 32 # default to circle
+
+			if rotation_attribute_index < 0:
+				feature_rotation = rotation_degrees
+			else:
+				try:
+					feature_rotation = float(feature.attributes()[rotation_attribute_index])
+				except:
+					feature_rotation = 0.0
+
+			geometry = feature.geometry()
+			geometry.transform(transform) # Needs to be WGS 84 to use Haversine distance calculation
+			# print "Transform " + unicode(x) + ": " + unicode(geometry.centroid().asPoint().x())
+
+			if (geometry.wkbType() in [QGis.WKBPoint, QGis.WKBPoint25D, QGis.WKBMultiPoint, QGis.WKBMultiPoint25D]):
+
+				newgeometry = mmqgis_buffer_point(geometry.asPoint(), feature_radius, feature_edges, feature_rotation)
+
+			elif (geometry.wkbType() in [QGis.WKBLineString, QGis.WKBLineString25D, 
+							QGis.WKBMultiLineString, QGis.WKBMultiLineString25D]):
+
+				if (edge_attribute == "Flat End"):
+					# newgeometry = mmqgis_buffer_line_flat_end(geometry, feature_radius)
+					north = mmqgis_buffer_line_side(QgsGeometry(geometry), feature_radius, 0)
+					south = mmqgis_buffer_line_side(QgsGeometry(geometry), feature_radius, 180)
+					newgeometry = north.combine(south)
+
+				elif (edge_attribute == "North Side"):
+					newgeometry = mmqgis_buffer_line_side(geometry, feature_radius, 0)
+
+				elif (edge_attribute == "East Side"):
+					newgeometry = mmqgis_buffer_line_side(geometry, feature_radius, 90)
+
+				elif (edge_attribute == "South Side"):
+					newgeometry = mmqgis_buffer_line_side(geometry, feature_radius, 180)
+
+				elif (edge_attribute == "West Side"):
+					newgeometry = mmqgis_buffer_line_side(geometry, feature_radius, 270)
+
+				else: # "Rounded"
+					newgeometry = mmqgis_buffer_geometry(geometry, feature_radius)
+
+			else:
+				newgeometry = mmqgis_buffer_geometry(geometry, feature_radius)
+
+			if newgeometry == None:
+				return "Failure converting geometry for feature " + unicode(buffercount)
+
+			else:
+				newfeature = QgsFeature()
+				newfeature.setGeometry(newgeometry)
+				newfeature.setAttributes(feature.attributes())
+				outfile.addFeature(newfeature)
+	
+			buffercount = buffercount + 1
+
+	del outfile
+
+	if addlayer:
+		vlayer = qgis.addVectorLayer(savename, os.path.basename(savename), "ogr")
+		
+	mmqgis_completion_message(qgis, unicode(buffercount) + " buffers created for " + \
+		unicode(featurecount) + " features")
+
+	return None
+
+
+# Buffers for point features with the ring vertices for a batch of points computed
+# at once by mmqgis_endpoints(). Radius, edge and rotation values are read the same
+# way as in mmqgis_buffers() so the output matches mmqgis_buffer_point().
+# Returns (buffer count, error message)
+
+def mmqgis_buffer_point_batches(qgis, outfile, feature_list, featurecount, transform, \
+	radius_attribute_index, radius, radius_unit, edge_attribute_index, edge_count, \
+	rotation_attribute_index, rotation_degrees, batch_size = 10000):
+
+	buffercount = 0
+	batch = [] # attributes, point, radius, edges, rotation
+
 	for feature_index, feature in enumerate(feature_list):
-		mmqgis_status_message(qgis, "Writing feature " + \
-			unicode(feature.id()) + " of " + unicode(featurecount))
+		attributes = feature.attributes()
 
 		if radius_attribute_index < 0:
 			feature_radius = radius
 		else:
 			try:
-				feature_radius = float(feature.attributes()[radius_attribute_index])
+				feature_radius = float(attributes[radius_attribute_index])
 			except:
 				feature_radius = 0.0
 
@@ -1693,7 +2692,7 @@ def mmqgis_buffers(qgis, layername, radius_attribute, radius, radius_unit, edge_
 			feature_edges = edge_count
 		else:
 			try:
-				feature_edges = int(feature.attributes()[edge_attribute_index])
+				feature_edges = int(attributes[edge_attribute_index])
 			except:
 				feature_edges = 32 # default to circle
 
@@ -1701,65 +2700,73 @@ def mmqgis_buffers(qgis, layername, radius_attribute, radius, radius_unit, edge_
 			feature_rotation = rotation_degrees
 		else:
 			try:
-				feature_rotation = float(feature.attributes()[rotation_attribute_index])
+				feature_rotation = float(attributes[rotation_attribute_index])
 			except:
 				feature_rotation = 0.0
 
-		geometry = feature.geometry()
-		geometry.transform(transform) # Needs to be WGS 84 to use Haversine distance calculation
-		# print "Transform " + unicode(x) + ": " + unicode(geometry.centroid().asPoint().x())
-
-		if (geometry.wkbType() in [QGis.WKBPoint, QGis.WKBPoint25D, QGis.WKBMultiPoint, QGis.WKBMultiPoint25D]):
-
-			newgeometry = mmqgis_buffer_point(geometry.asPoint(), feature_radius, feature_edges, feature_rotation)
-
-		elif (geometry.wkbType() in [QGis.WKBLineString, QGis.WKBLineString25D, 
-						QGis.WKBMultiLineString, QGis.WKBMultiLineString25D]):
-
-			if (edge_attribute == "Flat End"):
-				# newgeometry = mmqgis_buffer_line_flat_end(geometry, feature_radius)
-				north = mmqgis_buffer_line_side(QgsGeometry(geometry), feature_radius, 0)
-				south = mmqgis_buffer_line_side(QgsGeometry(geometry), feature_radius, 180)
-				newgeometry = north.combine(south)
-
-			elif (edge_attribute == "North Side"):
-				newgeometry = mmqgis_buffer_line_side(geometry, feature_radius, 0)
+		# Needs to be WGS 84 to use Haversine distance calculation
+		point = transform.transform(feature.geometry().asPoint())
 
-			elif (edge_attribute == "East Side"):
-				newgeometry = mmqgis_buffer_line_side(geometry, feature_radius, 90)
+		batch.append([attributes, point, feature_radius, feature_edges, feature_rotation])
 
-			elif (edge_attribute == "South Side"):
-				newgeometry = mmqgis_buffer_line_side(geometry, feature_radius, 180)
-
-			elif (edge_attribute == "West Side"):
-				newgeometry = mmqgis_buffer_line_side(geometry, feature_radius, 270)
-
-			else: # "Rounded"
-				newgeometry = mmqgis_buffer_geometry(geometry, feature_radius)
+		if len(batch) >= batch_size:
+			mmqgis_status_message(qgis, "Writing feature " + \
+				unicode(feature_index + 1) + " of " + unicode(featurecount))
+
+			buffercount, message = mmqgis_write_point_buffers(outfile, batch, buffercount)
+			if message:
+				return buffercount, message
+
+			batch = []
+
+	return mmqgis_write_point_buffers(outfile, batch, buffercount)
+
+def mmqgis_write_point_buffers(outfile, batch, buffercount):
+	# Points with the same number of edges share one array of ring vertices
+	x = numpy.array([ record[1].x() for record in batch ])
+	y = numpy.array([ record[1].y() for record in batch ])
+	radii = numpy.array([ record[2] for record in batch ])
+	edges = numpy.array([ record[3] for record in batch ], dtype = int)
+	rotations = numpy.array([ record[4] for record in batch ])
+
+	wkbs = [ None ] * len(batch)
+	for edge_count in numpy.unique(edges[edges >= 3]).tolist():
+		indices = numpy.nonzero(edges == edge_count)[0]
+		degrees = numpy.mod((numpy.arange(edge_count + 1) * 360.0 / float(edge_count)) + \
+			rotations[indices, numpy.newaxis], 360)
+
+		ring_x, ring_y = mmqgis_endpoints(x[indices, numpy.newaxis], y[indices, numpy.newaxis], \
+			radii[indices, numpy.newaxis], degrees)
+
+		for index, wkb in zip(indices.tolist(), mmqgis_wkb_array(QGis.WKBPolygon, \
+				numpy.dstack((ring_x, ring_y)))):
+			wkbs[index] = wkb
+
+	# A point with fewer than three edges has no ring. As when buffering one
+	# feature at a time, the buffers before it in input order are written
+	# and the error names it. Rings after it in the batch are dropped.
+	features = []
+	for record, wkb in zip(batch, wkbs):
+		if wkb == None:
+			break
 
-		else:
-			newgeometry = mmqgis_buffer_geometry(geometry, feature_radius)
+		geometry = QgsGeometry()
+		geometry.fromWkb(wkb)
 
-		if newgeometry == None:
-			return "Failure converting geometry for feature " + unicode(buffercount)
+		feature = QgsFeature()
+		feature.setGeometry(geometry)
+		feature.setAttributes(record[0])
+		features.append(feature)
 
-		else:
-			newfeature = QgsFeature()
-			newfeature.setGeometry(newgeometry)
-			newfeature.setAttributes(feature.attributes())
-			outfile.addFeature(newfeature)
-	
-		buffercount = buffercount + 1
+	for feature in features:
+		outfile.addFeature(feature)
 
-	del outfile
+	buffercount = buffercount + len(features)
 
-	if addlayer:
-		vlayer = qgis.addVectorLayer(savename, os.path.basename(savename), "ogr")
-		
-	mmqgis_completion_message(qgis, unicode(buffercount) + " buffers created for " + \
-		unicode(featurecount) + " features")
+	if len(features) < len(batch):
+		return buffercount, "Failure converting geometry for feature " + unicode(buffercount)
 
-	return None
+	return buffercount, None
 
 
 
@@ -1768,7 +2775,7 @@ def mmqgis_buffers(qgis, layername, radius_attribute, radius, radius_unit, edge_
 #			while removing duplicate shapes
 # --------------------------------------------------------
 
-def mmqgis_delete_duplicate_geometries(qgis, layername, savename, addlayer):
+def mmqgis_delete_duplicate_geometries(qgis, layername, savename, addlayer, tolerance = 0):
 
 	# Initialization and error checking
 	layer = mmqgis_find_layer(layername)
@@ -1778,6 +2785,9 @@ def mmqgis_delete_duplicate_geometries(qgis, layername, savename, addlayer):
 	if len(savename) <= 0:
 		return "No output filename given"
 
+	if tolerance < 0:
+		return "Invalid tolerance: " + unicode(tolerance)
+
 	if QFile(savename).exists():
 		if not QgsVectorFileWriter.deleteShapeFile(savename):
 			return "Failure deleting existing shapefile: " + savename
@@ -1787,32 +2797,65 @@ def mmqgis_delete_duplicate_geometries(qgis, layername, savename, addlayer):
 	if (outfile.hasError() != QgsVectorFileWriter.NoError):
 		return "Failure creating output shapefile: " + unicode(outfile.errorMessage())
 
-	# Read geometries into an array
-	# Have to save as WKT because saving geometries causes segfault 
-	# when they are used with equal() later
-	geometries = []
-
-	for feature in layer.getFeatures():
-		geometries.append(feature.geometry().exportToWkt())
-
-	# NULL duplicate geometries
-	for x in range(0, len(geometries) - 1):
-		if geometries[x] != None:
-			if (x % 20) == 0:
-				mmqgis_status_message(qgis, "Checking feature " + unicode(x))
+	# Single pass: each geometry is reduced to a digest of its canonical
+	# form and written immediately unless the digest has been seen before
+	digests = set()
 
-			for y in range(x + 1, len(geometries)):
-				#print "Comparing " + str(x) + ", " + str(y)
-				if geometries[x] == geometries[y]:
-					#print "None " + str(x)
-					geometries[y] = None
+	# With a tolerance, unique geometries are bucketed by their snapped
+	# bounding box and each feature is checked against the geometries in the
+	# neighbouring buckets with a Hausdorff distance
+	buckets = {}
+	neighbors = list(itertools.product([-1, 0, 1], repeat = 4))
 
 	writecount = 0
 	for index, feature in enumerate(layer.getFeatures()):
-		if geometries[index] != None:
-			writecount += 1
-			outfile.addFeature(feature)
-				
+		if (index % 1000) == 0:
+			mmqgis_status_message(qgis, "Checking feature " + unicode(index))
+
+		if tolerance <= 0:
+			digest = mmqgis_geometry_digest(feature.geometry())
+			if digest in digests:
+				continue
+			digests.add(digest)
+
+		else:
+			geometry = None
+			bucket = None
+			if feature.geometry() != None:
+				geometry = mmqgis_geometry_parts(feature.geometry())
+				if geometry[1] != None:
+					bucket = mmqgis_tolerance_bucket(geometry[1], tolerance)
+
+			# Geometries that cannot be bucketed are only matched exactly
+			if bucket == None:
+				digest = mmqgis_geometry_digest(feature.geometry())
+				if digest in digests:
+					continue
+				digests.add(digest)
+
+			else:
+				duplicate = False
+				for offset in neighbors:
+					key = tuple([ bucket[z] + offset[z] for z in range(4) ])
+					for other in buckets.get(key, []):
+						distance = mmqgis_hausdorff_distance(geometry, other, tolerance / 1000.0)
+						if (distance != None) and (distance <= tolerance):
+							duplicate = True
+							break
+					if duplicate:
+						break
+
+				if duplicate:
+					continue
+
+				if bucket in buckets:
+					buckets[bucket].append(geometry)
+				else:
+					buckets[bucket] = [geometry]
+
+		writecount += 1
+		outfile.addFeature(feature)
+
 	del outfile
 
 	if addlayer:
@@ -1908,7 +2951,17 @@ def mmqgis_float_to_text(qgis, layername, attributes, separator,
 #    mmqgis_geocode_web_service - Geocode CSV points from Google Maps
 # --------------------------------------------------------------
 
-def mmqgis_geocode_web_service(qgis, csvname, shapefilename, notfoundfile, keys, service, apikey, addlayer):
+# Addresses are geocoded by a pool of worker threads limited to rate
+# requests per second (default from mmqgis_geocode_rates for the service).
+# If cachefile is given, results are kept there for cache_days (zero for
+# no limit), keeping at most cache_size (zero for no limit) addresses.
+# If checkpointfile is given, progress is journaled there so that an
+# interrupted run resumes after the last row written when run again.
+# Not found rows and features written after the last checkpoint are
+# dropped on resume so they are not written twice
+
+def mmqgis_geocode_web_service(qgis, csvname, shapefilename, notfoundfile, keys, service, apikey, addlayer, \
+	workers = 1, rate = None, cachefile = None, cache_days = 0, cache_size = 0, checkpointfile = None):
 	# Read the CSV file header
 	if ((service <> "Google Maps") and (service <> "OpenStreetMap / Nominatim")):
 		return "Invalid web mapping service name given: " + service
@@ -1955,9 +3008,34 @@ def mmqgis_geocode_web_service(qgis, csvname, shapefilename, notfoundfile, keys,
 	fields.append(QgsField("addrlocat", QVariant.String))
 	
 
+	# Resume after the last checkpoint if the output files are still there
+	journal = None
+	resume_row = -1
+	recordcount = 0
+	notfoundcount = 0
+	notfound_offset = 0
+	if checkpointfile:
+		try:
+			journal = mmqgis_checkpoint_journal(checkpointfile, [ csvname, os.path.getmtime(csvname), \
+				shapefilename, notfoundfile, keys, service ])
+		except Exception as e:
+			return "Failure opening checkpoint file " + unicode(checkpointfile) + ": " + unicode(e)
+
+		if (journal.row >= 0) and (len(journal.state) == 3) and \
+		   QFile(shapefilename).exists() and os.path.isfile(notfoundfile):
+			resume_row = journal.row
+			recordcount, notfoundcount, notfound_offset = journal.state
+		else:
+			journal.restart()
+
 	# Create the CSV file for ungeocoded records
 	try:
-		notfound = open(notfoundfile, 'w')
+		if resume_row >= 0:
+			notfound = open(notfoundfile, 'r+')
+			notfound.truncate(notfound_offset)
+			notfound.seek(notfound_offset)
+		else:
+			notfound = open(notfoundfile, 'w')
 
 	except Exception as e:
 		return unicode(e)
@@ -1969,19 +3047,43 @@ def mmqgis_geocode_web_service(qgis, csvname, shapefilename, notfoundfile, keys,
 	notwriter = csv.writer(notfound, dialect)
 
 	# Encoding is forced to UTF-8 because CSV writer doesn't support Unicode
-	notwriter.writerow([field.encode("utf-8") for field in header])
+	if resume_row < 0:
+		notwriter.writerow([field.encode("utf-8") for field in header])
 
 	# Create the output shapefile
-	if QFile(shapefilename).exists():
-		if not QgsVectorFileWriter.deleteShapeFile(shapefilename):
-			return "Failure deleting existing shapefile: " + unicode(shapefilename)
+	if resume_row < 0:
+		if QFile(shapefilename).exists():
+			if not QgsVectorFileWriter.deleteShapeFile(shapefilename):
+				return "Failure deleting existing shapefile: " + unicode(shapefilename)
 
-	crs = QgsCoordinateReferenceSystem()
-	crs.createFromSrid(4326)
-	outfile = QgsVectorFileWriter(shapefilename, "utf-8", fields, QGis.WKBPoint, crs)
-
-	if (outfile.hasError() != QgsVectorFileWriter.NoError):
-		return "Failure creating output shapefile: " + unicode(outfile.errorMessage())
+		crs = QgsCoordinateReferenceSystem()
+		crs.createFromSrid(4326)
+		outfile = QgsVectorFileWriter(shapefilename, "utf-8", fields, QGis.WKBPoint, crs)
+
+		if (outfile.hasError() != QgsVectorFileWriter.NoError):
+			return "Failure creating output shapefile: " + unicode(outfile.errorMessage())
+
+	# With checkpoints, features are appended to the shapefile in batches
+	# so what has been written is always known
+	if journal:
+		if resume_row < 0:
+			del outfile
+
+		outfile = None
+		outlayer = QgsVectorLayer(shapefilename, os.path.basename(shapefilename), "ogr")
+		if not outlayer.isValid():
+			return "Failure opening output shapefile: " + unicode(shapefilename)
+
+		if resume_row >= 0:
+			request = QgsFeatureRequest()
+			request.setFlags(QgsFeatureRequest.NoGeometry)
+			request.setSubsetOfAttributes([])
+			extra = [ feature.id() for index, feature in enumerate(outlayer.getFeatures(request)) \
+				if index >= (recordcount - notfoundcount) ]
+			if (len(extra) > 0) and (not outlayer.dataProvider().deleteFeatures(extra)):
+				return "Failure removing features past the checkpoint from " + unicode(shapefilename)
+
+		pending = []
 
 	# Proxy settings from qgis options settings
 	try:
@@ -2006,17 +3108,9 @@ def mmqgis_geocode_web_service(qgis, csvname, shapefilename, notfoundfile, keys,
 	except:
 		pass
 
-	# Geocode and import
-	error = None
-	recordcount = 0
-	notfoundcount = 0
+	# Build the query addresses
+	addresses = []
 	for row in reader:
-		time.sleep(0.5) # to avoid Google rate quota limits
-
-		recordcount += 1	
-		mmqgis_status_message(qgis, "Geocoding " + unicode(recordcount) + 
-			" (" + unicode(notfoundcount) + " not found)")
-
 		address = ""
 		for x in indices:
 			if x < len(row):
@@ -2035,17 +3129,65 @@ def mmqgis_geocode_web_service(qgis, csvname, shapefilename, notfoundfile, keys,
 					if x != indices[0]:
 						address += ",+"
 					address += value
-						
+
+		addresses.append((row, address))
+
+	# Cached addresses skip the web service
+	cache = None
+	cache_keys = [ None ] * len(addresses)
+	cached = [ None ] * len(addresses)
+	if cachefile:
+		try:
+			cache = mmqgis_geocode_cache(cachefile, cache_days, cache_size)
+		except Exception as e:
+			return "Failure opening geocode cache " + unicode(cachefile) + ": " + unicode(e)
+
+		for index, (row, address) in enumerate(addresses):
+			if (index > resume_row) and (len(address) > 0):
+				cache_keys[index] = mmqgis_geocode_cache_key(service, address)
+				cached[index] = cache.lookup(cache_keys[index])
+
+	# Geocode in worker threads. Results come back in input order
+	if not rate:
+		rate = mmqgis_geocode_rates[service]
+
+	limiter = mmqgis_rate_limiter(rate)
+	tasks = [ (service, apikey, address, limiter, cached[index]) \
+		for index, (row, address) in enumerate(addresses) if index > resume_row ]
+
+	pool = None
+	if workers > 1:
+		pool = ThreadPool(workers)
+		results = pool.imap(mmqgis_geocode_task, tasks)
+	else:
+		results = itertools.imap(mmqgis_geocode_task, tasks)
+
+	# Geocode and import
+	error = None
+	row_index = resume_row
+	for row_index, ((row, address), result) in enumerate(itertools.izip( \
+			addresses[resume_row + 1:], results), resume_row + 1):
+
+		if journal and ((row_index - journal.row) > 100):
+			outlayer.dataProvider().addFeatures(pending)
+			pending = []
+			notfound.flush()
+			journal.record(row_index - 1, [ recordcount, notfoundcount, notfound.tell() ])
+
+		recordcount += 1	
+		mmqgis_status_message(qgis, "Geocoding " + unicode(recordcount) + 
+			" (" + unicode(notfoundcount) + " not found)")
 
 		if len(address) <= 0:
 			notfoundcount += 1
 			notwriter.writerow(row)
 			continue
 	
-		if (service == "Google Maps"):
-			x, y, addrtype, addrlocat, formatted_addr = mmqgis_geocode_address_google(address, apikey)
-		else:
-			x, y, addrtype, addrlocat, formatted_addr = mmqgis_geocode_address_osm(address)
+		x, y, addrtype, addrlocat, formatted_addr = result
+
+		# Errors are not cached so they are retried on the next run
+		if cache and (cached[row_index] == None) and (x != None) and (y != None):
+			cache.store(cache_keys[row_index], result)
 
 		# Error condition
 		if (x != None) and (y == None):
@@ -2068,13 +3210,37 @@ def mmqgis_geocode_web_service(qgis, csvname, shapefilename, notfoundfile, keys,
 			newfeature.setAttributes(attributes)
 			geometry = QgsGeometry.fromPoint(QgsPoint(x[0], y[0]))
 			newfeature.setGeometry(geometry)
-			outfile.addFeature(newfeature)
+			if journal:
+				pending.append(newfeature)
+			else:
+				outfile.addFeature(newfeature)
 
 		else:
 			notfoundcount += 1
 			notwriter.writerow(row)
 				# print xml
 
+	# Stops any geocoding still running after an error
+	if pool:
+		pool.terminate()
+
+	# The row with an error is left to be geocoded on the next run
+	if journal:
+		outlayer.dataProvider().addFeatures(pending)
+		del outlayer
+		notfound.flush()
+		if (error != None):
+			journal.record(row_index - 1, [ recordcount - 1, notfoundcount, notfound.tell() ])
+		else:
+			journal.remove()
+
+	cache_message = ""
+	if cache:
+		cache.close()
+		if (cache.hits + cache.misses) > 0:
+			cache_message = " (cache hit ratio " + unicode(int(round(100.0 * cache.hits \
+				/ (cache.hits + cache.misses)))) + "%)"
+
 	del outfile
 	del notfound
 
@@ -2082,22 +3248,165 @@ def mmqgis_geocode_web_service(qgis, csvname, shapefilename, notfoundfile, keys,
 		vlayer = qgis.addVectorLayer(shapefilename, os.path.basename(shapefilename), "ogr")
 
 	if (error != None):
-		return error + ": " + unicode(recordcount - notfoundcount - 1) + " addresses geocoded"
+		return error + ": " + unicode(recordcount - notfoundcount - 1) + " addresses geocoded" + cache_message
 
 	mmqgis_completion_message(qgis, unicode(recordcount - notfoundcount) + " of " + unicode(recordcount)
-		+ " addresses geocoded with " + service)
+		+ " addresses geocoded with " + service + cache_message)
 
 	return None
 
 
+# Persistent SQLite cache of geocoded addresses. Results are stored as
+# returned by the geocoders, keeping the first location (or none if
+# not found). Entries older than ttl_days or beyond the max_entries most
+# recent are evicted when the cache is opened and closed.
+# Zero ttl_days or max_entries means no limit.
+
+class mmqgis_geocode_cache:
+	def __init__(self, filename, ttl_days = 0, max_entries = 0):
+		self.ttl = ttl_days * 86400.0
+		self.max_entries = max_entries
+		self.hits = 0
+		self.misses = 0
+		self.pending = 0
+
+		self.connection = sqlite3.connect(filename)
+		self.connection.execute("CREATE TABLE IF NOT EXISTS geocode (key TEXT PRIMARY KEY, " + \
+			"x REAL, y REAL, addrtype TEXT, addrlocat TEXT, formatted TEXT, created REAL)")
+		self.connection.execute("CREATE INDEX IF NOT EXISTS geocode_created ON geocode (created)")
+		self.evict()
+
+	def lookup(self, key):
+		row = self.connection.execute("SELECT x, y, addrtype, addrlocat, formatted, created " + \
+			"FROM geocode WHERE key = ?", (key,)).fetchone()
+
+		if (row == None) or ((self.ttl > 0) and (row[5] < (time.time() - self.ttl))):
+			self.misses += 1
+			return None
+
+		self.hits += 1
+		if row[0] == None:
+			return [], [], [], [], []
+
+		return [row[0]], [row[1]], [row[2]], [row[3]], [row[4]]
+
+	def store(self, key, result):
+		x, y, addrtype, addrlocat, formatted_addr = result
+		if len(x) > 0:
+			values = (key, x[0], y[0], addrtype[0], addrlocat[0], formatted_addr[0], time.time())
+		else:
+			values = (key, None, None, None, None, None, time.time())
+
+		self.connection.execute("INSERT OR REPLACE INTO geocode VALUES (?, ?, ?, ?, ?, ?, ?)", values)
+
+		self.pending += 1
+		if self.pending >= 100:
+			self.connection.commit()
+			self.pending = 0
+
+	def evict(self):
+		if self.ttl > 0:
+			self.connection.execute("DELETE FROM geocode WHERE created < ?", (time.time() - self.ttl,))
+
+		if self.max_entries > 0:
+			self.connection.execute("DELETE FROM geocode WHERE key IN (SELECT key FROM geocode " + \
+				"ORDER BY created DESC LIMIT -1 OFFSET ?)", (self.max_entries,))
+
+		self.connection.commit()
+
+	def close(self):
+		self.evict()
+		self.connection.close()
+
+# Cache key from the service and the normalized form of a query address
+
+def mmqgis_geocode_cache_key(service, address):
+	# Query addresses are URL-quoted fields separated by ",+"
+	text = unicode(urllib2.unquote(address.replace("+", " ")), "utf-8")
+	number, street, unit = mmqgis_normalize_address(text)
+	return service + u"|" + u"|".join([ part or u"" for part in [ number, street, unit ] ])
+
+# Append-only journal of progress through a long run. The first line is a
+# signature of the run's inputs and each later line is the last row done
+# followed by state (such as counts) to restore. A journal with a different
+# signature is started over.
+
+class mmqgis_checkpoint_journal:
+	def __init__(self, filename, signature):
+		self.filename = filename
+		self.signature = json.loads(json.dumps(signature))
+		self.row = -1
+		self.state = []
+
+		if os.path.isfile(filename):
+			lines = open(filename, 'r').read().splitlines()
+			try:
+				if json.loads(lines[0]) != self.signature:
+					lines = []
+			except:
+				lines = []
+
+			# A partly written last line from a crash is skipped
+			for line in lines[1:]:
+				try:
+					checkpoint = json.loads(line)
+					self.row = checkpoint[0]
+					self.state = checkpoint[1:]
+				except:
+					break
+
+		if self.row < 0:
+			self.restart()
+
+	def restart(self):
+		self.row = -1
+		self.state = []
+		journal = open(self.filename, 'w')
+		journal.write(json.dumps(self.signature) + "\n")
+		journal.close()
+
+	def record(self, row, state):
+		self.row = row
+		self.state = state
+		journal = open(self.filename, 'a')
+		journal.write(json.dumps([ row ] + state) + "\n")
+		journal.flush()
+		os.fsync(journal.fileno())
+		journal.close()
+
+	def remove(self):
+		if os.path.isfile(self.filename):
+			os.remove(self.filename)
+
+# Geocodes one address for mmqgis_geocode_web_service worker threads.
+# task is (service, apikey, address, rate limiter, cached result or None)
+
+def mmqgis_geocode_task(task):
+	service, apikey, address, limiter, cached = task
+	if len(address) <= 0:
+		return None
+
+	if cached != None:
+		return cached
+
+	if (service == "Google Maps"):
+		return mmqgis_geocode_address_google(address, apikey, limiter)
+	else:
+		return mmqgis_geocode_address_osm(address, limiter)
+
+
 # ---------------------------------------------------------------
 #    mmqgis_geocode_street_layer - Geocode addresses from street 
 #			     address finder shapefile
 # ---------------------------------------------------------------
 
+# If indexfile is given, the street index is saved there and reused by
+# later runs against the same street layer and fields. Only unedited
+# file layers are indexed to disk, since others cannot be checked for changes
+
 def mmqgis_geocode_street_layer(qgis, layername, csvname, streetnamefield, numberfield, zipfield, \
 	streetname, fromx, fromy, tox, toy, leftfrom, rightfrom, leftto, rightto, leftzip, rightzip, \
-	setback, shapefilename, notfoundfile, addlayer):
+	setback, shapefilename, notfoundfile, addlayer, indexfile = None):
 
 	# Error checks
 	layer = mmqgis_find_layer(layername)
@@ -2200,6 +3509,167 @@ def mmqgis_geocode_street_layer(qgis, layername, csvname, streetnamefield, numbe
 	if (outfile.hasError() != QgsVectorFileWriter.NoError):
 		return "Failure creating output shapefile: " + unicode(outfile.errorMessage())
 
+	# Index the street segments by name and address range. The index is only
+	# saved for unedited file layers, where the file modification time shows
+	# when the streets change. Database and memory layers have no such time.
+	if indexfile and ((not os.path.isfile(layer.source())) or layer.isModified()):
+		mmqgis_status_message(qgis, "Street index not saved for " + unicode(layername) + \
+			", which is not an unedited file layer")
+		indexfile = None
+
+	index_key = [ layer.source(), layer.subsetString(), layer.featureCount(), streetname, \
+		fromx, fromy, tox, toy, leftfrom, rightfrom, leftto, rightto, leftzip, rightzip ]
+	if indexfile:
+		index_key.append(os.path.getmtime(layer.source()))
+
+	street_index = None
+	if indexfile and os.path.isfile(indexfile):
+		mmqgis_status_message(qgis, "Loading street index " + unicode(indexfile))
+		try:
+			cache = open(indexfile, 'rb')
+			cached_key, cached_index = cPickle.load(cache)
+			cache.close()
+			if cached_key == index_key:
+				street_index = cached_index
+		except:
+			street_index = None
+
+	if street_index == None:
+		street_index = mmqgis_street_index(qgis, layer, streetname, fromx, fromy, tox, toy, \
+			leftfrom, rightfrom, leftto, rightto, leftzip, rightzip)
+
+		if indexfile:
+			try:
+				cache = open(indexfile, 'wb')
+				cPickle.dump((index_key, street_index), cache, cPickle.HIGHEST_PROTOCOL)
+				cache.close()
+			except:
+				return "Failure writing street index " + unicode(indexfile)
+
+	segments, streets = street_index
+
+
+	# Look up each address. When more than one street segment matches,
+	# the first segment in the street layer is used
+	matches = []
+	unmatched = []
+	for row_index, row in enumerate(addresses):
+		if (row_index % 1000) == 0:
+			mmqgis_status_message(qgis, "Searching address " + \
+				unicode(row_index) + " of " + unicode(len(addresses)) + \
+				" (" + unicode(len(matches)) + " matched)")
+
+		number = row[numberfield_index]
+		street = mmqgis_searchable_streetname(unicode(row[streetnamefield_index]))
+
+		if zipfield_index >= 0:
+			zipcode = row[zipfield_index]
+		else:
+			zipcode = None
+
+		segment_number = mmqgis_street_index_lookup(streets, street, number, zipcode)
+		if segment_number == None:
+			unmatched.append(row)
+		else:
+			matches.append((segments[segment_number][0], row_index, segment_number))
+
+	# Output in street layer order, as when each street searched the address list
+	matches.sort()
+
+	matched_count = 0
+	feature_count = layer.featureCount()
+	for feature_index, row_index, segment_number in matches:
+		row = addresses[row_index]
+		number = row[numberfield_index]
+		feature_index, leftfrom_number, leftto_number, rightfrom_number, rightto_number, \
+			fromx, fromy, tox, toy = segments[segment_number]
+
+		# Find percentage distance along street
+		left = ((leftfrom_number % 2) == (number % 2))
+		if left:
+			if (leftfrom_number == leftto_number):
+				ratio = 0.5
+			else:
+				ratio = float(number - leftfrom_number) \
+					/ float(leftto_number - leftfrom_number)
+		else:
+			if (rightfrom_number == rightto_number):
+				ratio = 0.5
+			else:
+				ratio = float(number - rightfrom_number) \
+					/ float(rightto_number - rightfrom_number)
+
+		# setback from corner
+		angle = atan2(toy - fromy, tox - fromx)
+		setback_fromx = fromx + (setback * cos(angle))
+		setback_tox = tox - (setback * cos(angle))
+		setback_fromy = fromy + (setback * sin(angle))
+		setback_toy = toy - (setback * sin(angle))
+
+		x = setback_fromx + ((setback_tox - setback_fromx) * ratio)
+		y = setback_fromy + ((setback_toy - setback_fromy) * ratio)
+
+		# setback from street center
+		if left:
+			y += (setback * cos(angle))
+			x -= (setback * sin(angle))
+		else:
+			y -= (setback * cos(angle))
+			x += (setback * sin(angle))
+
+		# Create the output feature
+		newattributes = []
+		for field in row:
+			# newattributes.append(QVariant(field))
+			newattributes.append(field)
+
+		#newattributes.append(QVariant(x))
+		#newattributes.append(QVariant(y))
+		newattributes.append(x)
+		newattributes.append(y)
+
+		newfeature = QgsFeature()
+		newfeature.setAttributes(newattributes)
+		geometry = QgsGeometry.fromPoint(QgsPoint(x, y))
+		newfeature.setGeometry(geometry)
+		outfile.addFeature(newfeature)
+		matched_count += 1
+
+	address_count = len(addresses)
+	addresses = unmatched
+
+	#print "del outfile 1"
+	del outfile
+
+	# Write unjoined addresses to notfound file
+	for index, row in enumerate(addresses):
+		if row[streetnamefield_index] > "":
+			notfoundwriter.writerow([unicode(field).encode("utf-8") for field in row])
+            
+	# Close notfound file
+	del notfound
+
+
+	if matched_count and addlayer:
+		#print "addLayer"
+		vlayer = qgis.addVectorLayer(shapefilename, os.path.basename(shapefilename), "ogr")
+		
+	mmqgis_completion_message(qgis, unicode(matched_count) + " of " + unicode(address_count) \
+		+ " addresses geocoded from " + unicode(feature_count) + " street records")
+
+	return None
+
+
+# Street segment index for mmqgis_geocode_street_layer, built in one pass
+# over the street layer. Returns (segments, streets) where segments are
+# (feature index, left from, left to, right from, right to, from x, from y, to x, to y)
+# and streets maps each searchable street name to address ranges:
+# (range lows, running maximum of range highs, ranges as (low, high, parity, zip, segment))
+# sorted by low so a lookup is a binary search
+
+def mmqgis_street_index(qgis, layer, streetname, fromx, fromy, tox, toy, \
+		leftfrom, rightfrom, leftto, rightto, leftzip, rightzip):
+
 	fromx_attribute = None
 	fromy_attribute = None
 	tox_attribute = None
@@ -2226,224 +3696,134 @@ def mmqgis_geocode_street_layer(qgis, layername, csvname, streetnamefield, numbe
 	if rightzip:
 		rightzip_attribute = layer.fieldNameIndex(rightzip)
 
-
-	# Iterate through each feature in the source layer
-	matched_count = 0
+	segments = []
+	ranges = {}
 	feature_count = layer.featureCount()
 	for feature_index, feature in enumerate(layer.getFeatures()):
-		if (len(addresses) <= 0):
-			break
-
-		if (feature.id() % 100) == 0:
-			mmqgis_status_message(qgis, "Searching street " + \
-				unicode(feature_index) + " of " + unicode(feature_count) + \
-				" (" + unicode(matched_count) + " matched)")
-
-		# print "Searching street " + unicode(feature_index) + " of " + unicode(feature_count)
+		if (feature_index % 1000) == 0:
+			mmqgis_status_message(qgis, "Indexing street " + \
+				unicode(feature_index) + " of " + unicode(feature_count))
 
 		attributes = feature.attributes()
-		# feature_streetname = mmqgis_searchable_streetname(unicode(attributes[streetname_attribute].toString()))
-		# feature_streetname = mmqgis_normalize_address(unicode(attributes[streetname_attribute]))[1]
-
 		feature_streetname = mmqgis_searchable_streetname(unicode(attributes[streetname_attribute]))
 		if not feature_streetname:
 			continue
 
-		# print "Searching street:", feature_streetname
+		# Find range of street numbers on this feature
+		try:
+			leftto_number = int(attributes[leftto_attribute])
+			leftfrom_number = int(attributes[leftfrom_attribute])
+			rightto_number = int(attributes[rightto_attribute])
+			rightfrom_number = int(attributes[rightfrom_attribute])
 
-		# Check each address against this feature
-		row_index = 0
-		while (row_index < len(addresses)):
-			row = addresses[row_index]
-			number = row[numberfield_index]
+		except:
+			leftto_number = 0
+			leftfrom_number = 0
+			rightto_number = 0
+			rightfrom_number = 0
 
-			# street = mmqgis_normalize_address(row[streetnamefield_index])[1]
-			street = mmqgis_searchable_streetname(unicode(row[streetnamefield_index]))
+		if leftzip_attribute >= 0:
+			leftzipcode = unicode(attributes[leftzip_attribute])
+		else:
+			leftzipcode = None
 
-			# print "   Searching address:", number, street
+		if rightzip_attribute >= 0:
+			rightzipcode = unicode(attributes[rightzip_attribute])
+		else:
+			rightzipcode = None
 
-			if (not street) or (feature_streetname != street):
-				row_index = row_index + 1
-				continue
+		# Find line start and end points
+		geometry = feature.geometry()
+		if (geometry == None):
+			continue
 
+		elif (geometry.wkbType() == QGis.WKBLineString) or \
+		   (geometry.wkbType() == QGis.WKBLineString25D):
+			line = geometry.asPolyline()
+			fromx = line[0].x()
+			fromy = line[0].y()
+			tox = line[len(line) - 1].x()
+			toy = line[len(line) - 1].y()
 
-			# Find range of street numbers on this feature
-			try:
-				leftto_number = int(attributes[leftto_attribute])
-				leftfrom_number = int(attributes[leftfrom_attribute])
-				rightto_number = int(attributes[rightto_attribute])
-				rightfrom_number = int(attributes[rightfrom_attribute])
+		elif (geometry.wkbType() == QGis.WKBMultiLineString) or \
+		     (geometry.wkbType() == QGis.WKBMultiLineString25D):
+			lines = geometry.asMultiPolyline()
+			line = lines[0]
+			fromx = line[0].x()
+			fromy = line[0].y()
+			line = lines[len(lines) - 1]
+			tox = line[len(line) - 1].x()
+			toy = line[len(line) - 1].y()
 
-			except:
-				leftto_number = 0
-				leftfrom_number = 0
-				rightto_number = 0
-				rightfrom_number = 0
-
-			if leftzip_attribute >= 0:
-				# leftzipcode = unicode(attributes[leftzip_attribute].toString())
-				leftzipcode = unicode(attributes[leftzip_attribute])
-			else:
-				leftzipcode = None
+		else:
+			# errant geometry type?!
+			continue
 
-			if rightzip_attribute >= 0:
-				# rightzipcode = unicode(attributes[leftzip_attribute].toString())
-				rightzipcode = unicode(attributes[rightzip_attribute])
-			else:
-				rightzipcode = None
-			
-			if zipfield_index >= 0:
-				zipcode = row[zipfield_index]
+		# Use attribute values if specified
+		try:
+			if tox_attribute:					
+				tox = float(attributes[tox_attribute])
+			if toy_attribute:
+				toy = float(attributes[toy_attribute])
+			if fromx_attribute:
+				fromx = float(attributes[fromx_attribute])
+			if fromy_attribute:
+				fromy = float(attributes[fromy_attribute])
+		except:
+			tox = 0
+			toy = 0
+			fromx = 0
+			fromy = 0
+
+		segment_number = len(segments)
+		segments.append((feature_index, leftfrom_number, leftto_number, rightfrom_number, rightto_number, \
+			fromx, fromy, tox, toy))
+
+		if feature_streetname not in ranges:
+			ranges[feature_streetname] = []
+
+		ranges[feature_streetname].append((min(leftfrom_number, leftto_number), \
+			max(leftfrom_number, leftto_number), leftfrom_number % 2, leftzipcode, segment_number))
+		ranges[feature_streetname].append((min(rightfrom_number, rightto_number), \
+			max(rightfrom_number, rightto_number), rightfrom_number % 2, rightzipcode, segment_number))
+
+	streets = {}
+	for name, street_ranges in ranges.iteritems():
+		street_ranges.sort()
+		lows = [ street_range[0] for street_range in street_ranges ]
+		highs = []
+		for street_range in street_ranges:
+			if (len(highs) <= 0) or (street_range[1] > highs[-1]):
+				highs.append(street_range[1])
 			else:
-				zipcode = None
-
-			# Check address number
-			if ((leftto_number >= leftfrom_number) \
-			    and (number >= leftfrom_number) \
-			    and (number <= leftto_number) \
-			    and ((leftfrom_number % 2) == (number % 2)) \
-			    and ((leftzipcode == None) or (zipcode == None) or (zipcode == leftzipcode))) or \
-			    ((leftto_number < leftfrom_number) \
-			    and (number >= leftto_number) \
-			    and (number <= leftfrom_number) \
-			    and ((leftfrom_number % 2) == (number % 2)) \
-			    and ((leftzipcode == None) or (zipcode == None) or (zipcode == leftzipcode))) or \
-			   ((rightto_number >= rightfrom_number) \
-			    and (number >= rightfrom_number) \
-			    and (number <= rightto_number) \
-			    and ((rightfrom_number % 2) == (number % 2))
-			    and ((rightzipcode == None) or (zipcode == None) or (zipcode == rightzipcode))) or \
-			   ((rightto_number < rightfrom_number) \
-			    and (number >= rightto_number) \
-			    and (number <= rightfrom_number) \
-			    and ((rightfrom_number % 2) == (number % 2))
-			    and ((rightzipcode == None) or (zipcode == None) or (zipcode == rightzipcode))):
-
-				# print "      Match!"
-
-				# Find line start and end points
-				geometry = feature.geometry()
-				if (geometry.wkbType() == QGis.WKBLineString) or \
-				   (geometry.wkbType() == QGis.WKBLineString25D):
-					line = geometry.asPolyline()
-					fromx = line[0].x()
-					fromy = line[0].y()
-					tox = line[len(line) - 1].x()
-					toy = line[len(line) - 1].y()
-
-				elif (geometry.wkbType() == QGis.WKBMultiLineString) or \
-				     (geometry.wkbType() == QGis.WKBMultiLineString25D):
-					lines = geometry.asMultiPolyline()
-					line = lines[0]
-					fromx = line[0].x()
-					fromy = line[0].y()
-					line = lines[len(lines) - 1]
-					tox = line[len(line) - 1].x()
-					toy = line[len(line) - 1].y()
+				highs.append(highs[-1])
 
-				else:
-					# errant geometry type?!
-					continue
-					# return "Street layer must be a lines or multilines (WKB Type " + \
-					#	unicode(geometry.wkbType()) + ")"
+		streets[name] = (lows, highs, street_ranges)
 
-				# Use attribute values if specified
-				try:
-					if tox_attribute:					
-						# (tox, test) = attributes[tox_attribute].toDouble()
-						tox = float(attributes[tox_attribute])
-					if toy_attribute:
-						# (toy, test) = attributes[toy_attribute].toDouble()
-						toy = float(attributes[toy_attribute])
-					if fromx_attribute:
-						# (fromx, test) = attributes[fromx_attribute].toDouble()
-						fromx = float(attributes[fromx_attribute])
-					if fromy_attribute:
-						# (fromy, test) = attributes[fromy_attribute].toDouble()
-						fromy = float(attributes[fromy_attribute])
-				except:
-					tox = 0
-					toy = 0
-					fromx = 0
-					fromy = 0
-
-				# Find percentage distance along street
-				left = ((leftfrom_number % 2) == (number % 2))
-				if left:
-					if (leftfrom_number == leftto_number):
-						ratio = 0.5
-					else:
-						ratio = float(number - leftfrom_number) \
-							/ float(leftto_number - leftfrom_number)
-				else:
-					if (rightfrom_number == rightto_number):
-						ratio = 0.5
-					else:
-						ratio = float(number - rightfrom_number) \
-							/ float(rightto_number - rightfrom_number)
-
-				# setback from corner
-				angle = atan2(toy - fromy, tox - fromx)
-				setback_fromx = fromx + (setback * cos(angle))
-				setback_tox = tox - (setback * cos(angle))
-				setback_fromy = fromy + (setback * sin(angle))
-				setback_toy = toy - (setback * sin(angle))
-
-				x = setback_fromx + ((setback_tox - setback_fromx) * ratio)
-				y = setback_fromy + ((setback_toy - setback_fromy) * ratio)
-
-				# setback from street center
-				if left:
-					y += (setback * cos(angle))
-					x -= (setback * sin(angle))
-				else:
-					y -= (setback * cos(angle))
-					x += (setback * sin(angle))
+	return segments, streets
 
-				# Create the output feature
-				newattributes = []
-				for field in row:
-					# newattributes.append(QVariant(field))
-					newattributes.append(field)
+# Returns the first segment number (in street layer order) from mmqgis_street_index
+# with an address range on the named street containing number, or None
 
-				#newattributes.append(QVariant(x))
-				#newattributes.append(QVariant(y))
-				newattributes.append(x)
-				newattributes.append(y)
+def mmqgis_street_index_lookup(streets, street, number, zipcode):
+	if (not street) or (street not in streets):
+		return None
 
-				newfeature = QgsFeature()
-				newfeature.setAttributes(newattributes)
-				geometry = QgsGeometry.fromPoint(QgsPoint(x, y))
-				newfeature.setGeometry(geometry)
-				outfile.addFeature(newfeature)
-				matched_count += 1
+	lows, highs, street_ranges = streets[street]
 
-				# Remove address so not searched further
-				del addresses[row_index]
+	# Ranges to the left of the search position start at or below number,
+	# and scanning stops once no earlier range reaches up to number
+	found = None
+	position = bisect.bisect_right(lows, number) - 1
+	while (position >= 0) and (highs[position] >= number):
+		low, high, parity, range_zip, segment_number = street_ranges[position]
+		if (high >= number) and (parity == (number % 2)) and \
+		   ((range_zip == None) or (zipcode == None) or (zipcode == range_zip)):
+			if (found == None) or (segment_number < found):
+				found = segment_number
+		position -= 1
 
-			else:
-				row_index = row_index + 1
-
-	#print "del outfile 1"
-	del outfile
-
-	# Write unjoined addresses to notfound file
-	for index, row in enumerate(addresses):
-		if row[streetnamefield_index] > "":
-			notfoundwriter.writerow([unicode(field).encode("utf-8") for field in row])
-            
-	# Close notfound file
-	del notfound
-
-
-	if matched_count and addlayer:
-		#print "addLayer"
-		vlayer = qgis.addVectorLayer(shapefilename, os.path.basename(shapefilename), "ogr")
-		
-	mmqgis_completion_message(qgis, unicode(matched_count) + " of " + unicode(len(addresses)) \
-		+ " addresses geocoded from " + unicode(feature_count) + " street records")
-
-	return None
+	return found
 
 
 # --------------------------------------------------------
@@ -2753,12 +4133,69 @@ def mmqgis_geometry_convert(qgis, layername, newgeometry, savename, addlayer):
 
 	return None
 
+# Parts of a singlepart or multipart geometry for a multipart geometry of type
+# newtype. Shapefiles do not distinguish between single and multipart lines and
+# polygons, so the geometry is tried both ways. Returns None if neither works.
+
+def mmqgis_multipart_parts(geometry, newtype):
+	if newtype == QGis.WKBMultiPoint:
+		if geometry.wkbType() in [QGis.WKBPoint, QGis.WKBPoint25D]:
+			return [ geometry.asPoint() ]
+		elif geometry.wkbType() in [QGis.WKBMultiPoint, QGis.WKBMultiPoint25D]:
+			return list(geometry.asMultiPoint())
+
+	elif newtype == QGis.WKBMultiLineString:
+		if len(geometry.asPolyline()) > 0:
+			return [ geometry.asPolyline() ]
+		elif len(geometry.asMultiPolyline()) > 0:
+			return list(geometry.asMultiPolyline())
+
+	else: # newtype == QGis.WKBMultiPolygon:
+		if len(geometry.asPolygon()) > 0:
+			return [ geometry.asPolygon() ]
+		elif len(geometry.asMultiPolygon()) > 0:
+			return list(geometry.asMultiPolygon())
+
+	return None
+
+# Add the numeric values of a feature merged into a group to the group
+# attributes. Values that cannot be added set the sum to zero.
+
+def mmqgis_multipart_sum(attributes, values, fieldtypes):
+	for zindex, ztype in enumerate(fieldtypes):
+		if (ztype == QVariant.Int):
+			try:
+				attributes[zindex] = int(attributes[zindex]) + int(values[zindex])
+			except:
+				attributes[zindex] = 0
+
+		elif (ztype == QVariant.Double):
+			try:
+				attributes[zindex] = float(attributes[zindex]) + float(values[zindex])
+			except:
+				attributes[zindex] = 0
+
+def mmqgis_write_multipart(outfile, newtype, attributes, parts):
+	newfeature = QgsFeature()
+	newfeature.setAttributes(attributes)
+
+	if newtype == QGis.WKBMultiPoint:
+		newfeature.setGeometry(QgsGeometry.fromMultiPoint(parts))
+
+	elif newtype == QGis.WKBMultiLineString:
+		newfeature.setGeometry(QgsGeometry.fromMultiPolyline(parts))
+
+	else: # WKBMultiPolygon:
+		newfeature.setGeometry(QgsGeometry.fromMultiPolygon(parts))
+
+	outfile.addFeature(newfeature)
+
 # --------------------------------------------------------
 #    mmqgis_geometry_to_multipart - Convert singlepart 
 #		to multipart geometries
 # --------------------------------------------------------
 
-def mmqgis_geometry_to_multipart(qgis, layername, mergefield, mergeattop, savename, addlayer):
+def mmqgis_geometry_to_multipart(qgis, layername, mergefield, mergeattop, savename, addlayer, presorted = False):
 
 	# Error checking
 	layer = mmqgis_find_layer(layername)
@@ -2795,155 +4232,46 @@ def mmqgis_geometry_to_multipart(qgis, layername, mergefield, mergeattop, savena
 	if (outfile.hasError() != QgsVectorFileWriter.NoError):
 		return "Failure creating output shapefile: " + unicode(outfile.errorMessage())
 
-	# Have to read features into memory because nested loops of getFeature() don't work
+	# Group-by in one pass: features are bucketed by key in order of first
+	# appearance with the parts of the multipart geometry and the attributes
+	# of the first feature, which accumulate sums as later features are added.
+	# With presorted input, each group is written as soon as the key changes.
 	feature_count = layer.featureCount()
-        features = []
-	for index, feature in enumerate(layer.getFeatures()):
-		if (index % 10) == 0:
-			mmqgis_status_message(qgis, "Reading feature " + unicode(index) \
-				+ " of " + unicode(feature_count))
-		features.append(feature)
-	
+	fieldtypes = [ field.type() for field in layer.fields() ]
 
-	# Iterate through each feature in the source layer
+	groups = collections.OrderedDict()
 	merge_count = 0
-	for x in range(0, len(features)):
-		if (x % 10) == 0:
-			mmqgis_status_message(qgis, "Converting feature " + str(x) \
-				+ " of " + unicode(len(features)))
-
-		if features[x] != None:
-			attributes = features[x].attributes()
-			# key = unicode(attributes[merge_index].toString()).lower()
-			key = unicode(attributes[merge_index]).lower()
-			# print "Processing " + unicode(x) + ": " + key
-
-			newgeometry = []
-			if newtype == QGis.WKBMultiPoint:
-				if (feature.geometry().wkbType() == QGis.WKBPoint) or \
-				   (feature.geometry().wkbType() == QGis.WKBPoint25D):
-					newgeometry.append(features[x].geometry().asPoint())
-
-				elif (feature.geometry().wkbType() == QGis.WKBMultiPoint) or \
-				     (feature.geometry().wkbType() == QGis.WKBMultiPoint25D):
-					for point in features[x].geometry().asMultiPoint():
-						newgeometry.append(point)
-				else:
-					return "Invalid multipoint geometry type: " + \
-						mmqgis_wkbtype_to_text(features[x].geometry().wkbType())
-
-			elif newtype == QGis.WKBMultiLineString:
-				# This is a workaround since shapefiles do not distinguish
-				# between polylines and multipolylines - all polygons can have multiple
-				# parts. QgsGeometry.wkbType() returns WKBLineString even if the 
-				# geometry is WKBMultiLineString
-
-				#if (feature.geometry().wkbType() == QGis.WKBLineString) or \
-				#   (feature.geometry().wkbType() == QGis.WKBLineString25D):
-
-				if len(features[x].geometry().asPolyline()) > 0:
-					newgeometry.append(features[x].geometry().asPolyline())
-
-				#elif (feature.geometry().wkbType() == QGis.WKBMultiLineString) or \
-				#     (feature.geometry().wkbType() == QGis.WKBMultiLineString25D):
-
-				elif len(features[x].geometry().asMultiPolyline()) > 0:
-					for polyline in features[x].geometry().asMultiPolyline():
-						newgeometry.append(polyline)
-				else:
-					return "Invalid multilinestring geometry type: " + \
-						mmqgis_wkbtype_to_text(features[x].geometry().wkbType())
-
-			else: # newtype == QGis.WKBMultiPolygon:
-				# This is a workaround since shapefiles do not distinguish
-				# between polygons and multipolygons - all polygons can have multiple
-				# parts. QgsGeometry.wkbType() returns WKBPolygon even if the 
-				# geometry is WKBMultiPolygon
-
-				#if (feature.geometry().wkbType() == QGis.WKBPolygon) or \
-				#   (feature.geometry().wkbType() == QGis.WKBPolygon25D):
-
-				if len(features[x].geometry().asPolygon()) > 0:
-					newgeometry.append(features[x].geometry().asPolygon())
-
-				#elif (feature.geometry().wkbType() == QGis.WKBMultiPolygon) or \
-				#     (feature.geometry().wkbType() == QGis.WKBMultiPolygon25D):
-
-				elif len(features[x].geometry().asMultiPolygon()) > 0:
-					for polygon in features[x].geometry().asMultiPolygon():
-						newgeometry.append(polygon)
-				else:
-					return "Invalid multipolygon geometry type: " + \
-						mmqgis_wkbtype_to_text(features[x].geometry().wkbType())
-
-			for y in range(x + 1, len(features)):
-				#print "   Comparing " + unicode(y)
-				#if (features[y] != None) and \
-				#   (unicode(features[y].attributes()[merge_index].toString()).lower() == key):
-				if (features[y] != None) and \
-				   (unicode(features[y].attributes()[merge_index]).lower() == key):
-					# print "  " + unicode(features[y].geometry().wkbType())
-
-					if newtype == QGis.WKBMultiPoint:
-						newgeometry.append(features[y].geometry().asPoint())
-
-					elif newtype == QGis.WKBMultiLineString:
-						newgeometry.append(features[y].geometry().asPolyline())
-
-					# MultiPolygons must be broken apart into separate polygons
-					elif features[y].geometry().wkbType() == QGis.WKBMultiPolygon:
-						for polygon in features[y].geometry().asMultiPolygon():
-							newgeometry.append(polygon)
-						
-					else: # QGis.WKBMultiPolygon:
-						newgeometry.append(features[y].geometry().asPolygon())
-					
-					if mergeattop == "Sum":
-						for zindex, zfield in enumerate(layer.fields()):
-							zvalue = features[y].attributes()[zindex]
-							if (zfield.type() == QVariant.Int):
-								#xval, test = attributes[zindex].toInt()
-								#yval, test = features[y].attributes()[zindex].toInt()
-								#attributes[zindex] = QVariant(xval + yval)
-								try:
-									xval = int(attributes[zindex])
-									yval = int(zvalue)
-									attributes[zindex] = xval + yval
-								except:
-									attributes[zindex] = 0
-
-							elif (zfield.type() == QVariant.Double):
-								# xval, test = attributes[zindex].toDouble()
-								# yval, test = features[y].attributes()[zindex].toDouble()
-								# attributes[zindex] = QVariant(xval + yval)
-								try:
-									xval = float(attributes[zindex])
-									yval = float(zvalue)
-									attributes[zindex] = xval + yval
-								except:
-									attributes[zindex] = 0
-
-							# print "      Sum " + unicode(zindex) + ": " + \
-							#	unicode(attributes[zindex].typeName())
-
-					features[y] = None
-
-			# print unicode(key) + ": " + unicode(type(newgeometry)) + ": " + unicode(len(newgeometry))
-
-			newfeature = QgsFeature()
-			newfeature.setAttributes(attributes)
+	for index, feature in enumerate(layer.getFeatures()):
+		if (index % 1000) == 0:
+			mmqgis_status_message(qgis, "Converting feature " + unicode(index) \
+				+ " of " + unicode(feature_count))
 
-			if newtype == QGis.WKBMultiPoint:
-				newfeature.setGeometry(QgsGeometry.fromMultiPoint(newgeometry))
+		attributes = feature.attributes()
+		key = unicode(attributes[merge_index]).lower()
+
+		parts = mmqgis_multipart_parts(feature.geometry(), newtype)
+		if parts == None:
+			return "Invalid " + mmqgis_wkbtype_to_text(newtype) + " geometry type: " + \
+				mmqgis_wkbtype_to_text(feature.geometry().wkbType())
+
+		if key in groups:
+			group = groups[key]
+			group[1].extend(parts)
+			if mergeattop == "Sum":
+				mmqgis_multipart_sum(group[0], attributes, fieldtypes)
+			continue
 
-			elif newtype == QGis.WKBMultiLineString:
-				newfeature.setGeometry(QgsGeometry.fromMultiPolyline(newgeometry))
+		if presorted:
+			for group in groups.values():
+				mmqgis_write_multipart(outfile, newtype, group[0], group[1])
+				merge_count = merge_count + 1
+			groups.clear()
 
-			else: # WKBMultiPolygon:
-				newfeature.setGeometry(QgsGeometry.fromMultiPolygon(newgeometry))
+		groups[key] = [attributes, parts]
 
-			outfile.addFeature(newfeature)
-			merge_count = merge_count + 1
+	for group in groups.values():
+		mmqgis_write_multipart(outfile, newtype, group[0], group[1])
+		merge_count = merge_count + 1
 
 	del outfile
 
@@ -3145,137 +4473,662 @@ def mmqgis_geometry_import_from_csv(qgis, node_filename, long_colname, lat_colna
 		elif (header[x] == shapeid_colname):
 			shapeid_col = x
 
-	if (lat_col < 0):
-		return "Invalid latitude column name: " + lat_colname
+	if (lat_col < 0):
+		return "Invalid latitude column name: " + lat_colname
+
+	if (long_col < 0):
+		return "Invalid longitude column name: " + long_colname
+
+	if (shapeid_col < 0):
+		return "Invalid shape ID column name: " + shapeid_colname
+
+	if (geometry_type == "Point"):
+		wkb_type = QGis.WKBPoint
+
+	elif (geometry_type == "Polyline"):
+		wkb_type = QGis.WKBLineString
+
+	elif (geometry_type == "Polygon"):
+		wkb_type = QGis.WKBPolygon
+	else:
+		return "Invalid geometry type: " + geometry_type
+
+	# Create the output shapefile
+	if QFile(shapefile_name).exists():
+		if not QgsVectorFileWriter.deleteShapeFile(shapefile_name):
+			return "Failure deleting existing shapefile: " + shapefile_name
+
+	if qgis.activeLayer():
+		crs = qgis.activeLayer().crs()
+	else:
+		crs = QgsCoordinateReferenceSystem()
+		crs.createFromSrid(4326) # WGS 84
+
+	fields = QgsFields()
+	fields.append(QgsField(shapeid_colname, QVariant.String))
+	if (geometry_type == "Point"):
+		for x in range(len(header)):
+			if ((x != lat_col) and (x != long_col) and (x != shapeid_col)):
+				fields.append(QgsField(header[x], QVariant.String))
+
+	outfile = QgsVectorFileWriter(shapefile_name, "utf-8", fields, wkb_type, crs)
+
+	if (outfile.hasError() != QgsVectorFileWriter.NoError):
+		return "Failure creating output shapefile: " + unicode(outfile.errorMessage())
+
+	polyline = []
+	node_count = 0
+	shape_count = 0
+	current_shape_id = False
+	reading = True
+	while reading:
+		try:
+			row = reader.next()
+		except:
+			reading = False
+
+		if reading and (len(row) > long_col) and (len(row) > lat_col) and (len(row) > shapeid_col) \
+				and mmqgis_is_float(row[long_col]) and mmqgis_is_float(row[lat_col]):
+			node_count += 1
+			if (node_count % 10) == 0:
+				mmqgis_status_message(qgis, "Importing node " + unicode(node_count))
+			point = QgsPoint(float(row[long_col]), float(row[lat_col]))
+		else:
+			point = False
+
+		if reading and (wkb_type != QGis.WKBPoint) and (row[shapeid_col] == current_shape_id):
+			polyline.append(point)
+
+		else:
+			#print str(wkb_type) + ": " + str(current_shape_id)
+			#print polyline
+
+			bad_feature = False
+			if wkb_type == QGis.WKBPoint:
+				if point:
+					geometry = QgsGeometry.fromPoint(point)
+					current_shape_id = row[shapeid_col]
+				else:
+					bad_feature = True
+
+			elif wkb_type == QGis.WKBLineString:
+				if len(polyline) < 2:
+					bad_feature = True
+				else:
+					geometry = QgsGeometry.fromPolyline(polyline)
+
+			elif wkb_type == QGis.WKBPolygon:
+				if len(polyline) < 3:
+					bad_feature = True
+				else:
+					# polyline[len(polyline) - 1] = polyline[0] # must close polygons
+					polygon = [ polyline ]
+					geometry = QgsGeometry.fromPolygon(polygon)
+
+			if not bad_feature:
+				# attributes = QgsAttributes()
+				# attributes = [ QVariant(str(current_shape_id)) ]
+				attributes = [ unicode(current_shape_id) ]
+				if (geometry_type == "Point"):
+					for x in range(len(header)):
+						if x >= len(row):
+							attributes.append("")
+
+						elif ((x != lat_col) and (x != long_col) and (x != shapeid_col)):
+							attributes.append(unicode(row[x], 'utf-8'))
+
+				#print attributes
+				newfeature = QgsFeature()
+				newfeature.setAttributes(attributes)
+				newfeature.setGeometry(geometry)
+				outfile.addFeature(newfeature)
+				shape_count += 1
+	
+			polyline = []
+			if reading and point:
+				current_shape_id = row[shapeid_col]
+				polyline.append(point)
+
+	del infile
+	del outfile
+
+	if addlayer:
+		qgis.addVectorLayer(shapefile_name, os.path.basename(shapefile_name), "ogr")
+		
+	mmqgis_completion_message(qgis, "Loaded " + unicode(shape_count) + " shapes (" + unicode(node_count) + " nodes)")
+
+	return None
+
+# --------------------------------------------------------
+#    mmqgis_grid - Grid shapefile creation
+# --------------------------------------------------------
+
+def mmqgis_grid(qgis, shapetype, crs, xspacing, yspacing, xleft, ybottom, xright, ytop, layer_name, savename, addlayer, mask_layer = None):
+
+	# Error Checks
+
+	if len(savename) <= 0:
+		return "No output filename given"
+
+	if (xspacing <= 0) or (yspacing <= 0):
+		return "Grid spacing must be positive: " + unicode(xspacing) + " x " + unicode(yspacing)
+
+	if (xleft >= xright):
+		return "Invalid extent width: " + unicode(xleft) + " - " + unicode(xright)
+	
+	if (ybottom >= ytop):
+		return "Invalid extent height: " + unicode(ybottom) + " - " + unicode(ytop)
+	
+	if (xspacing >= (xright - xleft)):
+		return "X spacing too wide for extent: " + unicode(xspacing)
+
+	if (yspacing >= (ytop - ybottom)):
+		return "Y spacing too tall for extent: " + unicode(yspacing)
+
+
+	# Without NumPy, cells are built one by one in mmqgis_grid_without_numpy()
+	if numpy == None:
+		if mask_layer != None:
+			return "NumPy is required to clip a grid to a mask layer"
+
+		return mmqgis_grid_without_numpy(qgis, shapetype, crs, xspacing, yspacing, xleft, ybottom, \
+			xright, ytop, layer_name, savename, addlayer)
+
+	# Fields containing coordinates
+
+	fields = QgsFields()
+	fields.append(QgsField("left", QVariant.Double, "real", 24, 16, "left"))
+	fields.append(QgsField("bottom", QVariant.Double, "real", 24, 16, "bottom"))
+	fields.append(QgsField("right", QVariant.Double, "real", 24, 16, "right"))
+	fields.append(QgsField("top", QVariant.Double, "real", 24, 16, "top"))
+
+
+	# Determine shapefile type
+
+	if (shapetype == "Points") or (shapetype == "Random Points"):
+		geometry_type = QGis.WKBPoint
+		
+	elif shapetype == "Lines":
+		geometry_type = QGis.WKBLineString
+
+	elif (shapetype == "Rectangles") or (shapetype == "Diamonds") or (shapetype == "Hexagons"):
+		geometry_type = QGis.WKBPolygon
+
+	else:
+		return "Invalid output shape type: " + unicode(shapetype)
+
+
+	# Mask polygon to clip cells to
+
+	mask = None
+	if mask_layer != None:
+		mask = mmqgis_grid_mask(mask_layer, crs)
+		if isinstance(mask, basestring):
+			return mask
+
+		mask_box = mmqgis_bounding_box(mask)
+
+
+	# Create output file
+
+	if QFile(savename).exists():
+		if not QgsVectorFileWriter.deleteShapeFile(savename):
+			return "Failure deleting existing shapefile: " + savename
+
+	outfile = QgsVectorFileWriter(savename, "utf-8", fields, geometry_type, crs)
+
+	if (outfile.hasError() != QgsVectorFileWriter.NoError):
+		return "Failure creating output shapefile: " + unicode(outfile.errorMessage())
+
+
+	# Cell vertices and WKB geometries are computed for a whole column at
+	# a time and the column's features are written as a batch
+
+	feature_count = 0
+	for column, (attributes, vertices) in enumerate(mmqgis_grid_columns(shapetype, \
+			xspacing, yspacing, xleft, ybottom, xright, ytop)):
+
+		if (column % 10) == 0:
+			mmqgis_status_message(qgis, "Column " + unicode(column) + ": " + \
+				unicode(feature_count) + " features")
+
+		# Only cells whose bounding box overlaps the mask need to be clipped
+		if mask != None:
+			inside = (vertices[:, :, 0].max(axis = 1) >= mask_box[0]) & \
+				(vertices[:, :, 1].max(axis = 1) >= mask_box[1]) & \
+				(vertices[:, :, 0].min(axis = 1) <= mask_box[2]) & \
+				(vertices[:, :, 1].min(axis = 1) <= mask_box[3])
+			attributes = attributes[inside]
+			vertices = vertices[inside]
+
+		batch = []
+		for attribute, wkb in zip(attributes.tolist(), mmqgis_wkb_array(geometry_type, vertices)):
+			geometry = QgsGeometry()
+			geometry.fromWkb(wkb)
+
+			if mask != None:
+				geometry = mmqgis_grid_clip(geometry, mask)
+				if geometry == None:
+					continue
+
+			feature = QgsFeature()
+			feature.setGeometry(geometry)
+			feature.setAttributes(attribute)
+			batch.append(feature)
+
+		for feature in batch:
+			outfile.addFeature(feature)
+
+		feature_count = feature_count + len(batch)
+
+	del outfile
+
+	if addlayer:
+		qgis.addVectorLayer(savename, os.path.basename(savename), "ogr")
+		
+	mmqgis_completion_message(qgis, unicode(feature_count) + " feature grid shapefile created")
+
+	return None
+
+
+# Cell coordinates for mmqgis_grid(), one column of cells at a time, in the same
+# order and with the same arithmetic as the cell by cell mmqgis_grid_without_numpy().
+# Yields numpy arrays of (left, bottom, right, top) attributes and cell vertices.
+
+def mmqgis_grid_columns(shapetype, xspacing, yspacing, xleft, ybottom, xright, ytop):
+	rows = int(ceil((ytop - ybottom) / yspacing))
+	columns = int(ceil((xright - xleft) / xspacing))
+
+	if shapetype == "Lines":
+		row = numpy.arange(rows + 1)
+		for column in range(0, columns + 1):
+			x1 = xleft + (column * xspacing)
+			x2 = xleft + ((column + 1) * xspacing)
+			y1 = ybottom + (row * yspacing)
+			y2 = ybottom + ((row + 1) * yspacing)
+
+			# Vertical lines except on the top row
+			vertical = mmqgis_grid_vertices(rows, [(x1, y1[0:rows]), (x1, y2[0:rows])])
+
+			if (column >= columns):
+				yield vertical.reshape((rows, 4)), vertical
+				continue
+
+			# Horizontal line followed by vertical line for each row
+			horizontal = mmqgis_grid_vertices(rows + 1, [(x1, y1), (x2, y1)])
+			vertices = numpy.empty(((rows * 2) + 1, 2, 2))
+			vertices[0::2] = horizontal
+			vertices[1::2] = vertical
+			yield vertices.reshape(((rows * 2) + 1, 4)), vertices
+
+	elif shapetype == "Rectangles":
+		row = numpy.arange(rows)
+		for column in range(0, columns):
+			x1 = xleft + (column * xspacing)
+			x2 = xleft + ((column + 1) * xspacing)
+			y1 = ybottom + (row * yspacing)
+			y2 = ybottom + ((row + 1) * yspacing)
+
+			yield mmqgis_grid_vertices(rows, [(x1, y1), (x2, y2)]).reshape((rows, 4)), \
+				mmqgis_grid_vertices(rows, [(x1, y1), (x2, y1), (x2, y2), (x1, y2), (x1, y1)])
+
+	elif (shapetype == "Points"):
+		row = numpy.arange(rows + 1)
+		for column in range(0, columns + 1):
+			x = xleft + (column * xspacing)
+			y = ybottom + (row * yspacing)
+
+			yield mmqgis_grid_vertices(rows + 1, [(x, y), (x, y)]).reshape((rows + 1, 4)), \
+				mmqgis_grid_vertices(rows + 1, [(x, y)])
+
+	elif (shapetype == "Random Points"):
+		row = numpy.arange(rows)
+		for column in range(0, columns):
+			x = xleft + (column * xspacing) + (numpy.random.random(rows) * xspacing)
+			y = ybottom + (row * yspacing) + (numpy.random.random(rows) * yspacing)
+
+			yield mmqgis_grid_vertices(rows, [(x, y), (x, y)]).reshape((rows, 4)), \
+				mmqgis_grid_vertices(rows, [(x, y)])
+
+	elif shapetype == "Diamonds":
+		row = numpy.arange(rows)
+		for column in range(0, (columns * 2) - 1):
+			x1 = xleft + ((column + 0) * (xspacing / 2))
+			x2 = xleft + ((column + 1) * (xspacing / 2))
+			x3 = xleft + ((column + 2) * (xspacing / 2))
+
+			offset = column % 2
+			y1 = ybottom + (((row * 2) + offset + 0) * (yspacing / 2))
+			y2 = ybottom + (((row * 2) + offset + 1) * (yspacing / 2))
+			y3 = ybottom + (((row * 2) + offset + 2) * (yspacing / 2))
+
+			yield mmqgis_grid_vertices(rows, [(x1, y1), (x3, y3)]).reshape((rows, 4)), \
+				mmqgis_grid_vertices(rows, [(x1, y2), (x2, y1), (x3, y2), (x2, y3), (x1, y2)])
+
+	elif shapetype == "Hexagons":
+		# To preserve symmetry, hspacing is fixed relative to vspacing
+		xvertexlo = 0.288675134594813 * yspacing;
+		xvertexhi = 0.577350269189626 * yspacing;
+		xspacing = xvertexlo + xvertexhi
+
+		rows = int(floor(float(ytop - ybottom) / yspacing))
+		row = numpy.arange(rows)
+		for column in range(0, int(floor(float(xright - xleft) / xspacing))):
+			x1 = xleft + (column * xspacing)	# far left
+			x2 = x1 + (xvertexhi - xvertexlo)	# left
+			x3 = xleft + ((column + 1) * xspacing)	# right
+			x4 = x3 + (xvertexhi - xvertexlo)	# far right
+
+			offset = column % 2
+			y1 = ybottom + (((row * 2) + offset + 0) * (yspacing / 2))	# hi
+			y2 = ybottom + (((row * 2) + offset + 1) * (yspacing / 2))	# mid
+			y3 = ybottom + (((row * 2) + offset + 2) * (yspacing / 2))	# lo
+
+			yield mmqgis_grid_vertices(rows, [(x1, y1), (x4, y3)]).reshape((rows, 4)), \
+				mmqgis_grid_vertices(rows, [(x1, y2), (x2, y1), (x3, y1), (x4, y2), \
+					(x3, y3), (x2, y3), (x1, y2)])
+
+# Array of count cells of vertices from a list of (x, y) where
+# each x and y is either a number or an array with a value per cell
+
+def mmqgis_grid_vertices(count, points):
+	vertices = numpy.empty((count, len(points), 2))
+	for index, (x, y) in enumerate(points):
+		vertices[:, index, 0] = x
+		vertices[:, index, 1] = y
+
+	return vertices
+
+# Union of the mask layer geometries in the grid CRS
+
+def mmqgis_grid_mask(layername, crs):
+	layer = mmqgis_find_layer(layername)
+	if layer == None:
+		return "Invalid mask layer: " + unicode(layername)
+
+	transform = None
+	if layer.crs() != crs:
+		transform = QgsCoordinateTransform(layer.crs(), crs)
+
+	mask = None
+	for feature in layer.getFeatures():
+		if feature.geometry() == None:
+			continue
+
+		geometry = QgsGeometry(feature.geometry())
+		if transform:
+			geometry.transform(transform)
+
+		if mask == None:
+			mask = geometry
+		else:
+			mask = mask.combine(geometry)
+
+	if mask == None:
+		return "No geometries in mask layer: " + unicode(layername)
+
+	return mask
+
+# Cell geometry clipped to the mask, or None if nothing of the same type is left
+
+def mmqgis_grid_clip(geometry, mask):
+	if not mask.intersects(geometry):
+		return None
+
+	if mask.contains(geometry):
+		return geometry
+
+	clipped = geometry.intersection(mask)
+	if (clipped == None) or (clipped.type() != geometry.type()):
+		return None
+
+	return clipped
+
+# Columns and cells per column written by mmqgis_grid(). Cell ids used by
+# mmqgis_grid_cell_index() are the order cells are written: (column * rows) + row.
+# Lines and random points have no fixed cells.
+
+def mmqgis_grid_dimensions(shapetype, xspacing, yspacing, xleft, ybottom, xright, ytop):
+	rows = int(ceil((ytop - ybottom) / yspacing))
+	columns = int(ceil((xright - xleft) / xspacing))
+
+	if shapetype == "Rectangles":
+		return columns, rows
+
+	elif shapetype == "Points":
+		return columns + 1, rows + 1
+
+	elif shapetype == "Diamonds":
+		return (columns * 2) - 1, rows
+
+	elif shapetype == "Hexagons":
+		xspacing = (0.288675134594813 + 0.577350269189626) * yspacing
+		return int(floor(float(xright - xleft) / xspacing)), int(floor(float(ytop - ybottom) / yspacing))
+
+	return None, None
+
+# Ids of the mmqgis_grid() cells containing the points in the x and y numpy arrays,
+# or -1 for points outside the grid. Computed arithmetically as the nearest cell
+# center on the unbounded tiling, so points on a shared edge go to either cell.
+# For "Points" grids, the id of the nearest grid point.
+
+def mmqgis_grid_cell_index(shapetype, xspacing, yspacing, xleft, ybottom, xright, ytop, x, y):
+	columns, rows = mmqgis_grid_dimensions(shapetype, xspacing, yspacing, xleft, ybottom, xright, ytop)
+	if columns == None:
+		return None
+
+	x = numpy.asarray(x, dtype = float)
+	y = numpy.asarray(y, dtype = float)
+
+	if shapetype == "Rectangles":
+		column = numpy.floor((x - xleft) / xspacing)
+		row = numpy.floor((y - ybottom) / yspacing)
+
+	elif shapetype == "Points":
+		column = numpy.floor(((x - xleft) / xspacing) + 0.5)
+		row = numpy.floor(((y - ybottom) / yspacing) + 0.5)
+
+	elif shapetype == "Diamonds":
+		# Diamond centers are at integer half-spacing coordinates (i, j) with
+		# i + j even. Rotated 45 degrees, each diamond is a square around
+		# the nearest even coordinates.
+		u = (x - xleft) / (xspacing / 2)
+		v = (y - ybottom) / (yspacing / 2)
+		p = 2 * numpy.floor(((u + v) / 2) + 0.5)
+		q = 2 * numpy.floor(((u - v) / 2) + 0.5)
+		column = ((p + q) / 2) - 1
+		row = (((p - q) / 2) - (column % 2) - 1) / 2
+
+	else: # Hexagons
+		# Hexagons are regular, so a point is in the hexagon with the nearest
+		# center, which is in one of the two columns around the point
+		radius = 0.577350269189626 * yspacing
+		xspacing = (0.288675134594813 + 0.577350269189626) * yspacing
+
+		for offset in [0, 1]:
+			candidate = numpy.floor((x - xleft - radius) / xspacing) + offset
+			parity = candidate % 2
+			candidate_row = numpy.floor((((((y - ybottom) / (yspacing / 2)) - parity - 1) / 2) + 0.5))
+			dx = x - (xleft + (candidate * xspacing) + radius)
+			dy = y - (ybottom + (((candidate_row * 2) + parity + 1) * (yspacing / 2)))
+			distance = (dx * dx) + (dy * dy)
+
+			if offset == 0:
+				column, row, nearest = candidate, candidate_row, distance
+			else:
+				closer = distance < nearest
+				column = numpy.where(closer, candidate, column)
+				row = numpy.where(closer, candidate_row, row)
+
+	inside = (column >= 0) & (column < columns) & (row >= 0) & (row < rows)
+	return numpy.where(inside, (column * rows) + row, -1).astype(numpy.int64)
+
+# --------------------------------------------------------
+#    mmqgis_grid_count - Count (and sum) points in each
+#		cell of an mmqgis_grid() grid
+# --------------------------------------------------------
+
+def mmqgis_grid_count(qgis, layername, sumfield, shapetype, crs, xspacing, yspacing, \
+		xleft, ybottom, xright, ytop, savename, addlayer):
 
-	if (long_col < 0):
-		return "Invalid longitude column name: " + long_colname
+	if numpy == None:
+		return "NumPy is required to count points in grid cells"
 
-	if (shapeid_col < 0):
-		return "Invalid shape ID column name: " + shapeid_colname
+	layer = mmqgis_find_layer(layername)
+	if layer == None:
+		return "Invalid point layer: " + unicode(layername)
 
-	if (geometry_type == "Point"):
-		wkb_type = QGis.WKBPoint
+	if layer.geometryType() != QGis.Point:
+		return "Layer " + unicode(layername) + " does not contain points"
 
-	elif (geometry_type == "Polyline"):
-		wkb_type = QGis.WKBLineString
+	sumindex = -1
+	if sumfield:
+		sumindex = layer.fieldNameIndex(sumfield)
+		if sumindex < 0:
+			return "Invalid sum field: " + unicode(sumfield)
 
-	elif (geometry_type == "Polygon"):
-		wkb_type = QGis.WKBPolygon
-	else:
-		return "Invalid geometry type: " + geometry_type
+	if len(savename) <= 0:
+		return "No output filename given"
 
-	# Create the output shapefile
-	if QFile(shapefile_name).exists():
-		if not QgsVectorFileWriter.deleteShapeFile(shapefile_name):
-			return "Failure deleting existing shapefile: " + shapefile_name
+	if (xspacing <= 0) or (yspacing <= 0):
+		return "Grid spacing must be positive: " + unicode(xspacing) + " x " + unicode(yspacing)
 
-	if qgis.activeLayer():
-		crs = qgis.activeLayer().crs()
+	if (xleft >= xright) or (ybottom >= ytop):
+		return "Invalid grid extent"
+
+	if shapetype == "Points":
+		geometry_type = QGis.WKBPoint
+	elif (shapetype == "Rectangles") or (shapetype == "Diamonds") or (shapetype == "Hexagons"):
+		geometry_type = QGis.WKBPolygon
 	else:
-		crs = QgsCoordinateReferenceSystem()
-		crs.createFromSrid(4326) # WGS 84
+		return "Points cannot be counted in " + unicode(shapetype) + " grids"
 
-	fields = QgsFields()
-	fields.append(QgsField(shapeid_colname, QVariant.String))
-	if (geometry_type == "Point"):
-		for x in range(len(header)):
-			if ((x != lat_col) and (x != long_col) and (x != shapeid_col)):
-				fields.append(QgsField(header[x], QVariant.String))
+	transform = None
+	if layer.crs() != crs:
+		transform = QgsCoordinateTransform(layer.crs(), crs)
+
+	# Count points in one pass, looking up cells for blocks of points at a time
+	totals = {}
+	def tally(x, y, values):
+		cells, inverse = numpy.unique(mmqgis_grid_cell_index(shapetype, xspacing, yspacing, \
+			xleft, ybottom, xright, ytop, x, y), return_inverse = True)
+		counts = numpy.bincount(inverse)
+		sums = numpy.bincount(inverse, weights = values)
+		for cell, count, total in zip(cells.tolist(), counts.tolist(), sums.tolist()):
+			if cell >= 0:
+				if cell in totals:
+					totals[cell][0] += count
+					totals[cell][1] += total
+				else:
+					totals[cell] = [count, total]
 
-	outfile = QgsVectorFileWriter(shapefile_name, "utf-8", fields, wkb_type, crs)
+	x = []
+	y = []
+	values = []
+	point_count = 0
+	for feature in layer.getFeatures():
+		geometry = feature.geometry()
+		if geometry == None:
+			continue
 
-	if (outfile.hasError() != QgsVectorFileWriter.NoError):
-		return "Failure creating output shapefile: " + unicode(outfile.errorMessage())
+		# Each point of a multipoint is counted, with the feature's sum field value
+		if (geometry.wkbType() == QGis.WKBMultiPoint) or (geometry.wkbType() == QGis.WKBMultiPoint25D):
+			points = geometry.asMultiPoint()
+		else:
+			points = [ geometry.asPoint() ]
 
-	polyline = []
-	node_count = 0
-	shape_count = 0
-	current_shape_id = False
-	reading = True
-	while reading:
-		try:
-			row = reader.next()
-		except:
-			reading = False
+		value = 0.0
+		if sumindex >= 0:
+			try:
+				value = float(feature.attributes()[sumindex])
+			except:
+				value = 0.0
 
-		if reading and (len(row) > long_col) and (len(row) > lat_col) and (len(row) > shapeid_col) \
-				and mmqgis_is_float(row[long_col]) and mmqgis_is_float(row[lat_col]):
-			node_count += 1
-			if (node_count % 10) == 0:
-				mmqgis_status_message(qgis, "Importing node " + unicode(node_count))
-			point = QgsPoint(float(row[long_col]), float(row[lat_col]))
-		else:
-			point = False
+		for point in points:
+			if transform:
+				point = transform.transform(point)
 
-		if reading and (wkb_type != QGis.WKBPoint) and (row[shapeid_col] == current_shape_id):
-			polyline.append(point)
+			x.append(point.x())
+			y.append(point.y())
+			values.append(value)
 
-		else:
-			#print str(wkb_type) + ": " + str(current_shape_id)
-			#print polyline
+		point_count += len(points)
+		if len(x) >= 100000:
+			mmqgis_status_message(qgis, "Counted " + unicode(point_count) + " points")
+			tally(x, y, values)
+			x = []
+			y = []
+			values = []
 
-			bad_feature = False
-			if wkb_type == QGis.WKBPoint:
-				if point:
-					geometry = QgsGeometry.fromPoint(point)
-					current_shape_id = row[shapeid_col]
-				else:
-					bad_feature = True
+	if len(x) > 0:
+		tally(x, y, values)
 
-			elif wkb_type == QGis.WKBLineString:
-				if len(polyline) < 2:
-					bad_feature = True
-				else:
-					geometry = QgsGeometry.fromPolyline(polyline)
+	# Write the cells with points in the order mmqgis_grid() writes them
+	fields = QgsFields()
+	fields.append(QgsField("left", QVariant.Double, "real", 24, 16, "left"))
+	fields.append(QgsField("bottom", QVariant.Double, "real", 24, 16, "bottom"))
+	fields.append(QgsField("right", QVariant.Double, "real", 24, 16, "right"))
+	fields.append(QgsField("top", QVariant.Double, "real", 24, 16, "top"))
+	fields.append(QgsField("count", QVariant.Int))
+	if sumindex >= 0:
+		fields.append(QgsField("sum", QVariant.Double, "real", 24, 8))
 
-			elif wkb_type == QGis.WKBPolygon:
-				if len(polyline) < 3:
-					bad_feature = True
-				else:
-					# polyline[len(polyline) - 1] = polyline[0] # must close polygons
-					polygon = [ polyline ]
-					geometry = QgsGeometry.fromPolygon(polygon)
+	if QFile(savename).exists():
+		if not QgsVectorFileWriter.deleteShapeFile(savename):
+			return "Failure deleting existing shapefile: " + savename
 
-			if not bad_feature:
-				# attributes = QgsAttributes()
-				# attributes = [ QVariant(str(current_shape_id)) ]
-				attributes = [ unicode(current_shape_id) ]
-				if (geometry_type == "Point"):
-					for x in range(len(header)):
-						if x >= len(row):
-							attributes.append("")
+	outfile = QgsVectorFileWriter(savename, "utf-8", fields, geometry_type, crs)
 
-						elif ((x != lat_col) and (x != long_col) and (x != shapeid_col)):
-							attributes.append(unicode(row[x], 'utf-8'))
+	if (outfile.hasError() != QgsVectorFileWriter.NoError):
+		return "Failure creating output shapefile: " + unicode(outfile.errorMessage())
 
-				#print attributes
-				newfeature = QgsFeature()
-				newfeature.setAttributes(attributes)
-				newfeature.setGeometry(geometry)
-				outfile.addFeature(newfeature)
-				shape_count += 1
-	
-			polyline = []
-			if reading and point:
-				current_shape_id = row[shapeid_col]
-				polyline.append(point)
+	columns, rows = mmqgis_grid_dimensions(shapetype, xspacing, yspacing, xleft, ybottom, xright, ytop)
+	cells = sorted(totals.keys())
+	next_cell = 0
+	for column, (attributes, vertices) in enumerate(mmqgis_grid_columns(shapetype, \
+			xspacing, yspacing, xleft, ybottom, xright, ytop)):
+		if next_cell >= len(cells):
+			break
+
+		if (cells[next_cell] // rows) != column:
+			continue
+
+		index = []
+		while (next_cell < len(cells)) and ((cells[next_cell] // rows) == column):
+			index.append(cells[next_cell] % rows)
+			next_cell += 1
+
+		for cell, attribute, wkb in zip(index, attributes[index].tolist(), \
+				mmqgis_wkb_array(geometry_type, vertices[index])):
+			geometry = QgsGeometry()
+			geometry.fromWkb(wkb)
+
+			total = totals[(column * rows) + cell]
+			attribute.append(total[0])
+			if sumindex >= 0:
+				attribute.append(total[1])
+
+			feature = QgsFeature()
+			feature.setGeometry(geometry)
+			feature.setAttributes(attribute)
+			outfile.addFeature(feature)
 
-	del infile
 	del outfile
 
 	if addlayer:
-		qgis.addVectorLayer(shapefile_name, os.path.basename(shapefile_name), "ogr")
-		
-	mmqgis_completion_message(qgis, "Loaded " + unicode(shape_count) + " shapes (" + unicode(node_count) + " nodes)")
+		qgis.addVectorLayer(savename, os.path.basename(savename), "ogr")
+
+	mmqgis_completion_message(qgis, unicode(point_count) + " points counted in " + \
+		unicode(len(cells)) + " grid cells")
 
 	return None
 
 # --------------------------------------------------------
-#    mmqgis_grid - Grid shapefile creation
+#    mmqgis_grid_without_numpy - Grid shapefile creation one cell at a time,
+#		used when NumPy is not installed
 # --------------------------------------------------------
 
-def mmqgis_grid(qgis, shapetype, crs, xspacing, yspacing, xleft, ybottom, xright, ytop, layer_name, savename, addlayer):
+def mmqgis_grid_without_numpy(qgis, shapetype, crs, xspacing, yspacing, xleft, ybottom, xright, ytop, layer_name, savename, addlayer):
 
 	# Error Checks
 
@@ -3689,8 +5542,7 @@ def mmqgis_hub_distance(qgis, sourcename, destname, nameattributename, units, ad
 	outfields.append(QgsField("HubName", QVariant.String))
 	outfields.append(QgsField("HubDist", QVariant.Double))
 
-	wgs84 = QgsCoordinateReferenceSystem()
-	wgs84.createFromProj4("+proj=longlat +datum=WGS84 +no_defs")
+	wgs84 = mmqgis_crs(mmqgis_wgs84_proj4)
 
 	outfile = QgsVectorFileWriter(savename, "utf-8", outfields, outputtype, wgs84)
 
@@ -3700,8 +5552,8 @@ def mmqgis_hub_distance(qgis, sourcename, destname, nameattributename, units, ad
 	# Distance calculations using mmqgis_distance() need 
 	# points in unprojected WGS 84 coordinates
 
-	htransform = QgsCoordinateTransform(hubslayer.crs(), wgs84)
-	stransform = QgsCoordinateTransform(sourcelayer.crs(), wgs84)
+	htransform = mmqgis_transform(hubslayer.crs(), mmqgis_wgs84_proj4)
+	stransform = mmqgis_transform(sourcelayer.crs(), mmqgis_wgs84_proj4)
 
 
 	# Create array of hubs in memory with WGS84 centroids and hub name
@@ -3776,13 +5628,49 @@ def mmqgis_hub_distance(qgis, sourcename, destname, nameattributename, units, ad
 				break
 
 		# Calculate actual distance
-		for x in range(0, len(lines)):
+		if (numpy != None) and (units != "Layer Units"):
+			distances = mmqgis_distances([ line[0].x() for line in lines ], [ line[0].y() for line in lines ], \
+				[ line[1].x() for line in lines ], [ line[1].y() for line in lines ]).tolist()
+			for x in range(0, len(lines)):
+				lines[x][4] = distances[x]
+
+		else:
+			for x in range(0, len(lines)):
+				if units == "Layer Units":
+					lines[x][4] = sqrt(pow(lines[x][0].x() - lines[x][1].x(), 2.0) + \
+						pow(lines[x][0].y() - lines[0][1].y(), 2.0))
+				else:
+					lines[x][4] = mmqgis_distance(lines[x][0], lines[x][1])
+
+
+	# Assign points to closest hub using distances from blocks of
+	# points to all hubs at once. argmin() picks the first of equally
+	# distant hubs, as the point-by-point search below does
+	elif numpy != None:
+		hub_x = numpy.array([ hub[0].x() for hub in hubs ])
+		hub_y = numpy.array([ hub[0].y() for hub in hubs ])
+		block_size = max(1, 1000000 / len(hubs))
+
+		for block_start in range(0, len(points), block_size):
+			mmqgis_status_message(qgis, "Creating line " + \
+				unicode(block_start) + " of " + unicode(len(points)))
+
+			block = points[block_start:block_start + block_size]
+			source_x = numpy.array([ source[0].x() for source in block ])[:, numpy.newaxis]
+			source_y = numpy.array([ source[0].y() for source in block ])[:, numpy.newaxis]
+
 			if units == "Layer Units":
-				lines[x][4] = sqrt(pow(lines[x][0].x() - lines[x][1].x(), 2.0) + \
-					pow(lines[x][0].y() - lines[0][1].y(), 2.0))
+				distances = numpy.sqrt(((source_x - hub_x) ** 2.0) + ((source_y - hub_y) ** 2.0))
 			else:
-				lines[x][4] = mmqgis_distance(lines[x][0], lines[x][1])
+				distances = mmqgis_distances(source_x, source_y, hub_x, hub_y)
 
+			closest = numpy.argmin(distances, axis = 1)
+			closest_distances = distances[numpy.arange(len(block)), closest].tolist()
+
+			for index, source in enumerate(block):
+				closest_index = closest[index]
+				lines.append([source[0], hubs[closest_index][0], source[1],
+					hubs[closest_index][1], closest_distances[index]])
 
 	# Assign points to closes hub (uneven distribution)
 	else:
@@ -3830,7 +5718,7 @@ def mmqgis_hub_distance(qgis, sourcename, destname, nameattributename, units, ad
 		elif units == "Kilometers":
 			hubdist = line[4] / 1000
 
-		elif units != "Meters": # Euclidian distance in layer units
+		else: # Meters or Euclidian distance in layer units
 			hubdist = line[4]
 
 		# Create feature
@@ -4068,9 +5956,7 @@ def mmqgis_kml_export(qgis, layername, nameattribute, description, exportdata, o
 
 
 	# Transform projection to WGS84 long/lat
-	wgs84 = QgsCoordinateReferenceSystem()
-	wgs84.createFromProj4("+proj=longlat +datum=WGS84 +no_defs")
-	transform = QgsCoordinateTransform(layer.crs(), wgs84)
+	transform = mmqgis_transform(layer.crs(), mmqgis_wgs84_proj4)
 
 	# Write features to KML
 	featurecount = 0
@@ -4269,11 +6155,89 @@ def mmqgis_kml_write_polygon(polygon, outfile):
 
 
 
+# Plan for copying a layer's attributes to the merged fields: a function per
+# output column that takes the source attributes and returns the output value.
+# Columns missing from the layer get a zero or blank default.
+
+def mmqgis_merge_plan(layer, fields):
+	sources = {}
+	for sindex, sfield in enumerate(layer.fields()):
+		if sfield.name().upper() not in sources:
+			sources[sfield.name().upper()] = (sindex, sfield)
+
+	plan = []
+	for dfield in fields:
+		if dfield.name().upper() in sources:
+			sindex, sfield = sources[dfield.name().upper()]
+			if (sfield.type() == dfield.type()):
+				plan.append(operator.itemgetter(sindex))
+
+			elif (dfield.type() == QVariant.String):
+				plan.append(lambda attributes, sindex = sindex: unicode(attributes[sindex]))
+
+			else:
+				return "Attribute " + unicode(sfield.name()) + \
+					" type mismatch " + sfield.typeName() + \
+					" != " + dfield.typeName()
+
+		elif (dfield.type() in [QVariant.Int, QVariant.UInt, QVariant.LongLong, QVariant.ULongLong]):
+			plan.append(lambda attributes: 0)
+
+		elif (dfield.type() == QVariant.Double):
+			plan.append(lambda attributes: 0.0)
+
+		else:
+			plan.append(lambda attributes: "")
+
+	return plan
+
+# Batches of features from a layer or feature source
+# with attributes mapped by mmqgis_merge_plan()
+
+def mmqgis_merge_batches(source, plan, size = 1000):
+	batch = []
+	for feature in source.getFeatures(QgsFeatureRequest()):
+		sattributes = feature.attributes()
+		feature.setAttributes([ column(sattributes) for column in plan ])
+		batch.append(feature)
+		if len(batch) >= size:
+			yield batch
+			batch = []
+
+	if len(batch) > 0:
+		yield batch
+
+# Worker thread for mmqgis_merge(): queues the batches from a layer's feature
+# source followed by None, or an error message in place of the remaining batches
+# if reading fails. Stops without queueing anything more once cancel is set.
+# QgsVectorLayer is not thread safe, so the QgsVectorLayerFeatureSource
+# must be created in the main thread.
+
+def mmqgis_merge_reader(source, layername, plan, queue, cancel):
+	def put(item):
+		while not cancel.is_set():
+			try:
+				queue.put(item, True, 0.1)
+				return True
+			except Queue.Full:
+				pass
+		return False
+
+	try:
+		for batch in mmqgis_merge_batches(source, plan):
+			if not put(batch):
+				return
+
+	except Exception, e:
+		put("Failure reading " + unicode(layername) + ": " + unicode(e))
+
+	put(None)
+
 # --------------------------------------------------------
 #    mmqgis_merge - Merge layers to single shapefile
 # --------------------------------------------------------
 
-def mmqgis_merge(qgis, layernames, savename, addlayer):
+def mmqgis_merge(qgis, layernames, savename, addlayer, workers = 1):
 	layers = []
 	field_list = []
 	totalfeaturecount = 0
@@ -4341,52 +6305,51 @@ def mmqgis_merge(qgis, layernames, savename, addlayer):
 	if (outfile.hasError() != QgsVectorFileWriter.NoError):
 		return "Failure creating output shapefile: " + unicode(outfile.errorMessage())
 
-	# Copy layer features to output file
-	featurecount = 0
+	# Column mapping from each layer's fields to the output fields
+	plans = []
 	for layer in layers:
-		for feature in layer.getFeatures():
-			sattributes = feature.attributes()
-			dattributes = []
-			for dindex, dfield in enumerate(fields):
-				# dattribute = QVariant(dfield.type())
-				# print str(dindex) + ": " + str(dfield.type())
-
-				if (dfield.type() in [QVariant.Int, QVariant.UInt, QVariant.LongLong, QVariant.ULongLong]):
-					dattribute = 0
-
-				elif (dfield.type() == QVariant.Double):
-					dattribute = 0.0
-
-				else:
-					dattribute = ""
-
-				for sindex, sfield in enumerate(layer.fields()):
-					if (sfield.name().upper() == dfield.name().upper()):
-						if (sfield.type() == dfield.type()):
-							dattribute = sattributes[sindex]
-
-						elif (dfield.type() == QVariant.String):
-							dattribute = unicode(sattributes[sindex])
-
-						else:
-							return "Attribute " + unicode(sfield.name()) + \
-								" type mismatch " + sfield.typeName() + \
-								" != " + dfield.typeName()
-						break
+		plan = mmqgis_merge_plan(layer, fields)
+		if isinstance(plan, basestring):
+			return plan
+		plans.append(plan)
+
+	# Layers are read in worker threads, each feeding a bounded queue of
+	# mapped feature batches that is written in layer order
+	pool = None
+	if workers > 1:
+		pool = ThreadPool(workers)
+		cancel = threading.Event()
+		queues = [ Queue.Queue(16) for layer in layers ]
+		for layer, plan, queue in zip(layers, plans, queues):
+			pool.apply_async(mmqgis_merge_reader, (QgsVectorLayerFeatureSource(layer), \
+				layer.name(), plan, queue, cancel))
+		batches = itertools.chain(*[ iter(queue.get, None) for queue in queues ])
+	else:
+		batches = itertools.chain(*[ mmqgis_merge_batches(layer, plan) \
+			for layer, plan in zip(layers, plans) ])
 
-				dattributes.append(dattribute)
+	# Copy layer features to output file. Readers are stopped
+	# however writing ends, so none are left waiting on a full queue
+	featurecount = 0
+	try:
+		for batch in batches:
+			if isinstance(batch, basestring):
+				return batch
 
-			#for dindex, dfield in dattributes.iteritems():
-			#	print layer.name() + " (" + str(dindex) + ") " + str(dfield.toString())
+			for feature in batch:
+				outfile.addFeature(feature)
+				featurecount += 1
+				if (featurecount % 1000) == 0:
+					mmqgis_status_message(qgis, "Writing feature " + \
+						unicode(featurecount) + " of " + unicode(totalfeaturecount))
 
-			feature.setAttributes(dattributes)
-			outfile.addFeature(feature)
-			featurecount += 1
-			if (featurecount % 50) == 0:
-				mmqgis_status_message(qgis, "Writing feature " + \
-					unicode(featurecount) + " of " + unicode(totalfeaturecount))
+	finally:
+		if pool:
+			cancel.set()
+			pool.close()
+			pool.join()
 
-	del outfile
+		del outfile
 
 	# Add the merged layer to the project
 	if addlayer:
@@ -4429,8 +6392,6 @@ def mmqgis_points(qgis, savename, hspacing, vspacing, hoffset, voffset, extent,
 
 	columns = int(floor((right - left) / hspacing)) + 1
 	rows = int(floor((top - bottom) / vspacing)) + 1
-	if (columns * rows) > 1048576:
-		return "Given dimensions will create over 1 million points"
 
 
 	# Create the output point shapefile
@@ -4453,32 +6414,78 @@ def mmqgis_points(qgis, savename, hspacing, vspacing, hoffset, voffset, extent,
 		return "Failure creating output shapefile: " + unicode(outfile.errorMessage())
 
 
-	# Scan the grid and insert points
+	# Polygon edges as (xmin, xmax, x1, y1, x2, y2, polygon index) sorted
+	# by xmin so each column only checks the edges that span it
+	edges = []
+	if polygons != None:
+		for index, polygon in enumerate(polygons.getFeatures()):
+			if polygon.geometry() == None:
+				continue
+
+			wkbtype, parts = mmqgis_geometry_parts(polygon.geometry())
+			if parts == None:
+				continue
+
+			vertices, segments = mmqgis_geometry_segments(wkbtype, parts)
+			for x1, y1, x2, y2 in segments:
+				if x1 != x2:
+					edges.append((min(x1, x2), max(x1, x2), x1, y1, x2, y2, index))
+
+		edges.sort()
+
+	# Scan the grid column by column and insert points as they are found.
+	# With bounding polygons, the rows inside each polygon are found from
+	# the crossings of the column with the polygon edges (even-odd rule)
 	point_id = 0
+	next_edge = 0
+	active = []
 
 	for column in range(0, columns):
-		for row in range(0, rows):
-			x = left + (column * hspacing)
-			y = bottom + (row * vspacing)
-			point = QgsPoint(x, y)
-
-			# Check if within polygon when bounding polygons are given
-			polygon_id = -1
-			if polygons != None:
-				for index, polygon in enumerate(polygons.getFeatures()):
-					if polygon.geometry().contains(point):
-						polygon_id = index
-						break
+		x = left + (column * hspacing)
+		if (column % 100) == 0:
+			mmqgis_status_message(qgis, "Column " + unicode(column) + " of " + unicode(columns))
+
+		if polygons == None:
+			inside = [ (row, -1) for row in range(0, rows) ]
 
-			# Add point to output shapefile
-			if (polygons == None) or (polygon_id >= 0):
-				point_id = point_id + 1
-				attributes = [ point_id, polygon_id, x, y ]
+		else:
+			while (next_edge < len(edges)) and (edges[next_edge][0] <= x):
+				active.append(edges[next_edge])
+				next_edge += 1
+			active = [ edge for edge in active if edge[1] >= x ]
+
+			crossings = {}
+			for xmin, xmax, x1, y1, x2, y2, index in active:
+				if (x1 <= x < x2) or (x2 <= x < x1):
+					y = y1 + ((x - x1) * (y2 - y1) / (x2 - x1))
+					if index in crossings:
+						crossings[index].append(y)
+					else:
+						crossings[index] = [y]
+
+			# The first polygon containing a point claims it
+			claimed = {}
+			for index in sorted(crossings.keys()):
+				ylist = sorted(crossings[index])
+				for z in range(0, len(ylist) - 1, 2):
+					first = max(0, int(floor((ylist[z] - bottom) / vspacing)))
+					last = min(rows - 1, int(ceil((ylist[z + 1] - bottom) / vspacing)))
+					for row in range(first, last + 1):
+						y = bottom + (row * vspacing)
+						if (ylist[z] < y < ylist[z + 1]) and (row not in claimed):
+							claimed[row] = index
+
+			inside = sorted(claimed.items())
+
+		for row, polygon_id in inside:
+			y = bottom + (row * vspacing)
+			point_id = point_id + 1
+			attributes = [ point_id, polygon_id, x, y ]
 
-				feature = QgsFeature()
-				feature.setGeometry(QgsGeometry.fromPoint(point))
-				feature.setAttributes(attributes)
-				outfile.addFeature(feature)
+			feature = QgsFeature()
+			feature.setGeometry(QgsGeometry.fromPoint(QgsPoint(x, y)))
+			feature.setAttributes(attributes)
+			outfile.addFeature(feature)
 				
 	del outfile
 
@@ -4739,17 +6746,30 @@ def mmqgis_select(qgis, layername, attributes, comparisons, values, savename, ad
 #    mmqgis_sort - Sort shapefile by attribute
 # --------------------------------------------------------
 
-def mmqgis_sort(qgis, layername, sortattributename, savename, direction, addlayer):
+def mmqgis_sort(qgis, layername, sortattributename, savename, direction, addlayer, memory_rows = 0):
 	layer = mmqgis_find_layer(layername)
 	if layer == None:
 		return "Project has no active vector layer to sort"
 
-	sortindex = layer.fieldNameIndex(sortattributename)
-	if sortindex < 0:
-		return "Invalid sort field name: " + sortattributename
-	
-	# print  "sortindex = " + str(sortindex)
+	# Multiple sort keys are given as lists of names and directions
+	if isinstance(sortattributename, basestring):
+		sortattributename = [ sortattributename ]
+
+	if isinstance(direction, basestring):
+		direction = [ direction ] * len(sortattributename)
+
+	if (len(sortattributename) <= 0) or (len(direction) != len(sortattributename)):
+		return "Each sort field needs a sort direction"
+
+	sortindices = []
+	for name in sortattributename:
+		sortindex = layer.fieldNameIndex(name)
+		if sortindex < 0:
+			return "Invalid sort field name: " + name
+		sortindices.append(sortindex)
 
+	descending = [ (x.lower() == "descending") for x in direction ]
+	
 	if len(savename) <= 0:
 		return "No output filename given"
 
@@ -4762,32 +6782,53 @@ def mmqgis_sort(qgis, layername, sortattributename, savename, direction, addlaye
 	if (outfile.hasError() != QgsVectorFileWriter.NoError):
 		return "Failure creating output shapefile: " + unicode(outfile.errorMessage())
 
-	table = []
+	# Records carry the whole feature so the sorted output can be written
+	# sequentially. The read index breaks ties so equal keys keep their order.
+	# Runs spilled to disk when memory_rows > 0 hold WKB and attributes
+	# converted to values that can be pickled.
+	table = mmqgis_external_sorter(memory_rows)
 	for index, feature in enumerate(layer.getFeatures()):
 
-		if (index % 50) == 0:
+		if (index % 1000) == 0:
 			mmqgis_status_message(qgis, "Reading feature " + unicode(feature.id()))
 
-		record = feature.id(), feature.attributes()[sortindex]
+		attributes = feature.attributes()
+		if memory_rows > 0:
+			attributes = [ mmqgis_pickle_value(value) for value in attributes ]
 
-		table.append(record)
+		key = []
+		for sortindex, reverse in zip(sortindices, descending):
+			if reverse:
+				key.append(mmqgis_descending(attributes[sortindex]))
+			else:
+				key.append(attributes[sortindex])
 
-	if (direction.lower() == "descending"):
-		table.sort(key = operator.itemgetter(1), reverse=True)
-	else:
-		table.sort(key = operator.itemgetter(1))
+		if memory_rows > 0:
+			geometry = feature.geometry()
+			if geometry != None:
+				geometry = geometry.exportToWkb()
+			table.add((key, index, attributes, geometry))
+		else:
+			table.add((key, index, feature))
 
 	writecount = 0
-	for index, record in enumerate(table):
-		# feature = QgsFeature()
-		# layer.featureAtId(record[0], feature)
-		feature = mmqgis_feature_at_id(layer, record[0])
+	for record in table.sorted():
+		if memory_rows > 0:
+			feature = QgsFeature()
+			feature.setAttributes([ mmqgis_unpickle_value(value) for value in record[2] ])
+			if record[3] != None:
+				geometry = QgsGeometry()
+				geometry.fromWkb(record[3])
+				feature.setGeometry(geometry)
+		else:
+			feature = record[2]
+
 		outfile.addFeature(feature)
 		writecount += 1
 
-		if (index % 50) == 0:
+		if (writecount % 1000) == 0:
 			mmqgis_status_message(qgis, "Writing feature " + unicode(writecount) +\
-				" of " + unicode(len(table)))
+				" of " + unicode(table.count))
 
 	del outfile
 
@@ -4798,6 +6839,51 @@ def mmqgis_sort(qgis, layername, sortattributename, savename, direction, addlaye
 
 	return None
 
+# Sort key wrapper that reverses the order of a value so keys
+# with mixed directions can be sorted and merged in one pass
+
+class mmqgis_descending:
+	def __init__(self, value):
+		self.value = value
+
+	def __cmp__(self, other):
+		return cmp(other.value, self.value)
+
+# NULL and Qt date and time attribute values may not pickle, so they are
+# stored on disk as tagged tuples. Dates and times keep their order
+# (as day and millisecond numbers) so the tuples can still be sort keys
+
+def mmqgis_pickle_value(value):
+	if type(value) == QPyNullVariant:
+		return ("NULL", int(value.type()))
+
+	elif type(value) == QDate:
+		return ("QDate", value.toJulianDay())
+
+	elif type(value) == QTime:
+		return ("QTime", QTime(0, 0).msecsTo(value))
+
+	elif type(value) == QDateTime:
+		return ("QDateTime", value.date().toJulianDay(), \
+			QTime(0, 0).msecsTo(value.time()), int(value.timeSpec()))
+
+	return value
+
+def mmqgis_unpickle_value(value):
+	if type(value) != tuple:
+		return value
+
+	elif value[0] == "NULL":
+		return QPyNullVariant(QVariant.Type(value[1]))
+
+	elif value[0] == "QDate":
+		return QDate.fromJulianDay(value[1])
+
+	elif value[0] == "QTime":
+		return QTime(0, 0).addMSecs(value[1])
+
+	return QDateTime(QDate.fromJulianDay(value[1]), QTime(0, 0).addMSecs(value[2]), Qt.TimeSpec(value[3]))
+
 # ----------------------------------------------------------
 #    mmqgis_spatial_join - Spatial Join
 # ----------------------------------------------------------
@@ -4869,6 +6955,31 @@ def mmqgis_spatial_join(qgis, targetname, spatialop, joinname, fields, fieldop,
 	if (outfile.hasError() != QgsVectorFileWriter.NoError):
 		return "Failure creating output shapefile: " + unicode(outfile.errorMessage())
 
+	# Reproject the join features once and index their bounding boxes so
+	# each target feature is only tested against join features it might touch
+	join_geometries = []
+	join_attributes = []
+	join_boxes = []
+	join_feature_count = join_layer.featureCount()
+	for join_index, join_feature in enumerate(join_layer.getFeatures()):
+		if (join_index % 1000) == 0:
+			mmqgis_status_message(qgis, "Indexing join feature " + unicode(join_index) + \
+				" of " + unicode(join_feature_count))
+
+		if join_feature.geometry() == None:
+			continue
+
+		# Copy because the feature owns the geometry it returns
+		join_geometry = QgsGeometry(join_feature.geometry())
+		if transform:
+			join_geometry.transform(transform)
+
+		join_geometries.append(join_geometry)
+		join_attributes.append(join_feature.attributes())
+		join_boxes.append(mmqgis_bounding_box(join_geometry))
+
+	join_grid = mmqgis_spatial_grid(join_boxes)
+
 	# Interate through target features
 	target_count = 0
 	feature_count = target_layer.featureCount()
@@ -4889,12 +7000,10 @@ def mmqgis_spatial_join(qgis, targetname, spatialop, joinname, fields, fieldop,
 			else:
 				attributes.append(0) # count
 
-		# Iterate through join features
+		# Iterate through join features with overlapping bounding boxes
 		join_count = 0
-		for join_index, join_feature in enumerate(join_layer.getFeatures()):
-			join_geometry = join_feature.geometry()
-			if transform:
-				join_geometry.transform(transform)
+		for join_index in join_grid.candidates(mmqgis_bounding_box(target_geometry)):
+			join_geometry = join_geometries[join_index]
 			
 			if ((spatialop == 'Intersects') and (not target_geometry.intersects(join_geometry))) or \
 			   ((spatialop == 'Within') and (not target_geometry.within(join_geometry))) or \
@@ -4908,7 +7017,7 @@ def mmqgis_spatial_join(qgis, targetname, spatialop, joinname, fields, fieldop,
 				if field[0] != join_layer:
 					continue
 
-				attribute = join_feature.attributes()[field[1]]
+				attribute = join_attributes[join_index][field[1]]
 
 				# print "   " + fieldop + ": " + unicode(dest_index) + " = join " + unicode(field[1])
 
@@ -4931,7 +7040,7 @@ def mmqgis_spatial_join(qgis, targetname, spatialop, joinname, fields, fieldop,
 						else:
 							target_value = float(attributes[dest_index])
 
-						join_value = float(join_feature.attributes()[field[1]])
+						join_value = float(join_attributes[join_index][field[1]])
 						attributes[dest_index] = target_value + (ratio * join_value)
 						# print "Join " + unicode(attributes[dest_index]) + " = " + \
 						#	unicode(target_value) + " + (" + unicode(ratio) + \
@@ -5104,164 +7213,15 @@ def mmqgis_voronoi_diagram(qgis, sourcelayer, savename, addlayer):
 	if (len(points) < 3):
 		return "Too few points to create diagram"
 
-	for point_number, center in enumerate(points):
-	# for center in [ points[17] ]:
-		# print "\nCenter, " + str(center[0]) + ", " + str(center[1])
-		if (point_number % 20) == 0:
-			#mmqgis_status_message(qgis, "Processing point " + \
-			#	unicode(center[0]) + ", " + unicode(center[1]))
-			mmqgis_status_message(qgis, "Processing point " + unicode(point_number) + " of " + unicode(len(points)))
-
-		# Borders are tangents to midpoints between all neighbors
-		tangents = []
-		for neighbor in points:
-			border = mmqgis_voronoi_line((center[0] + neighbor[0]) / 2.0, (center[1] + neighbor[1]) / 2.0)
-			if ((neighbor[0] != center[0]) or (neighbor[1] != center[1])):
-				tangents.append(border)
-
-		# Add edge intersections to clip to extent of points
-		offset = (xmax - xmin) * 0.01
-		tangents.append(mmqgis_voronoi_line(xmax + offset, center[1]))
-		tangents.append(mmqgis_voronoi_line(center[0], ymax + offset))
-		tangents.append(mmqgis_voronoi_line(xmin - offset, center[1]))
-		tangents.append(mmqgis_voronoi_line(center[0], ymin - offset))
-		#print "Extent x = " + str(xmax) + " -> " + str(xmin) + ", y = " + str(ymax) + " -> " + str(ymin)
-
-		# Find vector distance and angle to border from center point
-		for scan in range(0, len(tangents)):
-			run = tangents[scan].x - center[0]
-			rise = tangents[scan].y - center[1]
-			tangents[scan].distance = sqrt((run * run) + (rise * rise))
-			if (tangents[scan].distance <= 0):
-				tangents[scan].angle = 0
-			elif (tangents[scan].y >= center[1]):
-				tangents[scan].angle = acos(run / tangents[scan].distance)
-			elif (tangents[scan].y < center[1]):
-				tangents[scan].angle = (2 * pi) - acos(run / tangents[scan].distance)
-			elif (tangents[scan].x > center[0]):
-				tangents[scan].angle = pi / 2.0
-			else:
-				tangents[scan].angle = 3 * pi / 4
-
-			#print "  Tangent, " + str(tangents[scan].x) + ", " + str(tangents[scan].y) + \
-			#	", angle " + str(tangents[scan].angle * 180 / pi) + ", distance " + \
-			#	str(tangents[scan].distance)
-
-
-		# Find the closest line - guaranteed to be a border
-		closest = -1
-		for scan in range(0, len(tangents)):
-			if ((closest == -1) or (tangents[scan].distance < tangents[closest].distance)):
-				closest = scan
-
-		# Use closest as the first border
-		border = mmqgis_voronoi_line(tangents[closest].x, tangents[closest].y)
-		border.angle = tangents[closest].angle
-		border.distance = tangents[closest].distance
-		borders = [ border ]
-
-		#print "  Border 0) " + str(closest) + " of " + str(len(tangents)) + ", " \
-		#	+ str(border.x) + ", " + str(border.y) \
-		#	+ ", (angle " + str(border.angle * 180 / pi) + ", distance " \
-		#	+ str(border.distance) + ")"
-
-		# Work around the tangents in a CCW circle
-		circling = 1
-		while circling:
-			next = -1
-			scan = 0
-			while (scan < len(tangents)):
-				anglebetween = tangents[scan].angle - borders[len(borders) - 1].angle
-				if (anglebetween < 0):
-					anglebetween += (2 * pi)
-				elif (anglebetween > (2 * pi)):
-					anglebetween -= (2 * pi)
-
-				#print "    Scanning " + str(scan) + " of " + str(len(borders)) + \
-				#	", " + str(tangents[scan].x) + ", " + str(tangents[scan].y) + \
-				#	", angle " + str(tangents[scan].angle * 180 / pi) + \
-				#	", anglebetween " + str(anglebetween * 180 / pi)
-
-				# If border intersects to the left
-				if (anglebetween < pi) and (anglebetween > 0):
-					# A typo here with a reversed slash cost 8/13/2009 debugging
-					tangents[scan].iangle = atan2( (tangents[scan].distance / 
-						borders[len(borders) - 1].distance) \
-						- cos(anglebetween), sin(anglebetween))
-					tangents[scan].idistance = borders[len(borders) - 1].distance \
-						/ cos(tangents[scan].iangle)
-
-					tangents[scan].iangle += borders[len(borders) - 1].angle
-
-					# If the rightmost intersection so far, it's a candidate for next border
-					if (next < 0) or (tangents[scan].iangle < tangents[next].iangle):
-						# print "      Take idistance " + str(tangents[scan].idistance)
-						next = scan
-
-				scan += 1
-
-			# iangle/distance are for intersection of border with next border
-			borders[len(borders) - 1].iangle = tangents[next].iangle
-			borders[len(borders) - 1].idistance = tangents[next].idistance
-
-			# Stop circling if back to the beginning
-			if (borders[0].x == tangents[next].x) and (borders[0].y == tangents[next].y):
-				circling = 0
+	mmqgis_status_message(qgis, "Sweeping " + unicode(len(points)) + " points")
 
-			else:
-				# Add the next border
-				border = mmqgis_voronoi_line(tangents[next].x, tangents[next].y)
-				border.angle = tangents[next].angle
-				border.distance = tangents[next].distance
-				border.iangle = tangents[next].iangle
-				border.idistance = tangents[next].idistance
-				borders.append(border)
-				#print "  Border " + str(len(borders) - 1) + \
-				#	") " + str(next) + ", " + str(border.x) + \
-				#	", " + str(border.y) + ", angle " + str(border.angle * 180 / pi) +\
-				#	", iangle " + str(border.iangle * 180 / pi) +\
-				#	", idistance " + str(border.idistance) + "\n"
-
-			# Remove the border from the list so not repeated
-			tangents.pop(next)
-			if (len(tangents) <= 0):
-				circling = 0
-
-		polygon = []
-		if len(borders) >= 3:
-			for border in borders:
-				ix = center[0] + (border.idistance * cos(border.iangle))
-				iy = center[1] + (border.idistance * sin(border.iangle))
-				#print "  Node, " + str(ix) + ", " + str(iy) + \
-				#	", angle " + str(border.angle * 180 / pi) + \
-				#	", iangle " + str(border.iangle * 180 / pi) + \
-				#	", idistance " + str(border.idistance) + ", from " \
-				#	+ str(border.x) + ", " + str(border.y)
-				polygon.append(QgsPoint(ix, iy))
-
-			#print "Polygon " + unicode(point_number)
-			#for x in range(0, len(polygon)):
-			#	print "  Point " + unicode(polygon[x].x()) + ", " + unicode(polygon[x].y())
-
-			# Remove duplicate nodes
-			# Compare as strings (unicode) to avoid odd precision discrepancies
-			# that sometimes cause duplicate points to be unrecognized
-			dup = 0
-			while (dup < (len(polygon) - 1)):
-				if (unicode(polygon[dup].x()) == unicode(polygon[dup + 1].x())) and \
-				   (unicode(polygon[dup].y()) == unicode(polygon[dup + 1].y())):
-					polygon.pop(dup)
-					# print "  Removed duplicate node " + unicode(dup) + \
-					#	" in polygon " + unicode(point_number)
-				else:
-					# print "  " + unicode(polygon[dup].x()) + ", " + \
-					#	unicode(polygon[dup].y()) + " != " + \
-					#	unicode(polygon[dup + 1].x()) + ", " + \
-					#	unicode(polygon[dup + 1].y())
-					dup = dup + 1
+	cells = mmqgis_voronoi_cells(points, xmin, ymin, xmax, ymax)
 
-			# attributes = { 0:QVariant(center[0]), 1:QVariant(center[1]) }
+	for point_number, center in enumerate(points):
+		if (point_number % 1000) == 0:
+			mmqgis_status_message(qgis, "Writing polygon " + unicode(point_number) + " of " + unicode(len(points)))
 
+		polygon = cells[point_number]
 		if len(polygon) >= 3:
 			geometry = QgsGeometry.fromPolygon([ polygon ])
 			feature = QgsFeature()
@@ -5278,6 +7238,213 @@ def mmqgis_voronoi_diagram(qgis, sourcelayer, savename, addlayer):
 
 	return None
 
+# Builds the Voronoi cell of every point as the padded extent rectangle
+# clipped by the bisectors to its neighbors. Neighbors come from the
+# O(n log n) sweep in voronoi.py, so each cell only needs to be clipped
+# by a handful of half-planes rather than by every other point.
+# Returns one list of QgsPoint nodes per point (in the order of points)
+
+def mmqgis_voronoi_cells(points, xmin, ymin, xmax, ymax):
+	# Duplicate points share a cell and would give the sweep a zero-length bisector
+	sites = []
+	site_numbers = []
+	site_index = {}
+	for point in points:
+		key = (point[0], point[1])
+		if key not in site_index:
+			site_index[key] = len(sites)
+			sites.append(QgsPoint(point[0], point[1]))
+		site_numbers.append(site_index[key])
+
+	neighbors = [ [] for site in sites ]
+	if len(sites) >= 2:
+		for left, right in computeVoronoiNeighbors(sites):
+			neighbors[left].append(right)
+			neighbors[right].append(left)
+
+	# Clip to the extent of the points plus a one percent margin
+	offset = (xmax - xmin) * 0.01
+	extent = [ (xmax + offset, ymin - offset), (xmax + offset, ymax + offset), \
+		(xmin - offset, ymax + offset), (xmin - offset, ymin - offset) ]
+
+	cells = []
+	for site_number, site in enumerate(sites):
+		polygon = extent
+		for neighbor in neighbors[site_number]:
+			polygon = mmqgis_voronoi_clip(polygon, site, sites[neighbor])
+			if len(polygon) <= 0:
+				break
+
+		# Remove duplicate nodes
+		# Compare as strings (unicode) to avoid odd precision discrepancies
+		# that sometimes cause duplicate points to be unrecognized
+		nodes = []
+		for x, y in polygon:
+			node = QgsPoint(x, y)
+			if (len(nodes) > 0) and (unicode(nodes[-1].x()) == unicode(x)) and \
+			   (unicode(nodes[-1].y()) == unicode(y)):
+				continue
+			nodes.append(node)
+
+		cells.append(nodes)
+
+	return [ cells[site_number] for site_number in site_numbers ]
+
+# Sutherland-Hodgman clip of a convex polygon (list of x, y tuples) to the half
+# of the plane on the center side of the bisector between center and neighbor
+
+def mmqgis_voronoi_clip(polygon, center, neighbor):
+	dx = neighbor.x() - center.x()
+	dy = neighbor.y() - center.y()
+	limit = ((dx * dx) + (dy * dy)) / 2.0
+
+	clipped = []
+	x1, y1 = polygon[-1]
+	d1 = ((x1 - center.x()) * dx) + ((y1 - center.y()) * dy) - limit
+	for x2, y2 in polygon:
+		d2 = ((x2 - center.x()) * dx) + ((y2 - center.y()) * dy) - limit
+		if (d1 <= 0) != (d2 <= 0):
+			ratio = d1 / (d1 - d2)
+			clipped.append((x1 + ((x2 - x1) * ratio), y1 + ((y2 - y1) * ratio)))
+		if (d2 <= 0):
+			clipped.append((x2, y2))
+		x1, y1, d1 = x2, y2, d2
+
+	return clipped
+
+# External merge sort for more records than will fit in memory. Records
+# are sorted in runs of max_records that are spilled to temporary files,
+# then the runs are merged. Records must be picklable and are sorted by
+# their natural (tuple) ordering. A max_records of zero never spills.
+
+class mmqgis_external_sorter:
+	def __init__(self, max_records):
+		self.max_records = max_records
+		self.records = []
+		self.levels = []
+		self.count = 0
+
+	# Most runs open at once
+	fan_in = 64
+
+	def add(self, record):
+		self.records.append(record)
+		self.count += 1
+		if (self.max_records > 0) and (len(self.records) >= self.max_records):
+			self.add_run(0, self.spill(sorted(self.records)))
+			self.records = []
+
+	def add_run(self, level, run):
+		# Runs are kept by level. Runs at level n hold fan_in ** n spills,
+		# and fan_in runs of one level merge into one run of the next,
+		# so each record is only written again once per level
+		while len(self.levels) <= level:
+			self.levels.append([])
+
+		self.levels[level].append(run)
+		if len(self.levels[level]) >= self.fan_in:
+			runs = self.levels[level]
+			self.levels[level] = []
+			self.add_run(level + 1, self.spill(self.merge(runs)))
+
+	def merge(self, runs):
+		return heapq.merge(*[ self.read(run) for run in runs ])
+
+	def spill(self, records):
+		run = tempfile.TemporaryFile()
+		for record in records:
+			cPickle.dump(record, run, cPickle.HIGHEST_PROTOCOL)
+		run.seek(0)
+		return run
+
+	def read(self, run):
+		try:
+			while True:
+				yield cPickle.load(run)
+		except EOFError:
+			run.close()
+
+	def sorted(self):
+		# Sorted records can only be read once
+		self.records.sort()
+		if len(self.levels) <= 0:
+			records = self.records
+			self.records = []
+			return iter(records)
+
+		if len(self.records) > 0:
+			self.add_run(0, self.spill(self.records))
+			self.records = []
+
+		# Smallest runs first. Merge the smallest together until
+		# no more than fan_in runs are left to open at once
+		runs = [ run for level in self.levels for run in level ]
+		self.levels = []
+		while len(runs) > self.fan_in:
+			merged = min(self.fan_in, len(runs) - self.fan_in + 1)
+			runs = [ self.spill(self.merge(runs[0:merged])) ] + runs[merged:]
+
+		return self.merge(runs)
+
+# Uniform grid index of (xmin, ymin, xmax, ymax) bounding boxes.
+# Each box is listed in every grid cell it overlaps, so a query
+# only needs to check the boxes in the cells the query box covers
+
+class mmqgis_spatial_grid:
+	def __init__(self, boxes):
+		self.boxes = boxes
+		self.cells = {}
+
+		if len(boxes) <= 0:
+			self.size = 1.0
+			self.xmin = self.ymin = self.xmax = self.ymax = 0.0
+			return
+
+		self.xmin = min([ box[0] for box in boxes ])
+		self.ymin = min([ box[1] for box in boxes ])
+		self.xmax = max([ box[2] for box in boxes ])
+		self.ymax = max([ box[3] for box in boxes ])
+
+		# Cells are at least as large as the average box so most boxes
+		# land in few cells, and no smaller than one cell per box over the extent
+		mean_width = sum([ box[2] - box[0] for box in boxes ]) / len(boxes)
+		mean_height = sum([ box[3] - box[1] for box in boxes ]) / len(boxes)
+		density = sqrt((self.xmax - self.xmin) * (self.ymax - self.ymin) / len(boxes))
+		self.size = max(mean_width, mean_height, density)
+		if (self.size <= 0):
+			self.size = 1.0
+
+		for index, box in enumerate(boxes):
+			for key in self.keys(box):
+				if key in self.cells:
+					self.cells[key].append(index)
+				else:
+					self.cells[key] = [ index ]
+
+	def keys(self, box):
+		# Query boxes larger than the grid are trimmed to the grid extent
+		left = int(floor((max(box[0], self.xmin) - self.xmin) / self.size))
+		bottom = int(floor((max(box[1], self.ymin) - self.ymin) / self.size))
+		right = int(floor((min(box[2], self.xmax) - self.xmin) / self.size))
+		top = int(floor((min(box[3], self.ymax) - self.ymin) / self.size))
+
+		return [ (column, row) for column in range(left, right + 1) for row in range(bottom, top + 1) ]
+
+	def candidates(self, box):
+		# Indices of boxes overlapping (or touching) box, in the order they were indexed
+		if (box[0] > self.xmax) or (box[2] < self.xmin) or (box[1] > self.ymax) or (box[3] < self.ymin):
+			return []
+
+		found = set()
+		for key in self.keys(box):
+			for index in self.cells.get(key, []):
+				other = self.boxes[index]
+				if (other[0] <= box[2]) and (other[2] >= box[0]) and \
+				   (other[1] <= box[3]) and (other[3] >= box[1]):
+					found.add(index)
+
+		return sorted(found)
+
 class mmqgis_voronoi_line:
 	def __init__(self, x, y):
 		self.x = x
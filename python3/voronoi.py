@@ -95,6 +95,12 @@ Algorithmica 2, 153-174.
 #        Returns a list of 3-tuples: the indices of the points that form a
 #        Delaunay triangle.
 #
+#   computeVoronoiNeighbors(points):
+#
+#        Takes a list of point objects (which must have x and y fields).
+#        Returns a list of 2-tuples: the indices of the points whose
+#        Voronoi regions are separated by a bisector of the diagram.
+#
 #############################################################################
 import math
 import sys
@@ -117,6 +123,7 @@ class Context( object ):
         self.lines     = []    # equation of line 3-tuple (a b c), for the equation of the line a*x+b*y = c  
         self.edges     = []    # edge 3-tuple: (line index, vertex 1 index, vertex 2 index)   if either vertex index is -1, the edge extends to infiinity
         self.triangles = []    # 3-tuple of vertex indices
+        self.bisectors = []    # 2-tuple of site indices: (site 1 index, site 2 index) for each line
 #        self.extra_edges = []  # list of additional vertex 2-tubles (x,y) based on bounded voronoi tesselation
 #        self.set_bounds(None)
 #        self.use_bound = False
@@ -193,6 +200,7 @@ class Context( object ):
 
     def outBisector(self,edge):
         self.lines.append((edge.a, edge.b, edge.c))
+        self.bisectors.append((edge.reg[0].sitenum, edge.reg[1].sitenum))
         if(self.debug):
             print("line(%d) %gx+%gy=%g, bisecting %d %d" % (edge.edgenum, edge.a, edge.b, edge.c, edge.reg[0].sitenum, edge.reg[1].sitenum))
         elif(self.triangulate):
@@ -843,6 +851,19 @@ def computeDelaunayTriangulation( points ):
     voronoi( siteList, context )
     return context.triangles
 
+#------------------------------------------------------------------
+def computeVoronoiNeighbors( points ):
+    """ Takes a list of point objects (which must have x and y fields).
+        Returns a list of 2-tuples: the indices of the points whose
+        Voronoi regions are separated by a bisector of the diagram.
+        Points must be distinct.
+    """
+    siteList = SiteList( points )
+    context  = Context()
+    context.set_bounds( siteList )
+    voronoi( siteList, context )
+    return context.bisectors
+
 #-----------------------------------------------------------------------------
 if __name__=="__main__":
     try: